@@ -1,272 +1,41 @@
-import json
-import math
+import argparse
+import copy
+import keyword
 import os
-import subprocess
+import random
 import sys
-from dataclasses import dataclass, asdict, field
-from typing import Dict, List, Optional, Tuple
+import time
+from dataclasses import asdict
+from functools import partial
+from typing import Optional, Tuple
 
+import numpy as np
 from PySide6 import QtCore, QtGui, QtWidgets
 
-
-# -----------------------------
-# Data model
-# -----------------------------
-
-
-def _clamp01(x: float) -> float:
-    return max(0.0, min(1.0, float(x)))
-
-
-@dataclass
-class Vec3:
-    x: float = 0.0
-    y: float = 0.0
-    z: float = 0.0
-
-
-@dataclass
-class Color3:
-    r: float = 1.0
-    g: float = 1.0
-    b: float = 1.0
-
-
-@dataclass
-class Transform:
-    translate: Vec3 = field(default_factory=Vec3)
-    scale: Vec3 = field(default_factory=lambda: Vec3(1.0, 1.0, 1.0))
-    rot_z_deg: float = 0.0
-
-
-@dataclass
-class MaterialSpec:
-    kind: str = "matte"  # matte | checker | mirror
-    params: Dict[str, float] = field(default_factory=dict)
-
-
-@dataclass
-class ObjectSpec:
-    name: str
-    kind: str  # ball | cube | planeuv | cilinder
-    params: Dict[str, float] = field(default_factory=dict)
-    transform: Transform = field(default_factory=Transform)
-    material: MaterialSpec = field(default_factory=MaterialSpec)
-
-
-@dataclass
-class CameraSpec:
-    eye: Vec3 = field(default_factory=lambda: Vec3(12, 12, 4))
-    look_at: Vec3 = field(default_factory=lambda: Vec3(0, 0, 2.5))
-    up: Vec3 = field(default_factory=lambda: Vec3(0, 0, 1))
-    fov: float = 45.0
-    img_width: int = 200
-    img_height: int = 200
-
-
-@dataclass
-class LightSpec:
-    kind: str = "area"  # area only in this app
-    position: Vec3 = field(default_factory=lambda: Vec3(10, 5, 15))
-    look_at: Vec3 = field(default_factory=lambda: Vec3(0, 0, 0))
-    up: Vec3 = field(default_factory=lambda: Vec3(1, 1, 1))
-    width: float = 4.0
-    height: float = 4.0
-    color: Color3 = field(default_factory=lambda: Color3(0.8, 0.6, 0.6))
-    intensity: float = 1.7
-
-
-@dataclass
-class SceneSpec:
-    name: str = "Editor Scene"
-    background: Color3 = field(default_factory=lambda: Color3(0.7, 0.8, 0.95))
-    ambient_light: Color3 = field(default_factory=lambda: Color3(0.1, 0.1, 0.1))
-    max_depth: int = 4
-    camera: CameraSpec = field(default_factory=CameraSpec)
-    light: LightSpec = field(default_factory=LightSpec)
-    objects: List[ObjectSpec] = field(default_factory=list)
-
-
-# -----------------------------
-# Exporter (.py scene)
-# -----------------------------
-
-
-def _py_vec3(v: Vec3) -> str:
-    return f"Vector3D({v.x:.6g}, {v.y:.6g}, {v.z:.6g})"
-
-
-def _py_color(c: Color3) -> str:
-    return f"Color({c.r:.6g}, {c.g:.6g}, {c.b:.6g})"
-
-
-def _rot_z_matrix(theta_deg: float) -> List[List[float]]:
-    t = math.radians(theta_deg)
-    c = math.cos(t)
-    s = math.sin(t)
-    return [[c, -s, 0.0], [s, c, 0.0], [0.0, 0.0, 1.0]]
-
-
-def _scale_matrix(s: Vec3) -> List[List[float]]:
-    return [[s.x, 0.0, 0.0], [0.0, s.y, 0.0], [0.0, 0.0, s.z]]
-
-
-def _matmul3(a: List[List[float]], b: List[List[float]]) -> List[List[float]]:
-    out = [[0.0, 0.0, 0.0] for _ in range(3)]
-    for i in range(3):
-        for j in range(3):
-            out[i][j] = sum(a[i][k] * b[k][j] for k in range(3))
-    return out
-
-
-def export_scene_py(scene: SceneSpec, out_path: str) -> None:
-    module_name = os.path.splitext(os.path.basename(out_path))[0]
-
-    lines: List[str] = []
-    lines.append(
-        "\n".join(
-            [
-                '"""Auto-generated by app.py scene editor.',
-                "",
-                "Do not edit by hand unless you know what you're doing.",
-                f"Module name: {module_name}",
-                '"""',
-            ]
-        )
-    )
-    lines.append("import math")
-    lines.append("import numpy as np")
-    lines.append("from src.base import BaseScene, Color")
-    lines.append("from src.vector3d import Vector3D")
-    lines.append("from src.camera import Camera")
-    lines.append("from src.light import AreaLight")
-    lines.append(
-        "from src.shapes import Ball, Cube, PlaneUV, ObjectTransform, Translate, Cilinder"
-    )
-    lines.append(
-        "from src.materials import SimpleMaterialWithShadows, CheckerboardMaterial, ReflectiveMaterial"
-    )
-    lines.append("")
-
-    lines.append("def _m(m):")
-    lines.append("    return np.array(m, dtype=float)")
-    lines.append("")
-
-    lines.append("class Scene(BaseScene):")
-    lines.append("    def __init__(self):")
-    lines.append(f"        super().__init__({scene.name!r})")
-    lines.append(f"        self.background = {_py_color(scene.background)}")
-    lines.append(f"        self.ambient_light = {_py_color(scene.ambient_light)}")
-    lines.append(f"        self.max_depth = {int(scene.max_depth)}")
-
-    cam = scene.camera
-    lines.append(
-        "        self.camera = Camera(\n"
-        f"            eye={_py_vec3(cam.eye)},\n"
-        f"            look_at={_py_vec3(cam.look_at)},\n"
-        f"            up={_py_vec3(cam.up)},\n"
-        f"            fov={float(cam.fov):.6g},\n"
-        f"            img_width={int(cam.img_width)},\n"
-        f"            img_height={int(cam.img_height)},\n"
-        "        )"
-    )
-
-    li = scene.light
-    lines.append("        self.lights = [AreaLight(")
-    lines.append(f"            position={_py_vec3(li.position)},")
-    lines.append(f"            look_at={_py_vec3(li.look_at)},")
-    lines.append(f"            up={_py_vec3(li.up)},")
-    lines.append(f"            width={float(li.width):.6g},")
-    lines.append(f"            height={float(li.height):.6g},")
-    lines.append(f"            color={_py_color(li.color)},")
-    lines.append(f"            intensity={float(li.intensity):.6g}))")
-    lines.append("")
-
-    for obj in scene.objects:
-        # materials (per-object, simple + deterministic)
-        mat = obj.material
-        if mat.kind == "matte":
-            kd = float(mat.params.get("diffuse", 0.9))
-            ka = float(mat.params.get("ambient", 0.12))
-            ks = float(mat.params.get("specular", 0.15))
-            shin = float(mat.params.get("shininess", 32.0))
-            dr = float(mat.params.get("dr", 0.7))
-            dg = float(mat.params.get("dg", 0.2))
-            db = float(mat.params.get("db", 0.2))
-            lines.append(
-                f"        _mat_{obj.name} = SimpleMaterialWithShadows({ka:.6g}, {kd:.6g}, Color({dr:.6g}, {dg:.6g}, {db:.6g}), {ks:.6g}, Color(1,1,1), {shin:.6g})"
-            )
-        elif mat.kind == "checker":
-            ka = float(mat.params.get("ambient", 1.0))
-            kd = float(mat.params.get("diffuse", 0.9))
-            sq = float(mat.params.get("square_size", 1.0))
-            lines.append(
-                f"        _mat_{obj.name} = CheckerboardMaterial({ka:.6g}, {kd:.6g}, {sq:.6g})"
-            )
-        else:  # mirror
-            rc = float(mat.params.get("reflection", 1.0))
-            lines.append(
-                f"        _mat_{obj.name} = ReflectiveMaterial(0.0, 0.0, Color(0,0,0), 0.0, Color(0,0,0), reflection_coefficient={rc:.6g})"
-            )
-
-        # shapes
-        if obj.kind == "ball":
-            radius = float(obj.params.get("radius", 1.0))
-            lines.append(f"        _shape_{obj.name} = Ball(center=Vector3D(0,0,0), radius={radius:.6g})")
-        elif obj.kind == "cube":
-            size = float(obj.params.get("size", 1.0))
-            lines.append(f"        _shape_{obj.name} = Cube(size={size:.6g})")
-        elif obj.kind == "cilinder":
-            radius = float(obj.params.get("radius", 0.5))
-            height = float(obj.params.get("height", 2.0))
-            lines.append(f"        _shape_{obj.name} = Cilinder(radius={radius:.6g}, height={height:.6g})")
-        else:  # planeuv
-            px = float(obj.params.get("px", 0.0))
-            py = float(obj.params.get("py", 0.0))
-            pz = float(obj.params.get("pz", 0.0))
-            nx = float(obj.params.get("nx", 0.0))
-            ny = float(obj.params.get("ny", 0.0))
-            nz = float(obj.params.get("nz", 1.0))
-            fx = float(obj.params.get("fx", 1.0))
-            fy = float(obj.params.get("fy", 0.0))
-            fz = float(obj.params.get("fz", 0.0))
-            lines.append(
-                "        _shape_%s = PlaneUV(point=Vector3D(%.6g, %.6g, %.6g), normal=Vector3D(%.6g, %.6g, %.6g), forward_direction=Vector3D(%.6g, %.6g, %.6g))"
-                % (obj.name, px, py, pz, nx, ny, nz, fx, fy, fz)
-            )
-
-        # transforms: for PlaneUV, keep as-is (more predictable)
-        if obj.kind != "planeuv":
-            t = obj.transform
-            # build linear matrix = Rz @ S
-            # (consistent with your existing scenes: rot_z(...) @ scale3(...))
-            s = t.scale
-            # avoid singular matrices
-            sx, sy, sz = float(s.x), float(s.y), float(s.z)
-            if abs(sx) < 1e-8:
-                sx = 1e-3
-            if abs(sy) < 1e-8:
-                sy = 1e-3
-            if abs(sz) < 1e-8:
-                sz = 1e-3
-
-            R = _rot_z_matrix(float(t.rot_z_deg))
-            S = _scale_matrix(Vec3(sx, sy, sz))
-            M = _matmul3(R, S)
-            lines.append(f"        _shape_{obj.name} = ObjectTransform(_shape_{obj.name}, _m({M}))")
-
-            tr = t.translate
-            if abs(tr.x) > 1e-12 or abs(tr.y) > 1e-12 or abs(tr.z) > 1e-12:
-                lines.append(
-                    f"        _shape_{obj.name} = Translate(_shape_{obj.name}, Vector3D({tr.x:.6g}, {tr.y:.6g}, {tr.z:.6g}))"
-                )
-
-        lines.append(f"        self.add(_shape_{obj.name}, _mat_{obj.name})")
-        lines.append("")
-
-    content = "\n".join(lines) + "\n"
-    with open(out_path, "w", encoding="utf-8") as f:
-        f.write(content)
+import raster
+from src import camera, film, gbuffer, imageio, lightbuffers, rasterizer
+from src.dependencies import Dependencies
+from src.gbuffer import GBuffer
+from src.scenespec import (
+    Color3,
+    MaterialSpec,
+    ObjectSpec,
+    SceneSpec,
+    Transform,
+    Vec3,
+    _clamp01,
+    build_scene,
+    export_scene_py,
+    light_edit,
+    light_levels,
+    object_edit,
+    orbit_camera,
+    pan_camera,
+    shading_edit,
+    spec_from_dict,
+    zoom_camera,
+)
+from src.service import DefaultAddress, RenderClient, tile_pixels
 
 
 # -----------------------------
@@ -335,6 +104,295 @@ def _color_editor(prefix: str) -> Tuple[QtWidgets.QWidget, FloatEdit, FloatEdit,
 # -----------------------------
 
 
+# -----------------------------
+# Rendering
+# -----------------------------
+
+
+def _center_out(tiles: list, width: int, height: int) -> list:
+    # the middle of the image first, where the eye goes
+    return sorted(tiles, key=lambda t: ((t[0] + t[1] - height) ** 2 + (t[2] + t[3] - width) ** 2))
+
+
+class RenderSignals(QtCore.QObject):
+    # emitted from the render thread, delivered on the GUI thread
+    tile_ready = QtCore.Signal(int, int)  # tiles done, total
+    finished = QtCore.Signal(float)  # seconds
+    failed = QtCore.Signal(str)
+    message = QtCore.Signal(str)
+
+
+class ViewportLabel(QtWidgets.QLabel):
+    # the preview, navigated with the mouse: left drag orbits, right or middle
+    # drag (or shift + left) pans, the wheel zooms. Moves are in fractions of
+    # the label's width
+    orbited = QtCore.Signal(float, float)
+    panned = QtCore.Signal(float, float)
+    zoomed = QtCore.Signal(float)  # wheel steps, positive zooms in
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._last: Optional[QtCore.QPointF] = None
+
+    def mousePressEvent(self, event: QtGui.QMouseEvent):
+        self._last = event.position()
+
+    def mouseReleaseEvent(self, event: QtGui.QMouseEvent):
+        self._last = None
+
+    def mouseMoveEvent(self, event: QtGui.QMouseEvent):
+        if self._last is None:
+            return
+        delta = (event.position() - self._last) / max(self.width(), 1)
+        self._last = event.position()
+        buttons = event.buttons()
+        shift = event.modifiers() & QtCore.Qt.KeyboardModifier.ShiftModifier
+        if buttons & (QtCore.Qt.MouseButton.RightButton | QtCore.Qt.MouseButton.MiddleButton) or shift:
+            self.panned.emit(delta.x(), delta.y())
+        elif buttons & QtCore.Qt.MouseButton.LeftButton:
+            self.orbited.emit(delta.x(), delta.y())
+
+    def wheelEvent(self, event: QtGui.QWheelEvent):
+        self.zoomed.emit(event.angleDelta().y() / 120)
+
+
+class RenderCache:
+    # what a finished render leaves for the next one: its scene, settings,
+    # film, per pixel dependencies and, for deferred renders, first hits.
+    # The film of a render with light buffers holds them, not the image
+    def __init__(self, spec: SceneSpec, settings: tuple, image: film.Film, dependencies: Optional[Dependencies],
+                 first_hits: Optional[GBuffer] = None, light_buffers: bool = False):
+        self.spec = spec
+        self.settings = settings
+        self.film = image
+        self.dependencies = dependencies
+        self.gbuffer = first_hits
+        self.light_buffers = light_buffers
+
+
+class RenderTask(QtCore.QRunnable):
+    # renders a copy of a SceneSpec on a QThreadPool thread, tile by tile, into
+    # framebuffer (8-bit RGB, top row first), which the preview wraps in a
+    # QImage without copying. The raster engine runs in this process unless a
+    # render daemon (daemon.py) answers at the daemon address.
+    # Viewport renders trade quality for speed: the image is 1/scale of the
+    # camera's, direct lighting only (no reflections), shadows optional, the
+    # camera rays resolved from a z-buffer (primary "raster", as in raster.py)
+    # and passes of num_samples each are added up, showing the image after each.
+    # Incremental renders record what each pixel depends on (in the editor,
+    # not the daemon) and leave it in cache; given the cache of a render with
+    # the same settings (previous) and a scene edited in one object, only the
+    # pixels the edit may change are rendered again.
+    # Deferred renders (in the editor, one pass) keep the first hits of their
+    # samples (see gbuffer.py), also next to the output as <output>_gbuffer.npz;
+    # when only materials, the light, the background or the ambient light
+    # changed since, the image is shaded again from them.
+    # Renders with light buffers (in the editor) keep what each light adds to
+    # the image apart (see lightbuffers.py), also as <output>_lights.npz, so
+    # that light color and intensity edits need no render (MainWindow._relight)
+    def __init__(self, spec: SceneSpec, num_samples: int, output: Optional[str] = None, daemon: Optional[str] = None,
+                 scale: int = 1, direct: bool = False, shadows: bool = True, primary: str = "trace", passes: int = 1,
+                 incremental: bool = False, previous: Optional[RenderCache] = None, deferred: bool = False,
+                 light_buffers: bool = False):
+        super().__init__()
+        self.setAutoDelete(False)
+        # edits made while rendering do not reach this copy
+        self.spec = copy.deepcopy(spec)
+        self.num_samples = num_samples
+        self.output = output
+        self.daemon = daemon
+        self.scale = scale
+        self.direct = direct
+        self.shadows = shadows
+        self.primary = primary
+        self.passes = passes
+        self.incremental = incremental
+        self.previous = previous
+        self.deferred = deferred and passes == 1
+        self.light_buffers = light_buffers
+        # (color, intensity) of the lights the buffers are shown with
+        self.levels = light_levels(spec)
+        self.cache: Optional[RenderCache] = None
+        self.width = max(1, int(spec.camera.img_width) // scale)
+        self.height = max(1, int(spec.camera.img_height) // scale)
+        self.framebuffer = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        self.signals = RenderSignals()
+        self.cancelled = False
+        # set when run returns; until then the pool runs it
+        self.ended = False
+        self._client: Optional[RenderClient] = None
+        self._job = None
+
+    def cancel(self):
+        self.cancelled = True
+        if self._client is not None and self._job is not None:
+            self._client.cancel(self._job)
+
+    def _show(self, tile: Tuple[int, int, int, int], pixels: np.ndarray):
+        # film rows go up from the bottom, framebuffer rows down from the top
+        i0, i1, j0, j1 = tile
+        self.framebuffer[self.height - i1 : self.height - i0, j0:j1] = imageio.display(pixels)[::-1]
+
+    def _pixels(self, pixels: np.ndarray) -> np.ndarray:
+        # the image of film pixels
+        return lightbuffers.compose(pixels, self.levels) if self.light_buffers else pixels
+
+    def settings(self) -> tuple:
+        return (self.width, self.height, self.num_samples, self.passes, self.direct, self.shadows, self.primary,
+                self.light_buffers)
+
+    def _edit(self) -> Optional[Tuple[int, bool]]:
+        # the object edit since the previous render, when its pixels can be reused
+        previous = self.previous
+        if not self.incremental or self.deferred or previous is None or previous.dependencies is None:
+            return None
+        if previous.settings != self.settings():
+            return None
+        return object_edit(previous.spec, self.spec)
+
+    def _gbuffer_path(self) -> Optional[str]:
+        return os.path.splitext(self.output)[0] + "_gbuffer.npz" if self.output else None
+
+    def _first_hits(self) -> Tuple[Optional[GBuffer], Optional[Dependencies]]:
+        # the first hits this render can be shaded from, those of the previous
+        # render or of the file next to the output, and their dependencies
+        if not self.deferred:
+            return None, None
+        previous = self.previous
+        if (previous is not None and previous.gbuffer is not None and previous.settings == self.settings()
+                and shading_edit(previous.spec, self.spec)):
+            return previous.gbuffer, previous.dependencies
+        path = self._gbuffer_path()
+        if path and os.path.exists(path):
+            try:
+                header, first_hits = gbuffer.load(path)
+            except (OSError, ValueError, KeyError):
+                return None, None
+            if header.get("settings") == list(self.settings()) and shading_edit(spec_from_dict(header["spec"]), self.spec):
+                return first_hits, None
+        return None, None
+
+    def _build(self, spec: SceneSpec):
+        scene = build_scene(spec)
+        if self.scale != 1:
+            scene.camera = camera.resized(scene.camera, self.width, self.height)
+        if self.direct:
+            scene.max_depth = 0
+        scene.shadows = self.shadows
+        if self.light_buffers:
+            lightbuffers.unit_lights(scene)
+        scene.freeze()
+        return scene
+
+    def run(self):
+        start = time.time()
+        try:
+            local = self.deferred or self.light_buffers or self._edit() is not None
+            completed = self._run_daemon() if self.daemon and not local else None
+            if completed is None:
+                completed = self._run_local()
+        except Exception as e:
+            self.signals.failed.emit(repr(e))
+            return
+        finally:
+            self.ended = True
+        if completed:
+            self.signals.finished.emit(time.time() - start)
+
+    def _run_local(self) -> bool:
+        if self.cancelled:
+            return False
+        if self.daemon:
+            self.signals.message.emit("Rendering in the editor")
+        scene = self._build(self.spec)
+        vis = rasterizer.rasterize(scene, scene.camera) if self.primary == "raster" else None
+        options = argparse.Namespace(
+            num_samples=self.num_samples, engine="wavefront", texture_cache_mb=64, filter="box",
+            filter_radius=None, aux=False, denoise=False, squares=False, light_buffers=self.light_buffers,
+        )
+        image = film.Film(self.width, self.height, lightbuffers.channels(scene) if self.light_buffers else 3)
+        dependencies = Dependencies(scene, self.width, self.height) if self.incremental else None
+        mask = None
+        first_hits, deferred = None, None
+        edit = self._edit()
+        if self.deferred:
+            deferred, previous_dependencies = self._first_hits()
+            if deferred is not None:
+                # same samples, same pixels seen: only their shading changes
+                dependencies = None
+                if previous_dependencies is not None:
+                    dependencies = previous_dependencies.updated(scene, np.zeros((self.height, self.width), dtype=bool))
+                first_hits = deferred
+                self.signals.message.emit("Shading again from the first hits")
+            else:
+                first_hits = GBuffer()
+        elif edit is not None:
+            index, geometry = edit
+            previous = self.previous
+            mask = previous.dependencies.stale(index, geometry, self._build(previous.spec), scene)
+            dependencies = previous.dependencies.updated(scene, mask)
+            image.sums[:] = previous.film.sums
+            image.weights[:] = previous.film.weights
+            # the box filter keeps each sample in its pixel
+            image.sums[mask] = 0
+            image.weights[mask] = 0
+            self._show((0, self.height, 0, self.width), self._pixels(previous.film.image()))
+            self.signals.message.emit(f"Rendering {100 * mask.mean():.1f}% of the pixels again")
+        tiles = _center_out(raster.tiles(self.width, self.height), self.width, self.height)
+        if mask is not None:
+            tiles = [(i0, i1, j0, j1) for i0, i1, j0, j1 in tiles if mask[i0:i1, j0:j1].any()]
+        for p in range(self.passes):
+            context = raster.make_context(options, scene, vis, random.getrandbits(31))
+            context.mask = mask
+            context.dependencies = dependencies if deferred is None else None
+            context.gbuffer = first_hits if deferred is None else None
+            context.deferred = deferred
+            for k, tile in enumerate(tiles):
+                if self.cancelled:
+                    return False
+                _, block, _, _ = raster.render_tile(context, tile)
+                image.add(*block)
+                self._show(tile, self._pixels(image.image(*tile)))
+                self.signals.tile_ready.emit(p * len(tiles) + k + 1, self.passes * len(tiles))
+        if self.output:
+            imageio.write_image(self.output, imageio.image_rows(self._pixels(image.image())), self.width, self.height)
+            if self.light_buffers:
+                lightbuffers.save(os.path.splitext(self.output)[0] + "_lights.npz", image.image(), self.levels)
+        if first_hits is not None and first_hits.changed and self.output:
+            first_hits.save(self._gbuffer_path(), dict(spec=asdict(self.spec), settings=list(self.settings())))
+        if dependencies is not None or first_hits is not None:
+            self.cache = RenderCache(self.spec, self.settings(), image, dependencies, first_hits, self.light_buffers)
+        return True
+
+    def _run_daemon(self) -> Optional[bool]:
+        # None when no daemon answers
+        try:
+            self._client = RenderClient(self.daemon, timeout=0.2)
+        except OSError:
+            return None
+        self.signals.message.emit(f"Rendering with the daemon at {self.daemon}")
+        request = {"spec": asdict(self.spec), "num_samples": self.num_samples, "priority": "preview", "stream": True}
+        if self.output:
+            request["output"] = os.path.abspath(self.output)
+        try:
+            self._job = self._client.submit(request)
+            if self.cancelled:
+                self._client.cancel(self._job)
+            for event in self._client.events():
+                if event.get("id") != self._job:
+                    continue
+                if event["event"] == "progress":
+                    self._show(event["tile"], tile_pixels(event))
+                    self.signals.tile_ready.emit(event["done"], event["total"])
+                elif event["event"] == "error":
+                    raise RuntimeError(event["message"])
+                elif event["event"] in ("done", "cancelled"):
+                    return event["event"] == "done"
+            raise ConnectionError("The render daemon closed the connection")
+        finally:
+            self._client.close()
+
+
 class MainWindow(QtWidgets.QMainWindow):
     def __init__(self):
         super().__init__()
@@ -342,6 +400,29 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.scene = SceneSpec()
         self._selected_index: Optional[int] = None
+        # set while widgets are filled from the scene: their signals must not
+        # write the half-filled widgets back
+        self._loading = False
+        self._render_task: Optional[RenderTask] = None
+        self._render_image: Optional[QtGui.QImage] = None
+        # pixels behind the preview, kept for the next viewport frame
+        self._framebuffer: Optional[np.ndarray] = None
+        # "preview" and "refine" for the viewport's renders, None for the others
+        self._render_kind: Optional[str] = None
+        # set when the scene changed under a viewport preview in flight
+        self._viewport_stale = False
+        # started tasks are kept until they end, the pool does not own them
+        self._render_tasks = []
+        # caches of the last incremental renders, by their settings
+        self._render_caches = {}
+        # one render at a time: a new one waits for the cancelled one's tile
+        self._render_pool = QtCore.QThreadPool()
+        self._render_pool.setMaxThreadCount(1)
+        # the viewport is refined when the edits pause for this long
+        self._refine_timer = QtCore.QTimer()
+        self._refine_timer.setSingleShot(True)
+        self._refine_timer.setInterval(300)
+        self._refine_timer.timeout.connect(self._refine_viewport)
 
         self._default_scene()
         self._build_ui()
@@ -355,6 +436,8 @@ class MainWindow(QtWidgets.QMainWindow):
             kind="planeuv",
             params={"px": 0, "py": 0, "pz": 0, "nx": 0, "ny": 0, "nz": 1, "fx": 1, "fy": 0, "fz": 0},
             material=MaterialSpec(kind="checker", params={"square_size": 1.0}),
+            # the ground never shadows the objects above it
+            casts_shadows=False,
         )
         # a ball
         ball = ObjectSpec(
@@ -432,6 +515,9 @@ class MainWindow(QtWidgets.QMainWindow):
         light_lay.addWidget(_row("Width", self.light_w))
         light_lay.addWidget(_row("Height", self.light_h))
         light_lay.addWidget(_row("Intensity", self.light_int))
+        self.light_shadow_samples = IntEdit(minimum=1, maximum=256)
+        self.light_shadow_samples.setValue(self.scene.light.shadow_samples)
+        light_lay.addWidget(_row("Shadow rays", self.light_shadow_samples))
         lc_box, self.light_r, self.light_g, self.light_b = _color_editor("Color")
         light_lay.addWidget(lc_box)
         scene_lay.addWidget(light_box)
@@ -512,6 +598,17 @@ class MainWindow(QtWidgets.QMainWindow):
         mat_lay.addWidget(self.mat_stack)
         obj_lay.addWidget(self.mat_group)
 
+        # visibility
+        self.vis_group = QtWidgets.QGroupBox("Visibility")
+        vis_lay = QtWidgets.QVBoxLayout(self.vis_group)
+        self.vis_shadows = QtWidgets.QCheckBox("Casts shadows")
+        self.vis_camera = QtWidgets.QCheckBox("Visible to camera")
+        self.vis_reflections = QtWidgets.QCheckBox("Visible in reflections")
+        vis_lay.addWidget(self.vis_shadows)
+        vis_lay.addWidget(self.vis_camera)
+        vis_lay.addWidget(self.vis_reflections)
+        obj_lay.addWidget(self.vis_group)
+
         right_lay.addWidget(self.obj_group, 0)
 
         # Export/render
@@ -527,10 +624,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.samples = IntEdit(minimum=1, maximum=4096)
         self.samples.setValue(16)
-        self.jobs = IntEdit(minimum=1, maximum=64)
-        self.jobs.setValue(4)
         exp_lay.addWidget(_row("Samples", self.samples))
-        exp_lay.addWidget(_row("Jobs", self.jobs))
 
         self.out_img_path = QtWidgets.QLineEdit("preview.png")
         exp_lay.addWidget(QtWidgets.QLabel("Output image") )
@@ -538,9 +632,18 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.btn_export = QtWidgets.QPushButton("Export Scene")
         self.btn_render = QtWidgets.QPushButton("Render")
+        self.btn_cancel = QtWidgets.QPushButton("Cancel")
+        self.btn_cancel.setEnabled(False)
+        self.render_deferred = QtWidgets.QCheckBox("Deferred")
+        self.render_deferred.setToolTip("Keep the first hits of the render and shade material and light edits from them")
         exp_btns = QtWidgets.QHBoxLayout()
         exp_btns.addWidget(self.btn_export)
         exp_btns.addWidget(self.btn_render)
+        exp_btns.addWidget(self.btn_cancel)
+        exp_btns.addWidget(self.render_deferred)
+        self.render_light_buffers = QtWidgets.QCheckBox("Light buffers")
+        self.render_light_buffers.setToolTip("Keep what the light adds to the render apart: light color and intensity edits need no render")
+        exp_btns.addWidget(self.render_light_buffers)
         exp_lay.addLayout(exp_btns)
 
         self.render_log = QtWidgets.QPlainTextEdit()
@@ -548,7 +651,21 @@ class MainWindow(QtWidgets.QMainWindow):
         self.render_log.setMaximumBlockCount(5000)
         exp_lay.addWidget(self.render_log, 1)
 
-        self.preview = QtWidgets.QLabel()
+        viewport_row = QtWidgets.QHBoxLayout()
+        self.viewport_mode = QtWidgets.QCheckBox("Interactive")
+        self.viewport_mode.setToolTip("Render while editing; drag to orbit, right drag to pan, wheel to zoom")
+        self.viewport_scale = QtWidgets.QComboBox()
+        self.viewport_scale.addItems(["1/1", "1/2", "1/4", "1/8"])
+        self.viewport_scale.setCurrentText("1/4")
+        self.viewport_shadows = QtWidgets.QCheckBox("Shadows")
+        viewport_row.addWidget(self.viewport_mode)
+        viewport_row.addWidget(QtWidgets.QLabel("Scale"))
+        viewport_row.addWidget(self.viewport_scale)
+        viewport_row.addWidget(self.viewport_shadows)
+        viewport_row.addStretch(1)
+        exp_lay.addLayout(viewport_row)
+
+        self.preview = ViewportLabel()
         self.preview.setAlignment(QtCore.Qt.AlignmentFlag.AlignCenter)
         self.preview.setMinimumSize(300, 300)
         self.preview.setScaledContents(True)
@@ -564,6 +681,13 @@ class MainWindow(QtWidgets.QMainWindow):
         self.btn_browse_scene.clicked.connect(self._browse_scene_path)
         self.btn_export.clicked.connect(self._export_scene_clicked)
         self.btn_render.clicked.connect(self._render_clicked)
+        self.btn_cancel.clicked.connect(self._cancel_render)
+        self.viewport_mode.toggled.connect(self._viewport_toggled)
+        self.viewport_scale.currentTextChanged.connect(self._scene_edited)
+        self.viewport_shadows.toggled.connect(self._scene_edited)
+        self.preview.orbited.connect(self._viewport_orbit)
+        self.preview.panned.connect(self._viewport_pan)
+        self.preview.zoomed.connect(self._viewport_zoom)
 
         self.obj_name.editingFinished.connect(self._apply_obj_edits)
         self.obj_kind.currentTextChanged.connect(self._obj_kind_changed)
@@ -580,6 +704,9 @@ class MainWindow(QtWidgets.QMainWindow):
         ]:
             w.valueChanged.connect(self._apply_obj_edits)
 
+        for w in [self.vis_shadows, self.vis_camera, self.vis_reflections]:
+            w.toggled.connect(self._apply_obj_edits)
+
         # scene binds
         self.scene_name.editingFinished.connect(self._apply_scene_edits)
         self.max_depth.valueChanged.connect(self._apply_scene_edits)
@@ -616,6 +743,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.light_w,
             self.light_h,
             self.light_int,
+            self.light_shadow_samples,
             self.light_r,
             self.light_g,
             self.light_b,
@@ -767,6 +895,7 @@ class MainWindow(QtWidgets.QMainWindow):
             )
 
         self.scene.objects.append(obj)
+        self._scene_edited()
         self._refresh_object_list()
         self.object_list.setCurrentRow(len(self.scene.objects) - 1)
 
@@ -774,6 +903,7 @@ class MainWindow(QtWidgets.QMainWindow):
         if self._selected_index is None:
             return
         del self.scene.objects[self._selected_index]
+        self._scene_edited()
         self._refresh_object_list()
         new_idx = min(self._selected_index, len(self.scene.objects) - 1)
         self.object_list.setCurrentRow(new_idx)
@@ -781,6 +911,7 @@ class MainWindow(QtWidgets.QMainWindow):
     # ----- widget load/apply -----
 
     def _load_scene_widgets(self):
+        self._loading = True
         self.scene_name.setText(self.scene.name)
 
         self.bg_r.setValue(_clamp01(self.scene.background.r))
@@ -820,11 +951,15 @@ class MainWindow(QtWidgets.QMainWindow):
         self.light_w.setValue(float(li.width))
         self.light_h.setValue(float(li.height))
         self.light_int.setValue(float(li.intensity))
+        self.light_shadow_samples.setValue(int(li.shadow_samples))
         self.light_r.setValue(_clamp01(li.color.r))
         self.light_g.setValue(_clamp01(li.color.g))
         self.light_b.setValue(_clamp01(li.color.b))
+        self._loading = False
 
     def _apply_scene_edits(self):
+        if self._loading:
+            return
         self.scene.name = self.scene_name.text().strip() or "Editor Scene"
 
         self.scene.background = Color3(self.bg_r.value(), self.bg_g.value(), self.bg_b.value())
@@ -846,12 +981,22 @@ class MainWindow(QtWidgets.QMainWindow):
         li.width = float(self.light_w.value())
         li.height = float(self.light_h.value())
         li.intensity = float(self.light_int.value())
+        li.shadow_samples = int(self.light_shadow_samples.value())
         li.color = Color3(self.light_r.value(), self.light_g.value(), self.light_b.value())
+        self._scene_edited()
 
     def _load_object_widgets(self, obj: ObjectSpec):
+        self._loading = True
         self.obj_name.blockSignals(True)
         self.obj_kind.blockSignals(True)
         self.mat_kind.blockSignals(True)
+        for w in [self.vis_shadows, self.vis_camera, self.vis_reflections]:
+            w.blockSignals(True)
+
+        # set first: the value widgets below still fire _apply_obj_edits
+        self.vis_shadows.setChecked(obj.casts_shadows)
+        self.vis_camera.setChecked(obj.visible_to_camera)
+        self.vis_reflections.setChecked(obj.visible_in_reflections)
 
         self.obj_name.setText(obj.name)
         self.obj_kind.setCurrentText(obj.kind)
@@ -902,9 +1047,12 @@ class MainWindow(QtWidgets.QMainWindow):
         self.obj_name.blockSignals(False)
         self.obj_kind.blockSignals(False)
         self.mat_kind.blockSignals(False)
+        for w in [self.vis_shadows, self.vis_camera, self.vis_reflections]:
+            w.blockSignals(False)
+        self._loading = False
 
     def _apply_obj_edits(self):
-        if self._selected_index is None:
+        if self._selected_index is None or self._loading:
             return
         obj = self.scene.objects[self._selected_index]
 
@@ -914,6 +1062,9 @@ class MainWindow(QtWidgets.QMainWindow):
             existing = {o.name for i, o in enumerate(self.scene.objects) if i != self._selected_index}
             if new_name in existing:
                 self._log(f"Name '{new_name}' already exists; keeping '{obj.name}'.")
+            elif not new_name.isidentifier() or keyword.iskeyword(new_name):
+                # names are variables of the exported scene module
+                self._log(f"Name '{new_name}' is not a valid identifier; keeping '{obj.name}'.")
             else:
                 obj.name = new_name
 
@@ -956,8 +1107,13 @@ class MainWindow(QtWidgets.QMainWindow):
         else:
             obj.material.params = {"reflection": float(self.mirror_reflect.value())}
 
+        obj.casts_shadows = self.vis_shadows.isChecked()
+        obj.visible_to_camera = self.vis_camera.isChecked()
+        obj.visible_in_reflections = self.vis_reflections.isChecked()
+
         self._refresh_object_list()
         self.object_list.setCurrentRow(self._selected_index)
+        self._scene_edited()
 
     def _obj_kind_changed(self, kind: str):
         self._switch_params_page(kind)
@@ -998,51 +1154,188 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def _render_clicked(self):
         self._export_scene_clicked()
-
-        out_scene_path = self.out_scene_path.text().strip() or "scene_editor_output.py"
-        module_name = os.path.splitext(os.path.basename(out_scene_path))[0]
         out_img = self.out_img_path.text().strip() or "preview.png"
+        task = RenderTask(
+            self.scene, int(self.samples.value()), out_img, self._daemon_address(), incremental=True,
+            deferred=self.render_deferred.isChecked(), light_buffers=self.render_light_buffers.isChecked(),
+        )
+        if not self._relight(out_img, task.settings()):
+            self._start_render(task)
+
+    def _daemon_address(self) -> str:
+        return os.environ.get("RASTER_DAEMON", DefaultAddress)
+
+    def _start_render(self, task: RenderTask, kind: Optional[str] = None):
+        self._cancel_render()
+        if kind is None:
+            self._refine_timer.stop()
+        self._render_task = task
+        self._render_kind = kind
+        self._viewport_stale = False
+        if task.incremental:
+            task.previous = self._render_caches.get(task.settings())
+        self._render_start = time.time()
+        if kind is not None and self._framebuffer is not None:
+            # viewport frames start from the last one, scaled: no black flashes
+            h, w = self._framebuffer.shape[:2]
+            rows = np.arange(task.height) * h // task.height
+            cols = np.arange(task.width) * w // task.width
+            task.framebuffer[:] = self._framebuffer[rows][:, cols]
+        self._framebuffer = task.framebuffer
+        # the QImage reads the task's framebuffer in place
+        self._render_image = QtGui.QImage(
+            task.framebuffer.data, task.width, task.height, 3 * task.width, QtGui.QImage.Format.Format_RGB888
+        )
+        task.signals.tile_ready.connect(partial(self._render_tile_ready, task))
+        task.signals.finished.connect(partial(self._render_finished, task))
+        task.signals.failed.connect(partial(self._render_failed, task))
+        task.signals.message.connect(self._log)
+        self.btn_cancel.setEnabled(True)
+        self._render_tasks = [t for t in self._render_tasks if not t.ended] + [task]
+        self._render_pool.start(task)
+
+    def _cancel_render(self):
+        if self._render_task is not None:
+            self._render_task.cancel()
+            self._render_task = None
+            self._render_kind = None
+            self.btn_cancel.setEnabled(False)
+
+    def _render_tile_ready(self, task: RenderTask, done: int, total: int):
+        # signals of a cancelled render may still be queued
+        if task is not self._render_task:
+            return
+        self.preview.setPixmap(QtGui.QPixmap.fromImage(self._render_image))
 
-        cmd = [
-            sys.executable,
-            "raster.py",
-            "-s",
-            module_name,
-            "-n",
-            str(int(self.samples.value())),
-            "-j",
-            str(int(self.jobs.value())),
-            "-o",
-            out_img,
-        ]
+    def _render_finished(self, task: RenderTask, seconds: float):
+        if task is not self._render_task:
+            return
+        kind = self._render_kind
+        self._render_task = None
+        self._render_kind = None
+        self.btn_cancel.setEnabled(False)
+        self.preview.setPixmap(QtGui.QPixmap.fromImage(self._render_image))
+        if task.cache is not None:
+            self._render_caches.pop(task.cache.settings, None)
+            self._render_caches[task.cache.settings] = task.cache
+            while len(self._render_caches) > 2:
+                self._render_caches.pop(next(iter(self._render_caches)))
+        if kind == "preview":
+            # the frame is done: catch up with the edits made meanwhile
+            if self._viewport_stale:
+                self._preview_viewport()
+            return
+        if kind == "refine":
+            self._log(f"Viewport refined in {seconds:.2f}s ({task.passes} spp)")
+            return
+        self._log(f"Rendered in {seconds:.2f}s" + (f": {task.output}" if task.output else ""))
 
-        self._log("Running: " + " ".join(cmd))
-        try:
-            proc = subprocess.run(
-                cmd,
-                cwd=os.getcwd(),
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-            )
-            if proc.stdout:
-                self._log(proc.stdout.rstrip())
-            if proc.returncode != 0:
-                self._log(f"Render failed (exit={proc.returncode}).")
-                return
-        except Exception as e:
-            self._log(f"Render error: {e}")
+    def _render_failed(self, task: RenderTask, message: str):
+        if task is not self._render_task:
             return
+        self._render_task = None
+        self._render_kind = None
+        self.btn_cancel.setEnabled(False)
+        self._log(f"Render failed: {message}")
+
+    def _relight(self, output: Optional[str] = None, settings: Optional[tuple] = None) -> bool:
+        # light color and intensity edits since a render with light buffers:
+        # its image under the new light, a sum of the buffers. Edits of the
+        # scene only count when they changed the light, renders (output) when
+        # they have the settings of the buffers
+        caches = [
+            c for c in self._render_caches.values()
+            if c.light_buffers and light_edit(c.spec, self.scene)
+            and (c.settings == settings if output else c.spec.light != self.scene.light)
+        ]
+        if not caches:
+            return False
+        start = time.time()
+        cache = caches[-1]
+        self._cancel_render()
+        self._refine_timer.stop()
+        image = lightbuffers.compose(cache.film.image(), light_levels(self.scene))
+        # the buffers do not depend on the light: the cache stands for the new scene
+        cache.spec.light = copy.deepcopy(self.scene.light)
+        height, width = image.shape[:2]
+        self._framebuffer = np.ascontiguousarray(imageio.display(image)[::-1])
+        self._render_image = QtGui.QImage(
+            self._framebuffer.data, width, height, 3 * width, QtGui.QImage.Format.Format_RGB888
+        )
+        self.preview.setPixmap(QtGui.QPixmap.fromImage(self._render_image))
+        if output:
+            imageio.write_image(output, imageio.image_rows(image), width, height)
+        self._log(f"Relit in {1000 * (time.time() - start):.0f} ms" + (f": {output}" if output else ""))
+        return True
+
+    def _scene_edited(self):
+        # a render of the old scene is of no use any more
+        if self._relight():
+            return
+        if self.viewport_mode.isChecked():
+            self._preview_viewport()
+        else:
+            self._cancel_render()
 
-        if os.path.exists(out_img):
-            pix = QtGui.QPixmap(out_img)
-            if not pix.isNull():
-                self.preview.setPixmap(pix)
-                self._log(f"Preview updated: {out_img}")
-            else:
-                self._log(f"Could not load image: {out_img}")
+    # ----- interactive viewport -----
+
+    def _viewport_toggled(self, on: bool):
+        if on:
+            self._preview_viewport()
         else:
-            self._log(f"Output image not found: {out_img}")
+            self._refine_timer.stop()
+            if self._render_kind is not None:
+                self._cancel_render()
+
+    def _preview_viewport(self):
+        # a fast frame now, the refined image once the edits pause
+        self._refine_timer.start()
+        if self._render_kind == "preview":
+            # let the frame in flight finish, then render the latest scene
+            self._viewport_stale = True
+            return
+        scale = int(self.viewport_scale.currentText().split("/")[1])
+        task = RenderTask(
+            self.scene, 1, scale=scale, direct=True, shadows=self.viewport_shadows.isChecked(), primary="raster"
+        )
+        self._start_render(task, "preview")
+
+    def _refine_viewport(self):
+        if not self.viewport_mode.isChecked():
+            return
+        # full resolution and quality, one sample per pass up to Samples
+        task = RenderTask(self.scene, 1, primary="raster", passes=int(self.samples.value()), incremental=True)
+        self._start_render(task, "refine")
+
+    def _camera_moved(self):
+        self._load_scene_widgets()
+        self._scene_edited()
+
+    def _viewport_orbit(self, dx: float, dy: float):
+        if not self.viewport_mode.isChecked():
+            return
+        # a drag across the whole preview turns half way around
+        orbit_camera(self.scene.camera, -180 * dx, 180 * dy)
+        self._camera_moved()
+
+    def _viewport_pan(self, dx: float, dy: float):
+        if not self.viewport_mode.isChecked():
+            return
+        pan_camera(self.scene.camera, dx, dy)
+        self._camera_moved()
+
+    def _viewport_zoom(self, steps: float):
+        if not self.viewport_mode.isChecked():
+            return
+        zoom_camera(self.scene.camera, 0.9**steps)
+        self._camera_moved()
+
+    def closeEvent(self, event: QtGui.QCloseEvent):
+        # off first: the line edits losing focus still report edits
+        self.viewport_mode.setChecked(False)
+        self._cancel_render()
+        self._render_pool.waitForDone()
+        super().closeEvent(event)
 
     def _log(self, msg: str):
         self.render_log.appendPlainText(msg)
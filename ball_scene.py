@@ -78,7 +78,8 @@ class Scene(BaseScene):
             diffuse_coefficient=0.8,
             square_size=1.0,
             white_color=Color(0.9, 0.9, 0.9),
-            black_color=Color(0.2, 0.2, 0.2)
+            black_color=Color(0.2, 0.2, 0.2),
+            filtered=True
         )
         self.add(PlaneUV(point=Vector3D(0, 0, 0), normal=Vector3D(0, 0, 1), forward_direction=Vector3D(1, 1, 0)), gray_material)
 
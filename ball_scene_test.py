@@ -106,4 +106,4 @@ class Scene(BaseScene):
         # gray_material = ColorMaterial(
         #     diffuse_color=Color(0.8, 0.8, 0.8)
         # )
-        self.add(PlaneUV(point=Vector3D(0, 0, 0), normal=Vector3D(0, 0, 1), forward_direction=Vector3D(1, 1, 0)), gray_material)
\ No newline at end of file
+        self.add(PlaneUV(point=Vector3D(0, 0, 0), normal=Vector3D(0, 0, 1), forward_direction=Vector3D(1, 1, 0)), gray_material, casts_shadows=False)
\ No newline at end of file
@@ -0,0 +1,280 @@
+import os
+import sys
+import copy
+import json
+import time
+import heapq
+import random
+import asyncio
+import argparse
+import importlib
+from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import raster
+from src import camera, film, imageio, scenespec, service, textures
+
+# Long-lived render service: keeps a pool of worker processes with their
+# imports done, scenes loaded and structures built (rasterized visibility,
+# shadow maps, texture tiles), and renders the jobs sent to it over a local
+# socket (see src/service.py for the protocol), tile by tile, preview jobs
+# before final ones. Editing a scene and rendering it again only pays for
+# the tiles.
+
+# options of a job, by their raster.py names
+JobDefaults = dict(scene=None, spec=None, width=None, height=None, num_samples=1, engine='wavefront',
+                   primary='trace', shadow_map=0, mirror_views=0, light_samples=0, min_throughput=0.0,
+                   roulette=False, filter='box', filter_radius=None, aux=False, denoise=False, squares=False,
+                   texture_cache_mb=64, light_buffers=False, seed=None)
+# options the loaded and prepared scenes depend on
+SceneOptions = ('scene', 'spec', 'width', 'height', 'light_samples', 'min_throughput', 'roulette')
+PreparedOptions = SceneOptions + ('primary', 'shadow_map', 'mirror_views')
+# prepared scenes kept by each worker
+SceneCacheSize = 4
+
+# scenes of a worker process, most recently used last
+_scenes = OrderedDict()
+_module_times = dict()
+
+def _cached(key, build):
+    if key in _scenes:
+        _scenes.move_to_end(key)
+        return _scenes[key]
+    value = _scenes[key] = build()
+    while len(_scenes) > SceneCacheSize:
+        _scenes.popitem(last=False)
+    return value
+
+def _module(name):
+    # the scene module, imported again when its file changed
+    module = importlib.import_module(name)
+    mtime = os.path.getmtime(module.__file__)
+    if _module_times.setdefault(name, mtime) != mtime:
+        module = importlib.reload(module)
+        _module_times[name] = mtime
+    return module
+
+def load_scene(options):
+    # the frozen scene of a job, at the job's resolution
+    if options.spec is not None:
+        scene = scenespec.build_scene(scenespec.spec_from_dict(options.spec))
+    else:
+        scene = _module(options.scene).Scene()
+    if options.width or options.height:
+        width = options.width or scene.camera.img_width
+        height = options.height or round(scene.camera.img_height * width / scene.camera.img_width)
+        scene.camera = camera.resized(scene.camera, width, height)
+    scene.light_samples = options.light_samples
+    scene.min_throughput = options.min_throughput
+    scene.roulette = options.roulette
+    scene.freeze()
+    return scene
+
+def _key(options, names):
+    if options.scene is not None:
+        # edits of the module make another scene
+        _module(options.scene)
+    return json.dumps([getattr(options, name) for name in names] + [_module_times.get(options.scene)])
+
+def init_worker(texture_cache_mb):
+    textures.tile_cache.resize(texture_cache_mb << 20)
+
+def loaded_scene(options):
+    # the frozen scene of a job, shared by the jobs with the same SceneOptions
+    return _cached(_key(options, SceneOptions), partial(load_scene, options))
+
+def prepared_scene(options):
+    # the scene and primary visibility of a job, built from the loaded scene.
+    # Shadow maps and mirror views are attached to the scene, so those jobs
+    # get a copy of it
+    def prepare():
+        scene = loaded_scene(options)
+        if options.shadow_map or options.mirror_views:
+            scene = copy.deepcopy(scene)
+        return scene, raster.prepare_scene(options, scene)
+
+    return _cached(_key(options, PreparedOptions), prepare)
+
+def describe(options):
+    # image size of a job; loads the scene in one worker on the way
+    scene = loaded_scene(argparse.Namespace(**options))
+    return scene.camera.img_width, scene.camera.img_height
+
+def render_tile(options, tile):
+    options = argparse.Namespace(**options)
+    scene, vis = prepared_scene(options)
+    return raster.render_tile(raster.make_context(options, scene, vis, options.seed), tile)
+
+class Job:
+    def __init__(self, job_id, options, priority, stream, output, writer):
+        self.id = job_id
+        self.options = options
+        self.priority = priority
+        self.stream = stream
+        self.output = output
+        self.writer = writer
+        self.cancelled = False
+        self.film = None
+        self.done = 0
+        self.total = 0
+        self.start = time.time()
+
+    def send(self, event, **fields):
+        if not self.writer.is_closing():
+            self.writer.write(service.encode(dict(fields, id=self.id, event=event)))
+
+class RenderService:
+    def __init__(self, jobs, texture_cache_mb=64):
+        # started before the event loop, so the workers fork from a plain process
+        self.executor = ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(texture_cache_mb,))
+        for _ in range(jobs):
+            self.executor.submit(int)
+        self.capacity = jobs * 2
+        # (priority, job sequence, tile index, job, tile), lowest first
+        self.queue = []
+        self.sequence = 0
+
+    async def serve(self, address):
+        self.slots = asyncio.Semaphore(self.capacity)
+        self.ready = asyncio.Event()
+        host, _, port = address.rpartition(':')
+        server = await asyncio.start_server(self.connection, host or 'localhost', int(port))
+        print(f"Render daemon listening on {address}")
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.dispatch())
+
+    async def dispatch(self):
+        # keeps the pool busy with the most urgent tiles
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire()
+            while True:
+                while not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                *_, job, tile = heapq.heappop(self.queue)
+                if not job.cancelled:
+                    break
+            future = loop.run_in_executor(self.executor, render_tile, job.options, tile)
+            future.add_done_callback(partial(self.finished, job))
+
+    def fail(self, job, error):
+        # drops the rest of the job; the client is told instead of waiting
+        job.cancelled = True
+        job.send('error', message=repr(error))
+
+    def finished(self, job, future):
+        self.slots.release()
+        if job.cancelled:
+            return
+        try:
+            tile, block, _, _ = future.result()
+            job.film.add(*block)
+            job.done += 1
+            fields = dict(tile=list(tile), done=job.done, total=job.total)
+            if job.stream:
+                i0, i1, j0, j1 = tile
+                fields['data'] = service.encode_pixels(job.film.image(i0, i1, j0, j1))
+            job.send('progress', **fields)
+        except Exception as e:
+            self.fail(job, e)
+            return
+        if job.done == job.total:
+            asyncio.ensure_future(self.complete(job))
+
+    async def complete(self, job):
+        try:
+            if job.output:
+                width, height = job.film.width, job.film.height
+                rows = imageio.image_rows(job.film.image())
+                await asyncio.get_running_loop().run_in_executor(None, imageio.write_image, job.output, rows, width, height)
+        except Exception as e:
+            self.fail(job, e)
+            return
+        job.send('done', seconds=time.time() - job.start, output=job.output)
+
+    async def start(self, request, writer):
+        options = dict(JobDefaults)
+        options.update({name: request[name] for name in JobDefaults if name in request})
+        if options['scene'] is None and options['spec'] is None:
+            raise ValueError("A job needs a scene module or a spec")
+        if options['light_buffers']:
+            raise ValueError("Light buffers are rendered by raster.py and the editor, not the daemon")
+        # the film of a job only keeps the colors
+        unsupported = [name for name in ('squares', 'aux', 'denoise') if options[name]]
+        if unsupported:
+            raise ValueError(f"The daemon does not render with {', '.join(unsupported)}, use raster.py")
+        if options['seed'] is None:
+            options['seed'] = random.getrandbits(31)
+        priority = request.get('priority', 'final')
+        priority = service.Priorities[priority] if isinstance(priority, str) else int(priority)
+        job = Job(request.get('id'), options, priority, request.get('stream', False), request.get('output'), writer)
+        width, height = await asyncio.get_running_loop().run_in_executor(self.executor, describe, options)
+        tiles = raster.tiles(width, height)
+        job.film = film.Film(width, height)
+        job.total = len(tiles)
+        job.send('started', width=width, height=height, tiles=job.total)
+        self.sequence += 1
+        for k, tile in enumerate(tiles):
+            heapq.heappush(self.queue, (job.priority, self.sequence, k, job, tile))
+        self.ready.set()
+        return job
+
+    async def connection(self, reader, writer):
+        jobs = dict()
+        try:
+            async for line in reader:
+                request = json.loads(line)
+                if request.get('type') == 'cancel':
+                    job = jobs.pop(request.get('id'), None)
+                    if job is not None and not job.cancelled:
+                        job.cancelled = True
+                        job.send('cancelled')
+                    continue
+                try:
+                    job = await self.start(request, writer)
+                    jobs[job.id] = job
+                except Exception as e:
+                    writer.write(service.encode(dict(id=request.get('id'), event='error', message=repr(e))))
+        except (ConnectionError, json.JSONDecodeError):
+            pass
+        finally:
+            # the jobs of a client that went away are dropped
+            for job in jobs.values():
+                job.cancelled = True
+            writer.close()
+
+def render(args):
+    # client: renders a scene module through a running daemon
+    client = service.RenderClient(args.connect)
+    request = dict(scene=args.scene, num_samples=args.num_samples, priority=args.priority,
+                   output=os.path.abspath(args.output))
+    if args.width:
+        request['width'] = args.width
+    if args.height:
+        request['height'] = args.height
+    event = client.render(request)
+    client.close()
+    if event['event'] != 'done':
+        sys.exit(f"Render {event['event']}: {event.get('message', '')}")
+    print(f"Rendered {args.output} in {event['seconds']:.2f}s")
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['render']:
+        parser = argparse.ArgumentParser(prog='daemon.py render', description="Render a scene through a running render daemon")
+        parser.add_argument('-s', '--scene', type=str, help='Scene name', required=True)
+        parser.add_argument('-n', '--num_samples', type=int, help='Number of samples per pixel for anti-aliasing', default=1)
+        parser.add_argument('--width', type=int, help='Image width (default: the scene camera)', default=None)
+        parser.add_argument('--height', type=int, help='Image height (default: from the width and the camera aspect ratio)', default=None)
+        parser.add_argument('--priority', type=str, choices=list(service.Priorities), help='Previews are rendered before final jobs', default='final')
+        parser.add_argument('-c', '--connect', type=str, help='Address of the daemon, host:port', default=service.DefaultAddress)
+        parser.add_argument('-o', '--output', type=str, help='Output image file name', default='output.png')
+        render(parser.parse_args(sys.argv[2:]))
+        sys.exit()
+    parser = argparse.ArgumentParser(description="Render daemon with a warm worker pool")
+    parser.add_argument('-l', '--listen', type=str, help='Address to listen on, host:port', default=service.DefaultAddress)
+    parser.add_argument('-j', '--num_jobs', type=int, help='Number of worker processes', default=os.cpu_count())
+    parser.add_argument('--texture_cache_mb', type=int, help='Memory budget of the texture tile cache of each worker, in MB', default=64)
+    args = parser.parse_args()
+    asyncio.run(RenderService(args.num_jobs, args.texture_cache_mb).serve(args.listen))
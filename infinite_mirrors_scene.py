@@ -66,7 +66,8 @@ class Scene(BaseScene):
             normal=Vector3D(0, 0, 1),
             forward_direction=Vector3D(0, 1, 0),
         )
-        self.add(floor, checker)
+        # o chão nunca faz sombra sobre os objetos acima dele
+        self.add(floor, checker, casts_shadows=False)
 
         # Dois espelhos frente a frente
         mirror_y = 3.0
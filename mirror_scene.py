@@ -51,6 +51,7 @@ class Scene(BaseScene):
             0.6,
             white_color=Color(0.95, 0.95, 0.95),
             black_color=Color(0.08, 0.08, 0.09),
+            filtered=True,
         )
         mirror = ReflectiveMaterial(
             0.0,
@@ -68,7 +69,8 @@ class Scene(BaseScene):
             normal=Vector3D(0, 0, 1),
             forward_direction=Vector3D(0, 1, 0),
         )
-        self.add(floor, checker)
+        # o chão nunca faz sombra sobre os objetos acima dele
+        self.add(floor, checker, casts_shadows=False)
 
         # dois espelhos frente a frente (planos infinitos)
         mirror_x = 2.0
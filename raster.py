@@ -1,4 +1,8 @@
+import os
+import math
+import sys
 import random
+import socket
 import argparse
 import importlib
 from itertools import product
@@ -7,78 +11,394 @@ from multiprocessing import Pool
 
 import numpy as np
 from tqdm import tqdm
-import matplotlib.pyplot as plt
 
 from src.base import Color
+from src import wavefront, textures, film, denoise, rasterizer, shadowmap, mirrors, checkpoint, imageio, partials, distributed, lightbuffers
 
 class Context:
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
 
-def render_pixel(context, ij):
+def render_sample(context, x, y):
+    # color seen through the film position (x, y), and the first hit
+    # ray from camera
+    ray = context.camera.ray(x, y).scale_differentials(1 / math.sqrt(context.num_samples))
+    # hit ray with scene
+    if context.vis is not None:
+        hit_rec = rasterizer.primary_hit(context.scene, context.vis, ray, x, y)
+    else:
+        hit_rec = context.scene.hit(ray)
+    # test if hit something
+    if hit_rec.hit:
+        return hit_rec.material.shade(hit_rec, context.scene), hit_rec
+    return context.scene.background, hit_rec
+
+def jittered_samples(context, ij):
+    # film positions, colors and first hits of the samples of pixel (i, j)
     i, j = ij
-    pixel = Color(0, 0, 0)
     for _ in range(context.num_samples):
-        # random offset for anti-aliasing
+        # random offset for anti-aliasing, around the middle of the pixel
         dx = np.random.uniform(-0.5, 0.5)
         dy = np.random.uniform(-0.5, 0.5)
-        # middle of pixel coordinates
         x = j + 0.5 + dx
         y = i + 0.5 + dy
-        # ray from camera
-        ray = context.camera.ray(x, y)
-        # hit ray with scene
-        hit_rec = context.scene.hit(ray)
-        # test if hit something
-        if hit_rec.hit:
-            # Simple shading: use the red channel as intensity
-            material = hit_rec.material
-            shaded_color = material.shade(hit_rec, context.scene)
-            # this is box filtering!
-            pixel = pixel + shaded_color / context.num_samples
-        else:
-            # this is box filtering!
-            pixel = pixel + context.scene.background / context.num_samples
+        yield (x, y) + render_sample(context, x, y)
+
+def render_pixel(context, ij):
+    i, j = ij
+    pixel = Color(0, 0, 0)
+    for _, _, color, _ in jittered_samples(context, ij):
+        # this is box filtering!
+        pixel = pixel + color / context.num_samples
     return (i, j, pixel)
 
-def main(args, pool):
+# image is rendered in square tiles, so each worker keeps coherent pixels together
+TileSize = 16
+
+def tiles(img_width, img_height, size=TileSize):
+    # (i0, i1, j0, j1) blocks covering the image, row by row
+    return [(i0, min(i0 + size, img_height), j0, min(j0 + size, img_width))
+            for i0 in range(0, img_height, size)
+            for j0 in range(0, img_width, size)]
+
+def render_tile(context, tile):
+    # samples of the tile splatted through the reconstruction filter: returns
+    # weighted sums and weights that may reach past the tile (see film.splat).
+    # With context.aux, also the first hit buffers of the tile (box filtered)
+    # and the object id of each pixel. With context.mask (of the image) only
+    # the pixels set in it are rendered, and context.dependencies (see
+    # dependencies.py, wavefront engine) records what their pixels depend on.
+    # context.gbuffer (see gbuffer.py, wavefront engine) keeps the first hits
+    # of the samples; with context.deferred, a GBuffer of the same camera and
+    # geometry, the samples are shaded from its first hits instead. With
+    # context.light_parts the colors are the per light buffers of lightbuffers.py
+    i0, i1, j0, j1 = tile
+    partials.seed_tile(context.seed, tile)
+    cache = context.scene.shadow_cache
+    cache.begin_tile(tile)
+    lookups, hits = cache.counters()
+    first_hits = None
+    mask = context.mask[i0:i1, j0:j1] if context.mask is not None else None
+    if context.deferred is not None:
+        positions, colors = context.deferred.shade(context.scene, context.camera, tile, context.light_parts)
+    elif context.engine == 'wavefront':
+        record = None
+        if context.dependencies is not None:
+            count = (i1 - i0) * (j1 - j0) if mask is None else int(mask.sum())
+            record = context.dependencies.record(count * context.num_samples)
+        result = wavefront.render_tile(context.scene, context.camera, tile, context.num_samples,
+                                       context.aux, context.vis, mask, record, context.gbuffer,
+                                       context.light_parts)
+        positions, colors = result[:2]
+        if context.aux:
+            first_hits = result[2]
+        if record is not None:
+            context.dependencies.add(record, positions)
+    else:
+        if mask is not None or context.dependencies is not None or context.gbuffer is not None or context.light_parts:
+            raise ValueError("Pixel masks, dependency records, G-buffers and light buffers need the wavefront engine")
+        samples = [(x, y, color.as_list(), hit_rec)
+                   for ij in product(range(i0, i1), range(j0, j1))
+                   for x, y, color, hit_rec in jittered_samples(context, ij)]
+        positions = np.array([sample[:2] for sample in samples])
+        colors = np.array([sample[2] for sample in samples])
+        if context.aux:
+            first_hits = denoise.first_hit_aux(context.scene, [sample[3] for sample in samples])
+    # light parts are splatted as channels of their own
+    colors = colors.reshape(len(colors), -1)
+    if context.squares:
+        # the squares are splatted along, as three more channels
+        colors = np.hstack([colors, colors * colors])
+    block = film.splat(context.filter, tile, positions, colors)
+
+    aux = None
+    if first_hits is not None:
+        values, ids = first_hits
+        id_block = np.full((i1 - i0, j1 - j0), -1)
+        # the last sample of each pixel decides its id
+        id_block[np.floor(positions[:, 1]).astype(int) - i0, np.floor(positions[:, 0]).astype(int) - j0] = ids
+        aux = (film.splat(film.BoxFilter(), tile, positions, values), id_block)
+    # shadow cache counters of this tile
+    stats = (cache.lookups - lookups, cache.hits - hits)
+    return tile, block, aux, stats
+
+# each worker receives the context once, when the pool starts, and keeps it
+# (with its shadow cache) for every tile it renders
+_worker_context = None
+
+def init_worker(context):
+    global _worker_context
+    _worker_context = context
+    textures.tile_cache.resize(context.texture_cache_mb << 20)
+
+def render_tile_worker(tile):
+    return render_tile(_worker_context, tile)
+
+def load_scene(args):
     # load scene from file args.scene
-    scene = importlib.import_module(args.scene).Scene()
+    module = importlib.import_module(args.scene)
+    scene = module.Scene()
+    scene.light_samples = args.light_samples
+    scene.min_throughput = args.min_throughput
+    scene.roulette = args.roulette
+    if args.light_buffers:
+        lightbuffers.unit_lights(scene)
+    scene.freeze()
+    return module, scene
+
+def prepare_scene(args, scene):
+    # structures built once, where the tiles are rendered, before the scene
+    # is sent to the pool: returns the primary visibility (or None)
+    camera = scene.camera
+    vis = None
+    if args.primary == 'raster':
+        # primary visibility from the z-buffer, shared by all workers
+        vis = rasterizer.rasterize(scene, camera)
+        print(f"Rasterized primary visibility: {100 * vis.ambiguous.mean():.1f}% of the pixels are traced")
+
+    if args.shadow_map:
+        count = shadowmap.build_shadow_maps(scene, args.shadow_map)
+        print(f"Shadow maps: {count} point lights, {args.shadow_map}x{args.shadow_map} texels per cube face")
+
+    if args.mirror_views:
+        # reflections off planar mirrors, up to args.mirror_views bounces
+        scene.mirror_views = mirrors.MirrorViews(scene, camera, args.mirror_views)
+        print(f"Mirror views: {len(scene.mirror_views.views)} mirrored cameras, "
+              f"{100 * scene.mirror_views.ambiguous():.1f}% of their pixels are traced")
+    return vis
+
+def render_settings(args, seed):
+    # what the samples depend on (see checkpoint.py and partials.py)
+    settings = dict(scene=args.scene, num_samples=args.num_samples, engine=args.engine, filter=args.filter,
+                    filter_radius=args.filter_radius, light_samples=args.light_samples,
+                    min_throughput=args.min_throughput, roulette=args.roulette, seed=seed)
+    if args.light_buffers:
+        settings['light_buffers'] = True
+    return settings
+
+def make_context(args, scene, vis, seed):
+    return Context(scene=scene, camera=scene.camera, num_samples=args.num_samples, engine=args.engine,
+                   texture_cache_mb=args.texture_cache_mb, filter=film.make_filter(args.filter, args.filter_radius),
+                   aux=args.aux or args.denoise, vis=vis, seed=seed, squares=args.squares, mask=None,
+                   dependencies=None, gbuffer=None, deferred=None, light_parts=args.light_buffers)
+
+def main(args):
+    module, scene = load_scene(args)
     camera = scene.camera
     img_width = camera.img_width
     img_height = camera.img_height
-    image = np.zeros((img_height, img_width, 3)) # create tensor for image: RGB
+    use_aux = args.aux or args.denoise
+    if args.light_buffers and (args.squares or args.partial or args.engine != 'wavefront'):
+        raise ValueError("--light_buffers needs the wavefront engine, without --squares or --partial")
+    reconstruction = film.make_filter(args.filter, args.filter_radius)
+    # the coordinator leaves the rendering, and its structures, to the workers
+    vis = prepare_scene(args, scene) if not args.serve else None
+
+    # every run draws its own samples unless given a seed; a resumed run
+    # keeps the seed of its checkpoint
+    directory = os.path.splitext(args.output)[0] + '.checkpoint'
+    seed = args.seed
+    saved = checkpoint.saved_settings(directory) if args.resume else None
+    if seed is None:
+        seed = saved['seed'] if saved and 'seed' in saved else random.getrandbits(31)
+
+    # the tiles are accumulated on disk next to the output as they finish
+    settings = render_settings(args, seed)
+    channels = 6 if args.squares else 3
+    if args.light_buffers:
+        channels = lightbuffers.channels(scene)
+    state = checkpoint.Checkpoint(directory, img_width, img_height, TileSize, reconstruction.margin,
+                                  use_aux, settings, args.resume, channels)
+    todo = [tile for tile in tiles(img_width, img_height) if not state.done(tile)]
+    done_pixels = img_height * img_width - sum((i1 - i0) * (j1 - j0) for i0, i1, j0, j1 in todo)
+    if done_pixels:
+        print(f"Resuming: {state.finished()} tiles already rendered")
 
-    # for each pixel, determine if it is inside any primitive in the scene
-    # use cartesian product for efficiency
     print("Rendering... with anti-aliasing samples:", args.num_samples)
-    context = Context(scene=scene, camera=camera, num_samples=args.num_samples)
-    with tqdm(total=img_height*img_width) as pbar:
-        if args.num_jobs <= 1:
-            for i, j in product(range(img_height), range(img_width)):
-                _, _, pixel = render_pixel(context, (i, j))
-                image[i, j] = np.clip(pixel.as_list(), 0, 1)
-                pbar.update(1)
-                pbar.refresh()
+    context = make_context(args, scene, vis, seed)
+    textures.tile_cache.resize(args.texture_cache_mb << 20)
+    shadow_rays, cache_hits = 0, 0
+    scene_hash = partials.scene_hash(module, img_width, img_height, settings)
+    coordinator = None
+    with tqdm(total=img_height*img_width, initial=done_pixels) as pbar:
+        if args.serve:
+            # the workers build the context from the options
+            coordinator = distributed.Coordinator(args.serve, dict(vars(args), seed=seed), todo, scene_hash,
+                                                  args.tile_timeout)
+            tqdm.write(f"Serving {len(todo)} tiles on {coordinator.address[0]}:{coordinator.address[1]}")
+            results = coordinator.results()
+            pool = None
+        elif args.num_jobs <= 1:
+            results = map(partial(render_tile, context), todo)
+            pool = None
         else:
-            for i, j, pixel in pool.imap(partial(render_pixel, context), product(range(img_height), range(img_width))):
-                image[i, j] = np.clip(pixel.as_list(), 0, 1)
-                pbar.update(1)
-                pbar.refresh()
+            pool = Pool(args.num_jobs, initializer=init_worker, initargs=(context,))
+            results = pool.imap_unordered(render_tile_worker, todo)
+        for tile, block, aux, (lookups, hits) in results:
+            state.store(tile, block, aux)
+            shadow_rays += lookups
+            cache_hits += hits
+            i0, i1, j0, j1 = tile
+            pbar.update((i1 - i0) * (j1 - j0))
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if coordinator is not None:
+        for line in coordinator.report():
+            print(f"Worker {line}")
+    if shadow_rays:
+        print(f"Shadow cache: {cache_hits}/{shadow_rays} shadow rays resolved by the cached occluder ({100 * cache_hits / shadow_rays:.1f}%)")
+
+    if args.partial:
+        # the unresolved film, to be merged with other runs (raster.py merge)
+        sums, weights = state.color.accumulated(0, img_height)
+        header = dict(scene=args.scene, scene_hash=scene_hash,
+                      width=img_width, height=img_height, seeds=[seed], num_samples=args.num_samples,
+                      settings=settings)
+        squares = sums[:, :, 3:] if args.squares else None
+        partials.save_partial(args.partial, header, sums[:, :, :3], weights, squares)
+        print(f"Partial render (seed {seed}) written to {args.partial}")
+
+    if args.light_buffers:
+        path = os.path.splitext(args.output)[0] + '_lights.npz'
+        lightbuffers.save(path, state.color.image(), scene.light_levels)
+        print(f"Light buffers written to {path}")
+
+    # the film is written band by band, unless the denoiser needs all of it
+    def rows(i0, i1):
+        if args.light_buffers:
+            return lightbuffers.compose(state.color.rows(i0, i1), scene.light_levels)
+        return state.color.rows(i0, i1)[:, :, :3]
+    if use_aux:
+        buffers = state.aux.image()
+        ids = np.array(state.ids)
+        albedo, normals, depth = buffers[:, :, 0:3], buffers[:, :, 3:6], buffers[:, :, 6]
+        if args.aux:
+            # raw buffers, and previews of albedo and normals
+            stem = os.path.splitext(args.output)[0]
+            np.savez(stem + '_aux.npz', albedo=albedo, normal=normals, depth=depth, object_id=ids)
+            imageio.write_png(stem + '_albedo.png', imageio.image_rows(albedo), img_width, img_height)
+            imageio.write_png(stem + '_normal.png', imageio.image_rows(normals * 0.5 + 0.5), img_width, img_height)
+        if args.denoise:
+            print("Denoising...")
+            rows = imageio.image_rows(denoise.denoise_image(rows(0, img_height), albedo, normals, depth, ids))
 
-    # save image as png using matplotlib
-    plt.imsave(args.output, image, vmin=0, vmax=1, origin='lower')
+    write_output(args, rows, img_width, img_height)
+    state.remove()
+
+def write_output(args, rows, width, height):
+    imageio.write_image(args.output, rows, width, height, args.writer, bit_depth=args.bit_depth,
+                        exposure=args.exposure, tonemap=args.tonemap, gamma=args.gamma, dither=args.dither)
+
+def merge(args):
+    # combines the partial renders of several runs into one image
+    header, sums, weights, squares = partials.merge_partials(args.partials)
+    width, height = header['width'], header['height']
+    print(f"Merged {len(args.partials)} partial renders of {header['scene']}: "
+          f"{header['num_samples']} samples per pixel, seeds {header['seeds']}")
+    if args.variance and squares is None:
+        raise ValueError("The variance needs partial renders made with --squares")
+    if args.variance:
+        imageio.write_image(args.variance, imageio.image_rows(partials.variance(sums, squares, weights)),
+                            width, height, 'pfm')
+    write_output(args, imageio.image_rows(partials.resolve(sums, weights)), width, height)
+    # the merged partial last, so a failed run leaves none behind
+    if args.partial:
+        partials.save_partial(args.partial, header, sums, weights, squares)
+
+def worker(args):
+    # renders the tiles a coordinator (raster.py --serve) hands out, until it stops
+    connection = distributed.connect(args.connect, args.wait)
+    _, options = connection.receive()
+    options = argparse.Namespace(**options)
+    module, scene = load_scene(options)
+    vis = prepare_scene(options, scene)
+    context = make_context(options, scene, vis, options.seed)
+    scene_hash = partials.scene_hash(module, scene.camera.img_width, scene.camera.img_height,
+                                     render_settings(options, options.seed))
+    jobs = max(args.num_jobs, 1)
+    connection.send(('ready', args.name or socket.gethostname(), jobs, scene_hash))
+    textures.tile_cache.resize(options.texture_cache_mb << 20)
+    pool = Pool(jobs, initializer=init_worker, initargs=(context,)) if jobs > 1 else None
+
+    def failed(error):
+        # the coordinator hands the tiles in flight to the other workers
+        print(f"Tile failed: {error!r}")
+        connection.shutdown()
+
+    tiles_done = 0
+    try:
+        while True:
+            message = connection.receive()
+            if message[0] == 'stop':
+                if message[1]:
+                    print(message[1])
+                break
+            if pool is None:
+                connection.send(('done',) + render_tile(context, message[1]))
+            else:
+                pool.apply_async(render_tile_worker, (message[1],),
+                                 callback=lambda result: connection.send(('done',) + result),
+                                 error_callback=failed)
+            tiles_done += 1
+    finally:
+        if pool is not None:
+            pool.terminate()
+        connection.close()
+    print(f"Rendered {tiles_done} tiles")
+
+def add_output_arguments(parser):
+    parser.add_argument('-w', '--writer', type=str, choices=list(imageio.Writers), help='Image writer (default: from the output extension, .png .ppm .pfm or .raw)', default=None)
+    parser.add_argument('--bit_depth', type=int, choices=[8, 16], help='Bits per sample of PNG and PPM outputs', default=8)
+    parser.add_argument('--exposure', type=float, help='Scale of the linear values before tone mapping', default=1.0)
+    parser.add_argument('--tonemap', type=str, choices=list(imageio.ToneMaps), help='Tone mapping of 8/16 bit outputs: clip to [0, 1] or Reinhard x/(1+x)', default='clip')
+    parser.add_argument('--gamma', type=float, help='Gamma applied to 8/16 bit outputs (1 = linear values, as before)', default=1.0)
+    parser.add_argument('--dither', action='store_true', help='Dither 8/16 bit outputs before quantizing')
+    parser.add_argument('-o', '--output', type=str, help='Output image file name', default='output.png')
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ['merge']:
+        # raster.py merge a.npz b.npz ... -o image.png
+        parser = argparse.ArgumentParser(prog='raster.py merge', description="Combine partial renders (--partial) of the same scene")
+        parser.add_argument('partials', nargs='+', help='Partial render files')
+        parser.add_argument('--partial', type=str, help='Also write the merged partial render, to merge it again later', default=None)
+        parser.add_argument('--variance', type=str, help='Also write the per-pixel variance of the samples as a PFM image (needs --squares partials)', default=None)
+        add_output_arguments(parser)
+        merge(parser.parse_args(sys.argv[2:]))
+        sys.exit()
+    if sys.argv[1:2] == ['worker']:
+        # raster.py worker --connect host:port, on every machine of the farm
+        parser = argparse.ArgumentParser(prog='raster.py worker', description="Render the tiles of a coordinator (raster.py --serve)")
+        parser.add_argument('-c', '--connect', type=str, help='Address of the coordinator, host:port', required=True)
+        parser.add_argument('-j', '--num_jobs', type=int, help='Number of parallel jobs for rendering', default=os.cpu_count())
+        parser.add_argument('--name', type=str, help='Name of the worker in the coordinator report (default: host name)', default=None)
+        parser.add_argument('--wait', type=float, help='Seconds to keep trying to connect, for workers started before the coordinator', default=10.0)
+        worker(parser.parse_args(sys.argv[2:]))
+        sys.exit()
     parser = argparse.ArgumentParser(description="Raster module main function")
     parser.add_argument('-s', '--scene', type=str, help='Scene name', default='ball_scene')
     parser.add_argument('-n', '--num_samples', type=int, help='Number of samples per pixel for anti-aliasing', default=1)
     parser.add_argument('-j', '--num_jobs', type=int, help='Number of parallel jobs for rendering', default=4)
-    parser.add_argument('-o', '--output', type=str, help='Output image file name', default='output.png')
+    parser.add_argument('-l', '--light_samples', type=int, help='Number of lights sampled per shading point (0 = all lights)', default=0)
+    parser.add_argument('-e', '--engine', type=str, choices=['wavefront', 'recursive'], help='Wavefront (bounce by bounce) or recursive shading', default='wavefront')
+    parser.add_argument('-p', '--primary', type=str, choices=['trace', 'raster'], help='Find the first hits by tracing the camera rays or from a z-buffer rasterization', default='trace')
+    parser.add_argument('--shadow_map', type=int, help='Resolution of the cube shadow maps of the point lights (0 = trace every shadow ray)', default=0)
+    parser.add_argument('--mirror_views', type=int, help='Bounces off planar mirrors looked up in rasterized mirrored views (0 = trace them)', default=0)
+    parser.add_argument('-t', '--min_throughput', type=float, help='Secondary rays with a lower accumulated weight are terminated (0 = trace to max_depth)', default=0.0)
+    parser.add_argument('--roulette', action='store_true', help='Use Russian roulette below --min_throughput instead of a hard cutoff')
+    parser.add_argument('-f', '--filter', type=str, choices=list(film.Filters), help='Reconstruction filter the samples are splatted with', default='box')
+    parser.add_argument('--filter_radius', type=float, help='Filter radius in pixels (default depends on the filter)', default=None)
+    parser.add_argument('--aux', action='store_true', help='Also write the first hit albedo, normal, depth and object id buffers (<output>_aux.npz and previews)')
+    parser.add_argument('--denoise', action='store_true', help='Denoise the image with an a-trous filter guided by the first hit buffers')
+    parser.add_argument('--texture_cache_mb', type=int, help='Memory budget of the texture tile cache of each worker, in MB', default=64)
+    parser.add_argument('--serve', type=str, help='Coordinate workers (raster.py worker --connect) over TCP on host:port instead of rendering here', default=None)
+    parser.add_argument('--tile_timeout', type=float, help='Seconds a worker may go without returning a tile before its tiles are handed to the others (grows with the time per tile seen from the worker)', default=distributed.TileTimeout)
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted render from its checkpoint (<output>.checkpoint), skipping the finished tiles')
+    parser.add_argument('--seed', type=int, help='Seed of the random samples (default: a new one every run, see --partial)', default=None)
+    parser.add_argument('--partial', type=str, help='Also write the unresolved film as a partial render (.npz) that raster.py merge can combine with other runs', default=None)
+    parser.add_argument('--light_buffers', action='store_true', help='Also write the part of the image each light adds, at white and intensity 1 (<output>_lights.npz), to relight it without rendering')
+    parser.add_argument('--squares', action='store_true', help='Keep the sums of the squared samples in the partial render, for variance estimates')
+    add_output_arguments(parser)
     args = parser.parse_args()
-
-    # create a pool of workers for parallel processing
-    pool = Pool(args.num_jobs)
-    main(args, pool)
-    pool.close()
-    pool.join()
\ No newline at end of file
+    main(args)
@@ -40,7 +40,7 @@ class Scene(BaseScene):
 
         _mat_ground = CheckerboardMaterial(1, 0.9, 1)
         _shape_ground = PlaneUV(point=Vector3D(0, 0, 0), normal=Vector3D(0, 0, 1), forward_direction=Vector3D(1, 0, 0))
-        self.add(_shape_ground, _mat_ground)
+        self.add(_shape_ground, _mat_ground, casts_shadows=False)
 
         _mat_ball1 = SimpleMaterialWithShadows(0.12, 0.9, Color(0.2, 0.85, 0.2), 0.15, Color(1,1,1), 32)
         _shape_ball1 = Ball(center=Vector3D(0,0,0), radius=0.8)
@@ -70,6 +70,7 @@ class BaseFocalScene(BaseScene):
             diffuse_coefficient=0.8,
             square_size=2.0,
             white_color=Color(0.9, 0.9, 0.9),
-            black_color=Color(0.4, 0.4, 0.4)
+            black_color=Color(0.4, 0.4, 0.4),
+            filtered=True
         )
         self.add(PlaneUV(point=Vector3D(0, 0, 0), normal=Vector3D(0, 0, 1), forward_direction=Vector3D(1, 0, 0)), gray_material)
@@ -1,8 +1,16 @@
+import random
+
+import numpy as np
+
 from .ray import Ray
 from .camera import Camera
 from .vector3d import Vector3D
+from .light_tree import LightTree
+from .shadow_cache import ShadowCache
 
 CastEpsilon = 1e-4
+# shadow rays traced before deciding whether a point lies in a penumbra
+ShadowProbeSamples = 4
 
 class Shape:
     def __init__(self, type):
@@ -39,10 +47,29 @@ class BaseScene:
         self.name = name
         self.shapes = list()
         self.materials = list()
+        # subsets of the scene each kind of ray is tested against (see add)
+        self.camera_visible = list()
+        self.reflection_visible = list()
+        self.shadow_casters = list()
         # default background color and camera
         self.background = Color(0, 0, 0)
         # ambient light
         self.ambient_light = Color(0.1, 0.1, 0.1)
+        self.lights = list()
+        # number of lights sampled per shading point (0 = use every light)
+        self.light_samples = 0
+        self._light_tree = None
+        # secondary rays whose throughput falls below min_throughput are
+        # dropped, or with roulette, kept with probability throughput / min_throughput
+        self.min_throughput = 0.0
+        self.roulette = False
+        # per-worker: each process gets its own copy of the scene
+        self.shadow_cache = ShadowCache()
+        # optional mirrors.MirrorViews for the rays reflected by planar mirrors
+        self.mirror_views = None
+        # without shadows every light is fully visible (interactive previews)
+        self.shadows = True
+        self.frozen = False
 
         self.camera = Camera(
             eye=Vector3D(0, 0, 5),
@@ -56,25 +83,280 @@ class BaseScene:
     def display(self):
         print(f"Scene: {self.name}")
 
-    def add(self, primitive, material):
+    def add(self, primitive, material, casts_shadows=True, visible_to_camera=True, visible_in_reflections=True):
+        # the flags take the object out of shadow rays, camera rays or
+        # reflection/refraction rays respectively
+        if self.frozen:
+            raise RuntimeError("Cannot add objects to a frozen scene")
         self.shapes.append(primitive)
         self.materials.append(material)
+        if visible_to_camera:
+            self.camera_visible.append((primitive, material))
+        if visible_in_reflections:
+            self.reflection_visible.append((primitive, material))
+        if casts_shadows:
+            self.shadow_casters.append(primitive)
+
+    def freeze(self):
+        # validates the scene and compiles it for rendering: containers become
+        # tuples, materials precompute their per-light terms and the light tree
+        # is built. Called once before the scene is sent to the workers. The
+        # compiled terms are immutable arrays, but the lights, materials and
+        # ambient light they come from are not: a frozen scene edited in place
+        # must be compiled again with recompile()
+        if self.frozen:
+            return self
+        if not hasattr(self, 'max_depth'):
+            raise ValueError(f"Scene '{self.name}' does not set max_depth")
+        if self.camera.img_width <= 0 or self.camera.img_height <= 0:
+            raise ValueError(f"Scene '{self.name}' has an empty image")
+        for shape in self.shapes:
+            if not callable(getattr(shape, 'hit', None)):
+                raise ValueError(f"Shape {shape!r} has no hit method")
+        for light in self.lights:
+            for attr in ('position', 'color', 'intensity'):
+                if not hasattr(light, attr):
+                    raise ValueError(f"Light {light!r} has no {attr}")
+
+        self.shapes = tuple(self.shapes)
+        self.materials = tuple(self.materials)
+        self.lights = tuple(self.lights)
+        self.camera_visible = tuple(self.camera_visible)
+        self.reflection_visible = tuple(self.reflection_visible)
+        self.shadow_casters = tuple(self.shadow_casters)
+        self._compile()
+        self.frozen = True
+        return self
+
+    def _compile(self):
+        # shared materials are compiled once
+        for material in {id(m): m for m in self.materials}.values():
+            freeze = getattr(material, 'freeze', None)
+            if freeze is not None:
+                freeze(self)
+        self._light_tree = LightTree(self.lights)
+
+    def recompile(self):
+        # compiles a frozen scene again after its lights, materials or ambient
+        # light were changed in place
+        if self.frozen:
+            self._compile()
+        return self
+
+    def light_tree(self):
+        # built lazily: scenes fill self.lights after BaseScene.__init__
+        if self._light_tree is None:
+            self._light_tree = LightTree(self.lights)
+        return self._light_tree
+
+    def lights_for(self, point):
+        # (l, light, weight) triples to shade a point with, l the index of the
+        # light. When sampling, each contribution is divided by its selection
+        # probability, so the sum over the picked lights is an unbiased
+        # estimate of the sum over all lights
+        if not self.light_samples or len(self.lights) <= self.light_samples:
+            return [(l, light, 1.0) for l, light in enumerate(self.lights)]
+        tree = self.light_tree()
+        picks = []
+        for _ in range(self.light_samples):
+            l, pdf = tree.sample(point, random.random())
+            picks.append((l, self.lights[l], 1.0 / (pdf * self.light_samples)))
+        return picks
+
+    def light_picks(self, points):
+        # the batched form of lights_for, for an (N, 3) array of points:
+        # (l, light, rows, weights) for each light picked at some point, with
+        # the points that picked it and its weight at each of them (a light
+        # picked twice at a point gets the sum of the two weights)
+        count = len(points)
+        if not self.light_samples or len(self.lights) <= self.light_samples:
+            return [(l, light, np.arange(count), np.ones(count)) for l, light in enumerate(self.lights)]
+        if not count:
+            return []
+        tree = self.light_tree()
+        indices, pdfs = zip(*(tree.sample_batch(points, np.random.random(count))
+                              for _ in range(self.light_samples)))
+        keys, inverse = np.unique(np.concatenate(indices) * count + np.tile(np.arange(count), self.light_samples),
+                                  return_inverse=True)
+        weights = np.bincount(inverse.ravel(), 1.0 / (np.concatenate(pdfs) * self.light_samples))
+        lights, rows = np.divmod(keys, count)
+        # keys are sorted by light, so each light's picks are contiguous
+        starts = np.flatnonzero(np.r_[True, lights[1:] != lights[:-1]])
+        ends = np.r_[starts[1:], len(keys)]
+        return [(int(lights[s]), self.lights[lights[s]], rows[s:e], weights[s:e]) for s, e in zip(starts, ends)]
+
+    def occluded(self, origin, target, light=None):
+        # any-hit test: stops at the first shape found between origin and target
+        return self.occluded_batch(origin, [target], light)[0]
+
+    def occluded_batch(self, origin, targets, light=None):
+        # occlusion of several shadow rays sharing an origin. Shapes are the
+        # outer loop so rays that are already blocked drop out early. When the
+        # light is given, the shapes that recently blocked it are tested first
+        rays = []
+        for target in targets:
+            to_target = target - origin
+            rays.append((Ray(origin, to_target), to_target.length()))
+        blocked = [False] * len(rays)
+        pending = list(range(len(rays)))
+
+        cache = self.shadow_cache if light is not None else None
+        cached = []
+        if cache is not None:
+            cache.lookups += len(rays)
+            cached = cache.lookup(light)
+            for shape in cached:
+                if not pending:
+                    break
+                still_pending = self._block_rays(shape, rays, blocked, pending)
+                if len(still_pending) < len(pending):
+                    cache.hits += len(pending) - len(still_pending)
+                    cache.store(light, shape, len(pending) - len(still_pending))
+                pending = still_pending
+
+        for shape in self.shadow_casters:
+            if not pending:
+                break
+            if any(shape is other for other in cached):
+                continue
+            still_pending = self._block_rays(shape, rays, blocked, pending)
+            if cache is not None and len(still_pending) < len(pending):
+                cache.store(light, shape, len(pending) - len(still_pending))
+            pending = still_pending
+        return blocked
+
+    def _block_rays(self, shape, rays, blocked, pending):
+        # marks the pending rays blocked by shape, returns the ones still unblocked
+        still_pending = []
+        for k in pending:
+            ray, dist = rays[k]
+            shadow_hit = shape.hit(ray)
+            if shadow_hit.hit and CastEpsilon < shadow_hit.t < dist:
+                blocked[k] = True
+            else:
+                still_pending.append(k)
+        return still_pending
+
+    def light_visibility(self, light, point, normal, light_vector, shape=None):
+        # fraction of the light visible from point. light_vector is the
+        # (already sampled) vector from point to the light used for shading,
+        # shape the one the point lies on (helps the shadow map, if any)
+        if not self.shadows:
+            return 1.0
+        shadow_map = getattr(light, 'shadow_map', None)
+        if shadow_map is not None:
+            visibility = shadow_map.visibility(np.array([point.as_list()]), np.array([normal.as_list()]),
+                                               np.array([light_vector.as_list()]), [shape])[0]
+            if not np.isnan(visibility):
+                return visibility
+        return self.traced_visibility(light, point, normal, light_vector)
+
+    def traced_visibility(self, light, point, normal, light_vector):
+        # light_visibility from shadow rays
+        origin = point + normal * CastEpsilon
+        samples = getattr(light, 'shadow_samples', 1)
+        if samples <= 1:
+            return 0.0 if self.occluded(origin, point + light_vector, light) else 1.0
+
+        # stratified samples over the light; if the first probes all agree the
+        # point is taken as fully lit or fully blocked, otherwise it is in a
+        # penumbra and the remaining samples are traced
+        targets = light.stratified_positions(samples)
+        probes = min(samples, ShadowProbeSamples)
+        blocked = self.occluded_batch(origin, targets[:probes], light)
+        if all(blocked):
+            return 0.0
+        if not any(blocked):
+            return 1.0
+        blocked += self.occluded_batch(origin, targets[probes:], light)
+        return 1.0 - sum(blocked) / samples
+
+    def light_visibility_batch(self, light, points, normals, light_vectors, shapes=None):
+        # light_visibility for arrays of points, normals and light vectors.
+        # The shadow map resolves what it can at once, the rest is traced
+        if not self.shadows:
+            return np.ones(len(points))
+        shadow_map = getattr(light, 'shadow_map', None)
+        if shadow_map is None:
+            visibility = np.full(len(points), np.nan)
+        else:
+            visibility = shadow_map.visibility(points, normals, light_vectors, shapes)
+        for k in np.flatnonzero(np.isnan(visibility)):
+            visibility[k] = self.traced_visibility(light, Vector3D(*points[k]), Vector3D(*normals[k]),
+                                                   Vector3D(*light_vectors[k]))
+        return visibility
 
     # add iterator support for primitives zip and colors
     def __iter__(self):
         return iter(zip(self.shapes, self.materials))
+    def candidates(self, ray):
+        # camera rays start at depth 0, reflected and refracted rays are deeper
+        return self.camera_visible if ray.depth == 0 else self.reflection_visible
+
     def hit(self, ray):
         # check for hits with all shapes
+        if ray.mirrors and self.mirror_views is not None:
+            return self.mirror_views.hit(self, ray)
+        return self.hit_candidates(ray, self.candidates(ray))
+
+    def hit_candidates(self, ray, candidates):
+        # closest hit among the given (shape, material) pairs
         hit_rec = HitRecord()
-        for shape, material in zip(self.shapes, self.materials):
+        for shape, material in candidates:
             new_hit = shape.hit(ray)
             if new_hit.hit and new_hit.t < hit_rec.t and new_hit.t > CastEpsilon:
                 hit_rec = new_hit
                 # set material
                 hit_rec.material = material
                 hit_rec.ray = ray
+                hit_rec.shape = shape
+        if hit_rec.hit:
+            hit_rec.footprint = ray.cone_width + ray.cone_spread * hit_rec.t
         return hit_rec
 
+    def hit_batch(self, rays):
+        # closest hit for each ray of one bounce (all rays share the same
+        # depth). Shapes are the outer loop, rays the inner one
+        records = [HitRecord() for _ in rays]
+        if not rays:
+            return records
+        if self.mirror_views is not None and any(ray.mirrors for ray in rays):
+            return [self.hit(ray) for ray in rays]
+        for shape, material in self.candidates(rays[0]):
+            for k, ray in enumerate(rays):
+                new_hit = shape.hit(ray)
+                if new_hit.hit and new_hit.t < records[k].t and new_hit.t > CastEpsilon:
+                    new_hit.material = material
+                    new_hit.ray = ray
+                    new_hit.shape = shape
+                    records[k] = new_hit
+        for ray, hit_rec in zip(rays, records):
+            if hit_rec.hit:
+                hit_rec.footprint = ray.cone_width + ray.cone_spread * hit_rec.t
+        return records
+
+    def surviving(self, secondaries):
+        # filters (ray, weight) pairs spawned by a material according to the
+        # throughput of each ray. Russian roulette divides the weight of the
+        # survivors by their survival probability, which keeps the estimate unbiased
+        survivors = []
+        for ray, weight in secondaries:
+            if ray.throughput >= self.min_throughput:
+                survivors.append((ray, weight))
+            elif self.roulette:
+                p = ray.throughput / self.min_throughput
+                if random.random() < p:
+                    ray.throughput /= p
+                    survivors.append((ray, weight / p))
+        return survivors
+
+    def trace(self, ray):
+        # color seen along a ray
+        hit_rec = self.hit(ray)
+        if hit_rec.hit:
+            return hit_rec.material.shade(hit_rec, self)
+        return self.background
+
 class HitRecord:
     def __init__(self, hit=False, t=float('inf'), point=None, normal=None, material=None, ray=None, uv=None):
         self.hit = hit
@@ -83,12 +365,128 @@ class HitRecord:
         self.normal = normal
         self.material = material
         self.ray = ray
-        self.uv = uv
+        # a Vector3D, or a function that computes it on first use: shapes
+        # whose uv costs more than the hit test give one (see Ball.hit), so
+        # only the hits that get shaded pay for it
+        self.lazy_uv = uv
+        self.shape = None  # the scene shape that was hit, set by the scene
+        # width of the ray cone at the hit, set by the scene
+        self.footprint = 0.0
+        # (du/dx, dv/dx, du/dy, dv/dy) per pixel, from the ray differentials
+        self.uv_derivatives = None
+
+    @property
+    def uv(self):
+        if callable(self.lazy_uv):
+            self.lazy_uv = self.lazy_uv()
+        return self.lazy_uv
+
+    @uv.setter
+    def uv(self, uv):
+        self.lazy_uv = uv
+
+class HitBatch:
+    """Hits of several rays as (N, 3) arrays, the input of Material.shade_batch."""
+    def __init__(self, points, normals, view_dirs, depths, uvs=None, records=None, visibility=None, footprints=None, uv_derivatives=None):
+        self.points = points
+        self.normals = normals
+        self.view_dirs = view_dirs  # unit vectors from the hit towards the ray origin
+        self.depths = depths
+        self.uvs = uvs  # (N, 2), or None when the shapes produce no uv
+        self.records = records  # the HitRecords, when the batch was built from them
+        self.visibility = visibility  # optional precomputed (N, L) light visibility
+        # ray cone widths at the hits
+        self.footprints = footprints if footprints is not None else np.zeros(len(points))
+        # (N, 4) uv derivatives, rows of nan where the ray had no differentials
+        self.uv_derivatives = uv_derivatives if uv_derivatives is not None else np.full((len(points), 4), np.nan)
+
+    def __len__(self):
+        return len(self.points)
+
+    @classmethod
+    def from_records(cls, records):
+        points = np.array([r.point.as_list() for r in records])
+        normals = np.array([r.normal.as_list() for r in records])
+        view_dirs = -np.array([r.ray.direction.as_list() for r in records])
+        depths = np.array([r.ray.depth for r in records])
+        uvs = None
+        if all(r.uv is not None for r in records):
+            uvs = np.array([[r.uv.x, r.uv.y] for r in records])
+        footprints = np.array([r.footprint for r in records])
+        uv_derivatives = np.array([r.uv_derivatives if r.uv_derivatives is not None else (np.nan,) * 4
+                                   for r in records])
+        return cls(points, normals, view_dirs, depths, uvs, records, footprints=footprints,
+                   uv_derivatives=uv_derivatives)
+
+    def uv_widths(self):
+        # (N, 2) size of the pixel footprint along u and v. Uses the uv
+        # derivatives when known, otherwise the ray cone, stretched by 1/cos
+        # at grazing angles (clamped to avoid blurring everything)
+        d = np.abs(self.uv_derivatives)
+        widths = d[:, 0:2] + d[:, 2:4]
+        cone = ~np.isfinite(widths[:, 0])
+        if cone.any():
+            cos = np.abs(np.einsum('ij,ij->i', self.normals[cone], self.view_dirs[cone]))
+            widths[cone] = (self.footprints[cone] / np.maximum(cos, 0.05))[:, None]
+        return widths
+
+    def hit_records(self):
+        # scalar HitRecords for materials that only implement shade; rays
+        # are rebuilt one unit behind the hit when the batch has none
+        if self.records is not None:
+            return self.records
+        records = []
+        for k in range(len(self)):
+            point = Vector3D(*self.points[k])
+            view_dir = Vector3D(*self.view_dirs[k])
+            uv = Vector3D(self.uvs[k, 0], self.uvs[k, 1], 0) if self.uvs is not None else None
+            ray = Ray(point + view_dir, -view_dir, int(self.depths[k]))
+            hit_rec = HitRecord(True, 1.0, point, Vector3D(*self.normals[k]), ray=ray, uv=uv)
+            hit_rec.footprint = self.footprints[k]
+            if np.isfinite(self.uv_derivatives[k, 0]):
+                hit_rec.uv_derivatives = tuple(self.uv_derivatives[k])
+            records.append(hit_rec)
+        return records
+
+def normalize_rows(v):
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
 
 class Material:
     def __init__(self):
         pass
 
+    def local(self, hit_record, scene):
+        # shading that does not depend on secondary rays
+        return self.shade(hit_record, scene)
+
+    def scatter(self, hit_record, scene):
+        # secondary rays spawned at the hit, as (ray, weight) pairs:
+        # shade = local + sum(weight * color seen along ray)
+        return []
+
+    def shade_batch(self, batch, scene):
+        # local colors of a HitBatch as an (N, 3) array. This fallback calls the
+        # scalar local for each hit, so custom materials work unchanged
+        return np.array([self.local(hit_record, scene).as_list() for hit_record in batch.hit_records()])
+
+    def shade_parts_batch(self, batch, scene):
+        # shade_batch split in 1 + 2L parts (N, 1 + 2L, 3): what does not
+        # depend on the lights, then for each light l its ambient (1 + 2l) and
+        # direct (2 + 2l) colors, proportional to its intensity and, for the
+        # direct one, to its color (see lightbuffers.py). Materials that do not
+        # split their colors keep them in the first part
+        parts = np.zeros((len(batch), 1 + 2 * len(scene.lights), 3))
+        parts[:, 0] = self.shade_batch(batch, scene)
+        return parts
+
+    def freeze(self, scene):
+        # precompute terms that only depend on the material and the scene lights
+        pass
+
+    def albedo_batch(self, batch):
+        # (N, 3) surface color at the hits, used to guide the denoiser
+        return np.ones((len(batch), 3))
+
     def shade(self, hit_record, scene):
         # Placeholder method for shading
         raise NotImplementedError("shade method not implemented")
\ No newline at end of file
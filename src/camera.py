@@ -1,4 +1,5 @@
 # world is right-handed, z is up
+import copy
 import math
 import random
 
@@ -34,10 +35,20 @@ class Camera:
         # from view plane to world coordinates
         return self.eye + self.u * x_ndc + self.v * y_ndc - self.w
 
+    def differentials(self, direction):
+        # derivatives of direction (not normalized) per pixel, over its length
+        length = direction.length()
+        return (self.u * (self.su / self.img_width / length),
+                self.v * (self.sv / self.img_height / length))
+
     def ray(self, x, y):
         point_world = self.point_image2world(x, y)
-        direction = (point_world - self.eye).normalize()
-        return Ray(self.eye, direction)
+        direction = point_world - self.eye
+        # one pixel of the view plane, which lies at unit distance
+        ray = Ray(self.eye, direction, cone_spread=self.su / self.img_width,
+                  differentials=self.differentials(direction))
+        ray.pixel = (x, y)
+        return ray
 
 
 class Camera_with_focal_depth:
@@ -81,7 +92,23 @@ class Camera_with_focal_depth:
         lens_point = self.eye + self.u * ue + self.v * ve
         p_f = (point_world - self.eye) * self.focal_dist + self.eye
 
-        return Ray(lens_point, (p_f - lens_point).normalize())
+        # the lens point is fixed, the point on the focal plane moves with the pixel
+        direction = p_f - lens_point
+        length = direction.length() / self.focal_dist
+        differentials = (self.u * (self.su / self.img_width / length),
+                         self.v * (self.sv / self.img_height / length))
+        return Ray(lens_point, direction, cone_spread=self.su / self.img_width,
+                   differentials=differentials)
+
+
+        
 
 
-        
\ No newline at end of file
+def resized(camera, img_width, img_height):
+    # the same view at another image size: the horizontal field of view is
+    # kept and the vertical one follows the aspect ratio
+    camera = copy.copy(camera)
+    camera.img_width = img_width
+    camera.img_height = img_height
+    camera.sv = camera.su * img_height / img_width
+    return camera
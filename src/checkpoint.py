@@ -0,0 +1,80 @@
+import os
+import json
+import shutil
+
+import numpy as np
+
+from .film import TiledFilm
+from .denoise import AuxChannels
+
+# Render state kept on disk while rendering: the tiled films, the object ids
+# and a bitmap of the finished tiles. A tile's data is flushed before its bit,
+# so after a crash every marked tile is complete and the render can go on
+# from there (raster.py --resume). The films never need to fit in memory.
+
+def saved_settings(directory):
+    # settings of an existing checkpoint, None if there is none
+    try:
+        with open(os.path.join(directory, 'header.json')) as f:
+            return json.load(f)['settings']
+    except FileNotFoundError:
+        return None
+
+class Checkpoint:
+    def __init__(self, directory, width, height, tile_size, margin, aux=False, settings=None, resume=False,
+                 channels=3):
+        self.directory = directory
+        # what the stored samples depend on; resuming requires the same
+        header = dict(width=width, height=height, tile_size=tile_size, margin=margin, aux=aux,
+                      channels=channels, settings=settings or dict())
+        header_path = self._path('header.json')
+        mode = 'w+'
+        if resume and os.path.exists(header_path):
+            with open(header_path) as f:
+                saved = json.load(f)
+            if saved != json.loads(json.dumps(header)):
+                raise ValueError(f"Checkpoint '{directory}' was made with other settings, render without --resume to start over")
+            mode = 'r+'
+        os.makedirs(directory, exist_ok=True)
+
+        self.color = TiledFilm(self._path('color.f32'), width, height, tile_size, margin, channels, mode)
+        self.aux = None
+        self.ids = None
+        if aux:
+            # the first hit buffers are box filtered, without margin
+            self.aux = TiledFilm(self._path('aux.f32'), width, height, tile_size, 0, AuxChannels, mode)
+            self.ids = np.memmap(self._path('ids.i32'), dtype=np.int32, mode=mode, shape=(height, width))
+        tiles = self.color.tiles_x * self.color.tiles_y
+        self.bitmap = np.memmap(self._path('tiles.bitmap'), dtype=np.uint8, mode=mode, shape=((tiles + 7) // 8,))
+        if mode == 'w+':
+            # written last: a checkpoint without header is never resumed
+            with open(header_path, 'w') as f:
+                json.dump(header, f)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def done(self, tile):
+        k = self.color.index(tile)
+        return bool(self.bitmap[k >> 3] >> (k & 7) & 1)
+
+    def finished(self):
+        # number of finished tiles
+        return int(np.unpackbits(self.bitmap).sum())
+
+    def store(self, tile, block, aux=None):
+        # block and aux as returned by raster.render_tile
+        self.color.store(tile, *block)
+        self.color.flush()
+        if aux is not None:
+            i0, i1, j0, j1 = tile
+            self.aux.store(tile, *aux[0])
+            self.aux.flush()
+            self.ids[i0:i1, j0:j1] = aux[1]
+            self.ids.flush()
+        k = self.color.index(tile)
+        self.bitmap[k >> 3] |= 1 << (k & 7)
+        self.bitmap.flush()
+
+    def remove(self):
+        shutil.rmtree(self.directory)
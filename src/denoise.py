@@ -0,0 +1,77 @@
+import numpy as np
+
+from .base import HitBatch
+
+# Auxiliary buffers of the first hit seen through each pixel, and an
+# edge-avoiding a-trous wavelet filter (Dammertz et al. 2010) guided by them.
+
+# albedo (3), normal (3) and depth (1) of each sample
+AuxChannels = 7
+# B3 spline, the 1D kernel of every a-trous pass
+AtrousKernel = np.array([1/16, 1/4, 3/8, 1/4, 1/16])
+
+def first_hit_aux(scene, hits):
+    # (S, AuxChannels) buffers and (S,) object ids (-1 for the background)
+    # of the first hits of the camera samples
+    aux = np.zeros((len(hits), AuxChannels))
+    ids = np.full(len(hits), -1)
+    aux[:, 0:3] = scene.background.as_list()
+    shape_ids = {id(shape): k for k, shape in enumerate(scene.shapes)}
+    groups = dict()
+    for k, hit_rec in enumerate(hits):
+        if hit_rec.hit:
+            groups.setdefault(id(hit_rec.material), []).append(k)
+            ids[k] = shape_ids.get(id(hit_rec.shape), -1)
+    for indices in groups.values():
+        records = [hits[k] for k in indices]
+        batch = HitBatch.from_records(records)
+        aux[indices, 0:3] = records[0].material.albedo_batch(batch)
+        aux[indices, 3:6] = batch.normals
+        aux[indices, 6] = [hit_rec.t for hit_rec in records]
+    return aux, ids
+
+def _shifted(image, dy, dx):
+    # image moved by (dy, dx) pixels, repeating the border
+    h, w = image.shape[:2]
+    rows = np.clip(np.arange(h) + dy, 0, h - 1)
+    cols = np.clip(np.arange(w) + dx, 0, w - 1)
+    return image[rows][:, cols]
+
+def atrous(image, albedo, normals, depth, ids, iterations=5,
+           sigma_color=1.0, sigma_normal=0.3, sigma_depth=0.05, sigma_albedo=0.1):
+    # each pass blurs with the 5x5 B3 kernel spread 2^pass pixels apart,
+    # weighting every neighbour by how close its color and guide buffers are.
+    # The color tolerance halves every pass as the noise goes down
+    kernel = np.outer(AtrousKernel, AtrousKernel)
+    # depth is compared relative to the distance
+    scale = np.maximum(depth, 1e-6)
+    color = image.copy()
+    for level in range(iterations):
+        step = 2 ** level
+        sigma = sigma_color * 2.0 ** -level
+        total = np.zeros_like(color)
+        weights = np.zeros(depth.shape)
+        for a in range(5):
+            for b in range(5):
+                dy, dx = (a - 2) * step, (b - 2) * step
+                q_color = _shifted(color, dy, dx)
+                distance = (np.sum((q_color - color) ** 2, axis=2) / sigma ** 2
+                            + np.sum((_shifted(normals, dy, dx) - normals) ** 2, axis=2) / sigma_normal ** 2
+                            + ((_shifted(depth, dy, dx) - depth) / scale) ** 2 / sigma_depth ** 2
+                            + np.sum((_shifted(albedo, dy, dx) - albedo) ** 2, axis=2) / sigma_albedo ** 2)
+                w = kernel[a, b] * np.exp(-distance) * (_shifted(ids, dy, dx) == ids)
+                total += q_color * w[:, :, None]
+                weights += w
+        # the center pixel always has weight kernel[2, 2] > 0
+        color = total / weights[:, :, None]
+    return color
+
+# albedo below which a channel is filtered as it is: dividing by a dark
+# albedo would turn its noise into fireflies
+AlbedoFloor = 0.05
+
+def denoise_image(image, albedo, normals, depth, ids, **kwargs):
+    # filters the lighting only: dividing by the albedo keeps textures and
+    # checkers sharp while the noise from lights and shadows is smoothed
+    scale = np.where(albedo >= AlbedoFloor, albedo, 1.0)
+    return atrous(image / scale, albedo, normals, depth, ids, **kwargs) * scale
@@ -0,0 +1,181 @@
+import numpy as np
+
+from .rasterizer import tessellate, _screen_boxes
+
+# Which objects each pixel of an image depends on, so that an edit of one
+# object only re-renders the pixels it can change (app.py). While rendering
+# (wavefront engine), every camera sample records the shapes its rays hit,
+# first and reflected, and the shadow casters that could block its shadow
+# rays: those whose bounds cross the segment from a shaded point to a light,
+# grown by the size of the light. A shape is bit (index % 64) of a mask, so
+# with many objects the record errs on the side of re-rendering.
+#
+# An edit that moves geometry also reaches pixels that never saw the object:
+# those inside its old and new screen bounds, those whose shadow segments
+# cross its new bounds and those whose paths bounce (a reflection may show
+# it now). Records only live in the rendering process: the tiles have to be
+# rendered where the Dependencies object is.
+
+MaskBits = 64
+Unbounded = (np.full(3, -np.inf), np.full(3, np.inf))
+
+
+def bit(index):
+    return np.uint64(1) << np.uint64(index % MaskBits)
+
+
+def shape_bounds(shape, camera):
+    # (lo, hi) world box containing the shape, from its rasterizer mesh
+    mesh = tessellate(shape, camera)
+    if mesh is None:
+        return Unbounded
+    return mesh[0].min(axis=0), mesh[0].max(axis=0)
+
+
+def screen_mask(shape, camera):
+    # pixels whose centers the shape may cover (all of them when it has no mesh)
+    width, height = camera.img_width, camera.img_height
+    mask = np.zeros((height, width), dtype=bool)
+    mesh = tessellate(shape, camera)
+    if mesh is None:
+        mask[:] = True
+        return mask
+    vertices, triangles = mesh
+    eye = np.array(camera.eye.as_list())
+    u, v, w = (np.array(axis.as_list()) for axis in (camera.u, camera.v, camera.w))
+    # one pixel more around, for the samples away from the centers
+    for i0, i1, j0, j1 in _screen_boxes(camera, vertices[triangles], eye, u, v, w):
+        if i1 >= i0 and j1 >= j0:
+            mask[max(i0 - 1, 0):i1 + 2, max(j0 - 1, 0):j1 + 2] = True
+    return mask
+
+
+def _crosses(points, target, lo, hi):
+    # whether the segments from points (N, 3) to target (3,) cross the boxes
+    # lo, hi (broadcast to (N, B, 3)): (N, B)
+    d = target - points
+    d = np.where(np.abs(d) < 1e-12, 1e-12, d)[:, None]
+    t1 = (lo - points[:, None]) / d
+    t2 = (hi - points[:, None]) / d
+    t_in = np.minimum(t1, t2).max(axis=2)
+    t_out = np.maximum(t1, t2).min(axis=2)
+    return (t_out >= np.maximum(t_in, 0)) & (t_in <= 1)
+
+
+class SampleRecord:
+    # dependencies of the camera samples of one tile, filled by wavefront.render_tile
+    def __init__(self, dependencies, count):
+        self.dependencies = dependencies
+        self.hits = np.zeros(count, dtype=np.uint64)
+        self.shadows = np.zeros(count, dtype=np.uint64)
+        self.bounced = np.zeros(count, dtype=bool)
+        # box of the points shaded along each sample's path
+        self.lo = np.full((count, 3), np.inf)
+        self.hi = np.full((count, 3), -np.inf)
+
+    def record(self, samples, hits, depth):
+        # one bounce: samples are the sample index of each ray, hits their records
+        if depth > 0:
+            self.bounced[samples] = True
+        deps = self.dependencies
+        found = [k for k, hit_rec in enumerate(hits) if hit_rec.hit]
+        if not found:
+            return
+        samples = np.asarray(samples)[found]
+        bits = np.array([deps.bits.get(id(hits[k].shape), 0) for k in found], dtype=np.uint64)
+        np.bitwise_or.at(self.hits, samples, bits)
+        points = np.array([hits[k].point.as_list() for k in found])
+        np.minimum.at(self.lo, samples, points)
+        np.maximum.at(self.hi, samples, points)
+        if not len(deps.caster_bits):
+            return
+        shadows = np.zeros(len(found), dtype=np.uint64)
+        for center, radius in deps.lights:
+            crossed = _crosses(points, center, deps.caster_lo - radius, deps.caster_hi + radius)
+            shadows |= np.bitwise_or.reduce(np.where(crossed, deps.caster_bits, np.uint64(0)), axis=1)
+        np.bitwise_or.at(self.shadows, samples, shadows)
+
+
+class Dependencies:
+    # per pixel record of an image of a frozen scene
+    def __init__(self, scene, width, height):
+        self.width = width
+        self.height = height
+        self.hits = np.zeros((height, width), dtype=np.uint64)
+        self.shadows = np.zeros((height, width), dtype=np.uint64)
+        self.bounced = np.zeros((height, width), dtype=bool)
+        self.lo = np.full((height, width, 3), np.inf)
+        self.hi = np.full((height, width, 3), -np.inf)
+
+        self.bits = {id(shape): bit(k) for k, shape in enumerate(scene.shapes)}
+        casters = [shape for shape in scene.shadow_casters if id(shape) in self.bits]
+        self.caster_bits = np.array([self.bits[id(shape)] for shape in casters], dtype=np.uint64)
+        bounds = [shape_bounds(shape, scene.camera) for shape in casters]
+        self.caster_lo = np.array([lo for lo, _ in bounds]).reshape(-1, 3)
+        self.caster_hi = np.array([hi for _, hi in bounds]).reshape(-1, 3)
+        # a sphere around each light
+        self.lights = []
+        for light in scene.lights:
+            lo, hi = (np.array(p.as_list()) for p in light.bounds())
+            self.lights.append(((lo + hi) / 2, np.linalg.norm(hi - lo) / 2))
+
+    def record(self, count):
+        return SampleRecord(self, count)
+
+    def add(self, record, positions):
+        # merges the record of a tile's samples, at film positions (x, y)
+        rows = np.floor(positions[:, 1]).astype(int)
+        cols = np.floor(positions[:, 0]).astype(int)
+        np.bitwise_or.at(self.hits, (rows, cols), record.hits)
+        np.bitwise_or.at(self.shadows, (rows, cols), record.shadows)
+        np.logical_or.at(self.bounced, (rows, cols), record.bounced)
+        np.minimum.at(self.lo, (rows, cols), record.lo)
+        np.maximum.at(self.hi, (rows, cols), record.hi)
+
+    def clear(self, mask):
+        # forgets the pixels about to be rendered again
+        self.hits[mask] = 0
+        self.shadows[mask] = 0
+        self.bounced[mask] = False
+        self.lo[mask] = np.inf
+        self.hi[mask] = -np.inf
+
+    def updated(self, scene, mask):
+        # the record of the edited scene: the same pixels, but for those in mask
+        deps = Dependencies(scene, self.width, self.height)
+        for name in ('hits', 'shadows', 'bounced', 'lo', 'hi'):
+            setattr(deps, name, getattr(self, name).copy())
+        deps.clear(mask)
+        return deps
+
+    def stale(self, index, geometry, old_scene, new_scene):
+        # pixels an edit of object index may change. Material edits reach the
+        # pixels whose rays hit it; geometry edits (shape, transform, flags)
+        # also those it may have shadowed, those it covers on screen before
+        # and after, those it may shadow now and every bounce.
+        # old_scene and new_scene are frozen and share the camera
+        mask = (self.hits & bit(index)) != 0
+        if not geometry:
+            return mask
+        mask |= (self.shadows & bit(index)) != 0
+        mask |= self.bounced
+        camera = new_scene.camera
+        old = old_scene.shapes[index] if index < len(old_scene.shapes) else None
+        new = new_scene.shapes[index] if index < len(new_scene.shapes) else None
+        for shape in (old, new):
+            if shape is not None:
+                mask |= screen_mask(shape, camera)
+        if new is not None and any(shape is new for shape in new_scene.shadow_casters):
+            lo, hi = shape_bounds(new, camera)
+            shaded = np.flatnonzero(np.isfinite(self.lo[:, :, 0]).ravel() & ~mask.ravel())
+            if len(shaded):
+                box_lo, box_hi = self.lo.reshape(-1, 3)[shaded], self.hi.reshape(-1, 3)[shaded]
+                centers = (box_lo + box_hi) / 2
+                spans = (np.linalg.norm(box_hi - box_lo, axis=1) / 2)[:, None, None]
+                crossed = np.zeros(len(shaded), dtype=bool)
+                for center, radius in self.lights:
+                    # the segment from the middle of the pixel's points, grown by both sizes
+                    grow = spans + radius
+                    crossed |= _crosses(centers, center, lo - grow, hi + grow)[:, 0]
+                mask[np.unravel_index(shaded[crossed], mask.shape)] = True
+        return mask
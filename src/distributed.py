@@ -0,0 +1,197 @@
+import time
+import queue
+import pickle
+import socket
+import struct
+import threading
+from collections import deque
+
+# Rendering on several machines: a coordinator (raster.py --serve) hands out
+# tiles over TCP to workers (raster.py worker --connect), which load the
+# scene module once, render the tiles they are given and send the splatted
+# blocks back. Each worker keeps a few tiles in flight so it never waits for
+# the network; the tiles of a worker that goes away are handed out again.
+#
+# Messages are pickled, so only connect workers and coordinators that trust
+# each other (a render farm, not the internet).
+#
+#   coordinator -> worker: ('setup', options), then ('tile', tile) ... ('stop', reason)
+#   worker -> coordinator: ('ready', name, jobs, scene_hash), then ('done', tile, block, aux, stats) ...
+
+# tiles in flight per worker process
+TilesInFlight = 2
+# seconds a worker may take to return its next tile before it is taken as
+# lost (stuck render, paused machine), and how many times its usual time
+# per tile it may take once that is known
+TileTimeout = 120.0
+TileTimeoutFactor = 10.0
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+class Connection:
+    # length prefixed pickled messages; send may be called from several threads
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.sock.sendall(struct.pack('!Q', len(data)) + data)
+
+    def _read(self, size):
+        chunks = []
+        while size:
+            chunk = self.sock.recv(min(size, 1 << 20))
+            if not chunk:
+                raise ConnectionError("Connection closed")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def receive(self):
+        size, = struct.unpack('!Q', self._read(8))
+        return pickle.loads(self._read(size))
+
+    def shutdown(self):
+        # wakes up a thread blocked in receive
+        self.sock.shutdown(socket.SHUT_RDWR)
+
+    def close(self):
+        self.sock.close()
+
+def connect(address, wait=0.0):
+    # retries for up to wait seconds, so workers can start before the coordinator
+    deadline = time.time() + wait
+    while True:
+        try:
+            return Connection(socket.create_connection(parse_address(address)))
+        except OSError:
+            if time.time() >= deadline:
+                raise
+            time.sleep(0.5)
+
+class WorkerStats:
+    def __init__(self, name, address, jobs):
+        self.name = name
+        self.address = address
+        self.jobs = jobs
+        self.tiles = 0
+        self.pixels = 0
+        self.start = time.time()
+        self.end = None
+        self.lost = 0  # tiles handed out again when the worker went away
+
+    def report(self):
+        elapsed = (self.end or time.time()) - self.start
+        status = f", lost with {self.lost} tiles in flight" if self.lost else ""
+        return (f"{self.name} ({self.address[0]}, {self.jobs} jobs): {self.tiles} tiles in {elapsed:.1f}s, "
+                f"{self.pixels / max(elapsed, 1e-9):.0f} pixels/s{status}")
+
+class Coordinator:
+    def __init__(self, address, options, tiles, scene_hash, tile_timeout=TileTimeout):
+        # options are sent to the workers to build their render context;
+        # workers whose scene does not hash to scene_hash are turned away
+        self.options = options
+        self.scene_hash = scene_hash
+        self.tile_timeout = tile_timeout
+        self.pending = deque(tiles)
+        self.remaining = set(tiles)
+        self.results_queue = queue.Queue()
+        self.condition = threading.Condition()
+        self.finished = False
+        self.workers = []
+        self.server = socket.create_server(parse_address(address))
+        self.address = self.server.getsockname()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.server.accept()
+            except OSError:
+                return  # closed
+            threading.Thread(target=self._serve, args=(Connection(sock), address), daemon=True).start()
+
+    def _serve(self, connection, address):
+        stats = None
+        in_flight = set()
+        try:
+            connection.send(('setup', self.options))
+            _, name, jobs, scene_hash = connection.receive()
+            if scene_hash != self.scene_hash:
+                connection.send(('stop', f"The scene of worker {name} differs from the coordinator's"))
+                return
+            stats = WorkerStats(name, address, jobs)
+            with self.condition:
+                self.workers.append(stats)
+            while True:
+                with self.condition:
+                    # without tiles in flight, wait for tiles handed back by
+                    # lost workers or for the end of the render
+                    while not in_flight and not self.pending and not self.finished:
+                        self.condition.wait()
+                    if self.finished:
+                        connection.send(('stop', None))
+                        return
+                    handed = []
+                    while len(in_flight) < jobs * TilesInFlight and self.pending:
+                        tile = self.pending.popleft()
+                        in_flight.add(tile)
+                        handed.append(tile)
+                for tile in handed:
+                    connection.send(('tile', tile))
+                # a worker that stops answering is dropped like one that
+                # disconnected: its tiles in flight are handed out again
+                connection.sock.settimeout(self._deadline(stats, in_flight))
+                result = connection.receive()[1:]
+                tile = result[0]
+                in_flight.discard(tile)
+                i0, i1, j0, j1 = tile
+                stats.tiles += 1
+                stats.pixels += (i1 - i0) * (j1 - j0)
+                self.results_queue.put(result)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            with self.condition:
+                if in_flight:
+                    # hand the lost tiles out again, first (socket.timeout is an OSError)
+                    self.pending.extendleft(in_flight)
+                    if stats is not None:
+                        stats.lost = len(in_flight)
+                    self.condition.notify_all()
+        finally:
+            if stats is not None:
+                stats.end = time.time()
+            connection.close()
+
+    def _deadline(self, stats, in_flight):
+        # seconds to wait for the next result of a worker: its usual time
+        # per pixel, for the pixels it holds, with a wide margin
+        pixels = sum((i1 - i0) * (j1 - j0) for i0, i1, j0, j1 in in_flight)
+        if not stats.pixels:
+            return self.tile_timeout
+        per_pixel = (time.time() - stats.start) / stats.pixels
+        return max(self.tile_timeout, TileTimeoutFactor * per_pixel * pixels)
+
+    def results(self):
+        # results of the tiles, as raster.render_tile returns them, in the
+        # order they arrive
+        while self.remaining:
+            result = self.results_queue.get()
+            if result[0] in self.remaining:
+                self.remaining.remove(result[0])
+                yield result
+        self.close()
+
+    def close(self):
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+        self.server.close()
+
+    def report(self):
+        return [stats.report() for stats in self.workers]
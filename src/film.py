@@ -0,0 +1,179 @@
+import math
+
+import numpy as np
+
+# Reconstruction of the image from its samples. Every sample is splatted to
+# the pixels whose center lies inside the filter radius, weighted by the
+# filter; a pixel is the weighted mean of the samples around it.
+
+class Filter:
+    def __init__(self, radius):
+        self.radius = radius
+        # pixels reached on each side of the pixel holding the sample
+        self.margin = max(0, math.ceil(radius - 0.5))
+
+    def weight_1d(self, x):
+        raise NotImplementedError("weight_1d method not implemented")
+
+    def evaluate(self, dx, dy):
+        # separable filters: the product of the 1D weights
+        return self.weight_1d(dx) * self.weight_1d(dy)
+
+class BoxFilter(Filter):
+    def __init__(self, radius=0.5):
+        super().__init__(radius)
+
+    def weight_1d(self, x):
+        return (np.abs(x) <= self.radius).astype(float)
+
+class TentFilter(Filter):
+    def __init__(self, radius=1.0):
+        super().__init__(radius)
+
+    def weight_1d(self, x):
+        return np.maximum(self.radius - np.abs(x), 0)
+
+class GaussianFilter(Filter):
+    def __init__(self, radius=1.5, alpha=2.0):
+        super().__init__(radius)
+        self.alpha = alpha
+        # shifted so the weight reaches 0 at the radius
+        self.edge = math.exp(-alpha * radius * radius)
+
+    def weight_1d(self, x):
+        return np.maximum(np.exp(-self.alpha * x * x) - self.edge, 0)
+
+class MitchellFilter(Filter):
+    def __init__(self, radius=2.0, b=1/3, c=1/3):
+        super().__init__(radius)
+        self.b = b
+        self.c = c
+
+    def weight_1d(self, x):
+        # cubic on [-2, 2] stretched to the radius; has small negative lobes
+        x = np.abs(2 * x / self.radius)
+        b, c = self.b, self.c
+        near = ((12 - 9*b - 6*c) * x**3 + (-18 + 12*b + 6*c) * x**2 + (6 - 2*b)) / 6
+        far = ((-b - 6*c) * x**3 + (6*b + 30*c) * x**2 + (-12*b - 48*c) * x + (8*b + 24*c)) / 6
+        return np.where(x < 1, near, np.where(x < 2, far, 0))
+
+Filters = {
+    'box': BoxFilter,
+    'tent': TentFilter,
+    'gaussian': GaussianFilter,
+    'mitchell': MitchellFilter,
+}
+
+# smallest weight a pixel is divided by. Filters with negative lobes can
+# leave a pixel with a weight near zero or below (image borders, few
+# samples), where the weighted mean would blow up; every pixel that holds
+# samples of its own has more than this with the filters here
+MinWeight = 0.05
+
+def resolve(sums, weights, dtype=float):
+    # weighted mean of the samples of every pixel, black where there are none
+    image = sums / np.maximum(weights, MinWeight)[..., None]
+    return np.where(weights[..., None] > 0, image, 0).astype(dtype)
+
+def make_filter(name, radius=None):
+    if name not in Filters:
+        raise ValueError(f"Unknown filter '{name}', choose one of {', '.join(Filters)}")
+    return Filters[name]() if radius is None else Filters[name](radius)
+
+def splat(filter, tile, positions, colors):
+    # weighted sums and weights of a tile, with a border of filter.margin
+    # pixels for the samples that reach the neighbouring tiles. positions
+    # are (x, y) film coordinates, pixel (i, j) spans [j, j+1) x [i, i+1).
+    # colors may have any number of channels
+    i0, i1, j0, j1 = tile
+    m = filter.margin
+    sums = np.zeros((i1 - i0 + 2 * m, j1 - j0 + 2 * m, colors.shape[1]))
+    weights = np.zeros(sums.shape[:2])
+    x, y = positions[:, 0], positions[:, 1]
+    cols = np.floor(x).astype(int)
+    rows = np.floor(y).astype(int)
+    for di in range(-m, m + 1):
+        for dj in range(-m, m + 1):
+            w = filter.evaluate(cols + dj + 0.5 - x, rows + di + 0.5 - y)
+            index = (rows + di - i0 + m, cols + dj - j0 + m)
+            np.add.at(weights, index, w)
+            np.add.at(sums, index, colors * w[:, None])
+    return (i0 - m, j0 - m), sums, weights
+
+class Film:
+    def __init__(self, width, height, channels=3):
+        self.width = width
+        self.height = height
+        self.sums = np.zeros((height, width, channels))
+        self.weights = np.zeros((height, width))
+
+    def add(self, origin, sums, weights):
+        # accumulates a splatted block, dropping what falls outside the image
+        i, j = origin
+        h, w = weights.shape
+        a0, a1 = max(i, 0), min(i + h, self.height)
+        b0, b1 = max(j, 0), min(j + w, self.width)
+        if a0 >= a1 or b0 >= b1:
+            return
+        self.sums[a0:a1, b0:b1] += sums[a0 - i:a1 - i, b0 - j:b1 - j]
+        self.weights[a0:a1, b0:b1] += weights[a0 - i:a1 - i, b0 - j:b1 - j]
+
+    def image(self, i0=0, i1=None, j0=0, j1=None):
+        # the resolved image, or rows i0 to i1 and columns j0 to j1 of it
+        return resolve(self.sums[i0:i1, j0:j1], self.weights[i0:i1, j0:j1])
+
+class TiledFilm:
+    # Film kept in a float32 file mapped in memory, with one slot per tile
+    # holding the block it splatted (filter margin included) and its
+    # weights. Storing a tile overwrites its slot, so a tile rendered twice
+    # is not counted twice; the image is resolved from the slots band by band
+    def __init__(self, path, width, height, tile_size, margin, channels=3, mode='w+'):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.margin = margin
+        self.tiles_x = -(-width // tile_size)
+        self.tiles_y = -(-height // tile_size)
+        size = tile_size + 2 * margin
+        # the last channel holds the weights
+        self.slots = np.memmap(path, dtype=np.float32, mode=mode,
+                               shape=(self.tiles_y, self.tiles_x, size, size, channels + 1))
+
+    def index(self, tile):
+        i0, _, j0, _ = tile
+        return (i0 // self.tile_size) * self.tiles_x + j0 // self.tile_size
+
+    def store(self, tile, origin, sums, weights):
+        i0, _, j0, _ = tile
+        slot = self.slots[i0 // self.tile_size, j0 // self.tile_size]
+        h, w = weights.shape
+        slot[:h, :w, :-1] = sums
+        slot[:h, :w, -1] = weights
+
+    def flush(self):
+        self.slots.flush()
+
+    def accumulated(self, i0, i1):
+        # weighted sums and weights of image rows i0 to i1, adding up the
+        # slots of the tile rows that reach them
+        ts, m = self.tile_size, self.margin
+        size = ts + 2 * m
+        band = np.zeros((i1 - i0, self.width + 2 * m + ts, self.slots.shape[-1]))
+        for ty in range(max(0, (i0 - m) // ts - 1), min(self.tiles_y, (i1 + m) // ts + 1)):
+            top = ty * ts - m
+            a0, a1 = max(top, i0), min(top + size, i1)
+            if a0 >= a1:
+                continue
+            for tx in range(self.tiles_x):
+                # band columns are shifted by the margin
+                band[a0 - i0:a1 - i0, tx * ts:tx * ts + size] += self.slots[ty, tx, a0 - top:a1 - top]
+        band = band[:, m:m + self.width]
+        return band[:, :, :-1], band[:, :, -1]
+
+    def rows(self, i0, i1):
+        # resolved image rows i0 to i1
+        return resolve(*self.accumulated(i0, i1), dtype=np.float32)
+
+    def image(self):
+        return np.concatenate([self.rows(i, min(i + self.tile_size, self.height))
+                               for i in range(0, self.height, self.tile_size)])
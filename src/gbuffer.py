@@ -0,0 +1,156 @@
+import json
+
+import numpy as np
+
+from .base import HitRecord
+from .vector3d import Vector3D
+from . import wavefront
+
+# Deferred shading: the first hits of the camera samples of an image (point,
+# normal, uv, object, and the visibility of every light from the point),
+# kept by tile while the image is rendered. With the camera and the geometry
+# unchanged, the image can be shaded again from them without intersecting a
+# camera ray: materials, the background and light colors and intensities are
+# free to change, a light that moved only costs its shadow rays. Reflections
+# are still traced from the first hits. Saved next to the output (app.py).
+
+FormatVersion = 1
+# arrays of a tile, and the dtype they are saved with
+Buffers = dict(positions=np.float32, objects=np.int32, points=np.float64, normals=np.float32, t=np.float64,
+               uvs=np.float32, uv_derivatives=np.float32, footprints=np.float32, visibility=np.float32,
+               lights=np.float64)
+# numbers in the key of a light
+LightKeySize = 14
+
+
+def light_key(scene, light):
+    # what the visibility of a light depends on: its place, size and shadow rays
+    lo, hi = light.bounds()
+    key = lo.as_list() + hi.as_list()
+    for name in ('u', 'v'):
+        axis = getattr(light, name, None)
+        key += axis.as_list() if axis is not None else [0.0, 0.0, 0.0]
+    return key + [getattr(light, 'shadow_samples', 1), float(scene.shadows)]
+
+
+def visibility(scene, light, points, normals):
+    # fraction of the light seen from each point
+    if not len(points):
+        return np.zeros(0)
+    return scene.light_visibility_batch(light, points, normals, light.positions(len(points)) - points)
+
+
+class GBuffer:
+    def __init__(self):
+        self.tiles = dict()
+        # set when buffers were added or computed again since the last save
+        self.changed = False
+
+    def capture(self, scene, tile, positions, hits):
+        # keeps the first hits of a tile; returns their (S, L) light
+        # visibility, for the shading of the samples (see wavefront.trace_bounce)
+        objects = {id(shape): k for k, shape in enumerate(scene.shapes)}
+        found = [k for k, hit_rec in enumerate(hits) if hit_rec.hit]
+        count = len(hits)
+        buffers = dict(
+            positions=np.asarray(positions, dtype=float).reshape(-1, 2),
+            objects=np.full(count, -1),
+            points=np.zeros((count, 3)),
+            normals=np.zeros((count, 3)),
+            t=np.zeros(count),
+            uvs=np.full((count, 2), np.nan),
+            uv_derivatives=np.full((count, 4), np.nan),
+            footprints=np.zeros(count),
+            visibility=np.zeros((count, len(scene.lights))),
+        )
+        for k in found:
+            hit_rec = hits[k]
+            buffers['objects'][k] = objects[id(hit_rec.shape)]
+            buffers['points'][k] = hit_rec.point.as_list()
+            buffers['normals'][k] = hit_rec.normal.as_list()
+            buffers['t'][k] = hit_rec.t
+            if hit_rec.uv is not None:
+                buffers['uvs'][k] = hit_rec.uv.x, hit_rec.uv.y
+            if hit_rec.uv_derivatives is not None:
+                buffers['uv_derivatives'][k] = hit_rec.uv_derivatives
+            buffers['footprints'][k] = hit_rec.footprint
+        self.tiles[tile] = buffers
+        self.changed = True
+        self._update_lights(scene, buffers)
+        return buffers['visibility']
+
+    def _update_lights(self, scene, buffers):
+        # visibility of the lights that changed since it was computed
+        keys = np.array([light_key(scene, light) for light in scene.lights]).reshape(-1, LightKeySize)
+        old_keys = buffers.get('lights', np.zeros((0, LightKeySize)))
+        old_visibility = buffers['visibility']
+        hit = buffers['objects'] >= 0
+        updated = np.zeros((len(hit), len(scene.lights)))
+        for l, light in enumerate(scene.lights):
+            if l < len(old_keys) and np.array_equal(old_keys[l], keys[l]):
+                updated[:, l] = old_visibility[:, l]
+                continue
+            updated[hit, l] = visibility(scene, light, buffers['points'][hit], buffers['normals'][hit])
+            self.changed = True
+        buffers['visibility'] = updated
+        buffers['lights'] = keys
+
+    def shade(self, scene, camera, tile, light_parts=False):
+        # film positions and colors (or light parts, as in
+        # wavefront.render_tile) of the samples of a tile, from its first hits
+        buffers = self.tiles[tile]
+        self._update_lights(scene, buffers)
+        queue, hits = [], []
+        for k, ((x, y), index) in enumerate(zip(buffers['positions'].tolist(), buffers['objects'].tolist())):
+            ray = camera.ray(x, y)
+            queue.append(wavefront.PathState(k, ray, 1.0))
+            if index < 0:
+                hits.append(HitRecord())
+                continue
+            hit_rec = HitRecord(True, buffers['t'][k], Vector3D(*buffers['points'][k]),
+                                Vector3D(*buffers['normals'][k]), scene.materials[index], ray)
+            if not np.isnan(buffers['uvs'][k, 0]):
+                hit_rec.uv = Vector3D(*buffers['uvs'][k], 0)
+            if not np.isnan(buffers['uv_derivatives'][k, 0]):
+                hit_rec.uv_derivatives = tuple(buffers['uv_derivatives'][k])
+            hit_rec.shape = scene.shapes[index]
+            hit_rec.footprint = buffers['footprints'][k]
+            hits.append(hit_rec)
+        samples = np.zeros((len(queue), 1 + 2 * len(scene.lights), 3) if light_parts else (len(queue), 3))
+        queue = wavefront.trace_bounce(scene, queue, samples, hits, visibility=buffers['visibility'])
+        while queue:
+            queue = wavefront.trace_bounce(scene, queue, samples)
+        return buffers['positions'], samples
+
+    def save(self, path, header):
+        # the tiles' buffers one after the other, header a dict of JSON values
+        tiles = list(self.tiles)
+        arrays = dict(tiles=np.array(tiles, dtype=np.int32).reshape(-1, 4),
+                      counts=np.array([len(self.tiles[tile]['objects']) for tile in tiles], dtype=np.int64))
+        for name, dtype in Buffers.items():
+            parts = [self.tiles[tile][name] for tile in tiles]
+            arrays[name] = np.concatenate(parts).astype(dtype) if parts else np.zeros((0, LightKeySize), dtype)
+        header = dict(header, version=FormatVersion)
+        with open(path, 'wb') as f:
+            np.savez(f, header=np.array(json.dumps(header)), **arrays)
+        self.changed = False
+
+
+def load(path):
+    # header and GBuffer of a file written by GBuffer.save
+    gbuffer = GBuffer()
+    with np.load(path) as data:
+        header = json.loads(str(data['header']))
+        if header.get('version') != FormatVersion:
+            raise ValueError(f"'{path}' is not a G-buffer of version {FormatVersion}")
+        tiles = [tuple(tile) for tile in data['tiles'].tolist()]
+        offsets = np.concatenate([[0], np.cumsum(data['counts'])]).astype(int)
+        # one row of keys per light and tile
+        lights = data['lights'].reshape(max(len(tiles), 1), -1, LightKeySize)
+        arrays = {name: data[name].astype(np.int64 if name == 'objects' else np.float64)
+                  for name in Buffers if name != 'lights'}
+    for k, tile in enumerate(tiles):
+        buffers = {name: values[offsets[k]:offsets[k + 1]] for name, values in arrays.items()}
+        buffers['lights'] = lights[k].astype(np.float64)
+        gbuffer.tiles[tile] = buffers
+    return header, gbuffer
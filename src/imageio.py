@@ -0,0 +1,257 @@
+import json
+import struct
+import zlib
+
+import numpy as np
+
+# Image readers and writers without third party dependencies. Every reader
+# returns a float32 (height, width, 3) array with values in [0, 1], row 0 at
+# the top. Writers are described below read_image.
+
+PngSignature = b'\x89PNG\r\n\x1a\n'
+# samples per pixel of each PNG color type
+PngChannels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+def _paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    return b if pb <= pc else c
+
+def _unfilter(data, height, stride, bpp):
+    # undoes the per-row PNG filters, returns a (height, stride) uint8 array
+    rows = np.zeros((height, stride), dtype=np.uint8)
+    prev = np.zeros(stride, dtype=np.int32)
+    pos = 0
+    for y in range(height):
+        kind = data[pos]
+        line = np.frombuffer(data, dtype=np.uint8, count=stride, offset=pos + 1).astype(np.int32)
+        pos += stride + 1
+        if kind == 0:  # none
+            cur = line
+        elif kind == 1:  # sub: running sum of each byte of the pixel
+            cur = line.copy()
+            for k in range(bpp):
+                cur[k::bpp] = np.cumsum(line[k::bpp]) % 256
+        elif kind == 2:  # up
+            cur = (line + prev) % 256
+        elif kind == 3:  # average (sequential, done on python lists)
+            filt, up, rec = line.tolist(), prev.tolist(), [0] * stride
+            for k in range(stride):
+                left = rec[k - bpp] if k >= bpp else 0
+                rec[k] = (filt[k] + (left + up[k]) // 2) % 256
+            cur = np.array(rec, dtype=np.int32)
+        elif kind == 4:  # paeth (sequential, done on python lists)
+            filt, up, rec = line.tolist(), prev.tolist(), [0] * stride
+            for k in range(stride):
+                left = rec[k - bpp] if k >= bpp else 0
+                up_left = up[k - bpp] if k >= bpp else 0
+                rec[k] = (filt[k] + _paeth(left, up[k], up_left)) % 256
+            cur = np.array(rec, dtype=np.int32)
+        else:
+            raise ValueError(f"Unknown PNG filter type {kind}")
+        rows[y] = cur
+        prev = cur
+    return rows
+
+def read_png(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(PngSignature):
+        raise ValueError(f"{path} is not a PNG file")
+    pos = len(PngSignature)
+    idat = []
+    palette = None
+    while pos < len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + length]
+        pos += length + 12
+        if kind == b'IHDR':
+            width, height, depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', chunk)
+        elif kind == b'PLTE':
+            palette = np.frombuffer(chunk, dtype=np.uint8).reshape(-1, 3)
+        elif kind == b'IDAT':
+            idat.append(chunk)
+        elif kind == b'IEND':
+            break
+    if interlace:
+        raise ValueError(f"{path}: interlaced PNG files are not supported")
+    if depth not in (8, 16) or color_type not in PngChannels:
+        raise ValueError(f"{path}: unsupported PNG format (bit depth {depth}, color type {color_type})")
+
+    channels = PngChannels[color_type]
+    bpp = channels * depth // 8
+    rows = _unfilter(zlib.decompress(b''.join(idat)), height, width * bpp, bpp)
+    if depth == 16:
+        pixels = rows.view('>u2').astype(np.float32) / 65535
+    else:
+        pixels = rows.astype(np.float32) / 255
+    pixels = pixels.reshape(height, width, channels)
+
+    if color_type == 3:
+        return palette[rows.reshape(height, width)].astype(np.float32) / 255
+    if channels <= 2:  # gray, gray + alpha
+        return np.repeat(pixels[:, :, :1], 3, axis=2)
+    return pixels[:, :, :3]
+
+def _ppm_tokens(data, count):
+    # header fields, skipping whitespace and comments; returns them and the data offset
+    tokens = []
+    pos = 0
+    while len(tokens) < count:
+        while data[pos:pos + 1].isspace():
+            pos += 1
+        if data[pos:pos + 1] == b'#':
+            while data[pos:pos + 1] not in (b'\n', b''):
+                pos += 1
+            continue
+        start = pos
+        while not data[pos:pos + 1].isspace():
+            pos += 1
+        tokens.append(data[start:pos])
+    return tokens, pos + 1
+
+def read_ppm(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    (magic, width, height, maxval), offset = _ppm_tokens(data, 4)
+    width, height, maxval = int(width), int(height), int(maxval)
+    if magic == b'P6':
+        dtype = np.uint8 if maxval < 256 else np.dtype('>u2')
+        pixels = np.frombuffer(data, dtype=dtype, count=width * height * 3, offset=offset)
+    elif magic == b'P3':
+        pixels = np.array(data[offset:].split()[:width * height * 3], dtype=np.float64)
+    else:
+        raise ValueError(f"{path}: only P3 and P6 PPM files are supported")
+    return (pixels.astype(np.float32) / maxval).reshape(height, width, 3)
+
+def read_raw(path, width, height, channels=3, dtype=np.uint8):
+    # headerless pixels, row by row. Integer types are normalized by their maximum
+    pixels = np.fromfile(path, dtype=dtype, count=width * height * channels)
+    pixels = pixels.reshape(height, width, channels).astype(np.float32)
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        pixels /= np.iinfo(dtype).max
+    if channels < 3:
+        return np.repeat(pixels[:, :, :1], 3, axis=2)
+    return pixels[:, :, :3]
+
+def read_image(path, width=None, height=None, channels=3, dtype=np.uint8):
+    # dispatches on the extension; raw files need their size
+    lower = path.lower()
+    if lower.endswith('.png'):
+        return read_png(path)
+    if lower.endswith(('.ppm', '.pnm')):
+        return read_ppm(path)
+    if width is None or height is None:
+        raise ValueError(f"{path}: raw images need width and height")
+    return read_raw(path, width, height, channels, dtype)
+
+# Writers take the picture as rows(i0, i1), a function returning rows i0 to
+# i1 of the linear float image with row 0 at the bottom (as the film stores
+# it), so large images are written band by band, never assembled in memory.
+# 8 and 16 bit formats go through display(): exposure, tone mapping, gamma
+# and dithering; PFM and raw keep the linear values for compositing.
+
+BandRows = 16
+ToneMaps = ('clip', 'reinhard')
+
+def display(band, exposure=1.0, tonemap='clip', gamma=1.0, dither=False, bit_depth=8, rng=None):
+    # linear values to integers of bit_depth bits
+    values = np.maximum(np.asarray(band, dtype=np.float32) * exposure, 0)
+    if tonemap == 'reinhard':
+        values = values / (1 + values)
+    values = np.minimum(values, 1)
+    if gamma != 1.0:
+        values **= 1 / gamma
+    maxval = (1 << bit_depth) - 1
+    values *= maxval
+    if dither:
+        # noise of one step before rounding hides the banding of smooth gradients
+        values += (rng or np.random.default_rng()).uniform(-0.5, 0.5, values.shape)
+    return np.clip(np.rint(values), 0, maxval).astype(np.uint16 if bit_depth > 8 else np.uint8)
+
+def _bands_from_top(rows, height):
+    # the picture top down, in bands flipped to top row first
+    for i1 in range(height, 0, -BandRows):
+        yield rows(max(i1 - BandRows, 0), i1)[::-1]
+
+def _chunk(f, kind, data):
+    f.write(struct.pack('>I', len(data)) + kind + data)
+    f.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+def write_png(path, rows, width, height, bit_depth=8, **options):
+    # RGB PNG streamed band by band: every row gets the "up" filter and
+    # goes through one zlib stream split into IDAT chunks
+    rng = np.random.default_rng(0)
+    with open(path, 'wb') as f:
+        f.write(PngSignature)
+        _chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, bit_depth, 2, 0, 0, 0))
+        compressor = zlib.compressobj(6)
+        prev = np.zeros((1, width * 3 * (bit_depth // 8)), dtype=np.uint8)
+        for band in _bands_from_top(rows, height):
+            pixels = display(band, bit_depth=bit_depth, rng=rng, **options)
+            lines = pixels.astype('>u2' if bit_depth > 8 else np.uint8).reshape(len(pixels), -1).view(np.uint8)
+            # uint8 differences wrap around, as the filter wants
+            up = np.diff(np.vstack([prev, lines]), axis=0)
+            prev = lines[-1:]
+            data = compressor.compress(np.hstack([np.full((len(up), 1), 2, dtype=np.uint8), up]).tobytes())
+            if data:
+                _chunk(f, b'IDAT', data)
+        _chunk(f, b'IDAT', compressor.flush())
+        _chunk(f, b'IEND', b'')
+
+def write_ppm(path, rows, width, height, bit_depth=8, **options):
+    # binary PPM (P6), 16 bit samples are big endian
+    rng = np.random.default_rng(0)
+    with open(path, 'wb') as f:
+        f.write(f"P6\n{width} {height}\n{(1 << bit_depth) - 1}\n".encode('ascii'))
+        for band in _bands_from_top(rows, height):
+            pixels = display(band, bit_depth=bit_depth, rng=rng, **options)
+            f.write(pixels.astype('>u2' if bit_depth > 8 else np.uint8).tobytes())
+
+def write_pfm(path, rows, width, height, **options):
+    # float32 PFM, little endian; PFM stores the bottom row first like the film
+    with open(path, 'wb') as f:
+        f.write(f"PF\n{width} {height}\n-1.0\n".encode('ascii'))
+        for i0 in range(0, height, BandRows):
+            f.write(np.asarray(rows(i0, min(i0 + BandRows, height)), dtype='<f4').tobytes())
+
+def write_raw(path, rows, width, height, **options):
+    # headerless float32 pixels, top row first (see read_raw), described by
+    # a json file next to them
+    with open(path, 'wb') as f:
+        for band in _bands_from_top(rows, height):
+            f.write(np.asarray(band, dtype=np.float32).tobytes())
+    with open(path + '.json', 'w') as f:
+        json.dump(dict(width=width, height=height, channels=3, dtype='float32'), f)
+
+def write_matplotlib(path, rows, width, height, bit_depth=8, **options):
+    # any format matplotlib knows; imported only here, it is slow to load
+    import matplotlib.pyplot as plt
+    image = np.concatenate(list(_bands_from_top(rows, height)))
+    plt.imsave(path, display(image, rng=np.random.default_rng(0), **options))
+
+Writers = {
+    'png': write_png,
+    'ppm': write_ppm,
+    'pfm': write_pfm,
+    'raw': write_raw,
+    'matplotlib': write_matplotlib,
+}
+WriterExtensions = {'.png': 'png', '.ppm': 'ppm', '.pnm': 'ppm', '.pfm': 'pfm', '.raw': 'raw', '.f32': 'raw'}
+
+def write_image(path, rows, width, height, writer=None, **options):
+    # writer defaults to the one of the extension
+    if writer is None:
+        extension = path[path.rfind('.'):].lower() if '.' in path else ''
+        if extension not in WriterExtensions:
+            raise ValueError(f"No writer for '{path}', use one of {', '.join(WriterExtensions)} or the matplotlib writer")
+        writer = WriterExtensions[extension]
+    if writer not in Writers:
+        raise ValueError(f"Unknown writer '{writer}', choose one of {', '.join(Writers)}")
+    Writers[writer](path, rows, width, height, **options)
+
+def image_rows(image):
+    # rows function of an image held in memory, row 0 at the bottom
+    return lambda i0, i1: image[i0:i1]
@@ -1,4 +1,6 @@
-from random import uniform
+import math
+from random import uniform, shuffle
+import numpy as np
 from .vector3d import Vector3D
 from .base import Color
 
@@ -8,20 +10,42 @@ class Light:
 
     def position(self):
         raise NotImplementedError("Subclasses should implement this method")
-class PointLight:
+
+    def positions(self, n):
+        # n sampled positions as an (n, 3) array, for batched shading
+        return np.array([self.position().as_list() for _ in range(n)])
+
+    def bounds(self):
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def power(self):
+        # scalar estimate of the light's emitted power, used for light selection
+        return self.intensity * (self.color.r + self.color.g + self.color.b) / 3
+
+class PointLight(Light):
     def __init__(self, position: Vector3D, color: Color, intensity: float = 1.0):
         self.pos = position  # position is a Vector3
         self.color = color  # color is a Color
         self.intensity = intensity  # intensity is a float
+        # optional CubeShadowMap, see shadowmap.build_shadow_maps
+        self.shadow_map = None
 
     def position(self):
         return self.pos
 
-class AreaLight:
-    def __init__(self, position, look_at, up, width, height, color=Color(1, 1, 1), intensity=1.0):
+    def positions(self, n):
+        return np.tile(self.pos.as_list(), (n, 1))
+
+    def bounds(self):
+        return self.pos, self.pos
+
+class AreaLight(Light):
+    def __init__(self, position, look_at, up, width, height, color=Color(1, 1, 1), intensity=1.0, shadow_samples=1):
         self.pos = position
         self.color = color
         self.intensity = intensity
+        # maximum number of shadow rays per shading point (see BaseScene.light_visibility)
+        self.shadow_samples = shadow_samples
         self.w = (position - look_at).normalize()
         self.su = width
         self.sv = height
@@ -30,11 +54,40 @@ class AreaLight:
         self.v = self.w.cross(self.u).normalize()
 
     def position(self):
-        # from image coordinates to coordinates 
+        # from image coordinates to coordinates
         # in the camera's view plane
         u, v = uniform(0, 1), uniform(0, 1)
         x = self.su * u - self.su / 2
         y = self.sv * v - self.sv / 2
 
         # from view plane to world coordinates
-        return self.pos + self.u * x + self.v * y
\ No newline at end of file
+        return self.pos + self.u * x + self.v * y
+
+    def positions(self, n):
+        x = self.su * np.random.uniform(0, 1, n) - self.su / 2
+        y = self.sv * np.random.uniform(0, 1, n) - self.sv / 2
+        return (np.array(self.pos.as_list())
+                + np.outer(x, self.u.as_list())
+                + np.outer(y, self.v.as_list()))
+
+    def stratified_positions(self, n):
+        # one jittered point per cell of a grid over the su x sv rectangle.
+        # cells are visited in random order so that any prefix of the list
+        # is spread over the whole light
+        nu = int(math.ceil(math.sqrt(n)))
+        nv = int(math.ceil(n / nu))
+        cells = [(a, b) for a in range(nu) for b in range(nv)]
+        shuffle(cells)
+        positions = []
+        for a, b in cells[:n]:
+            x = self.su * (a + uniform(0, 1)) / nu - self.su / 2
+            y = self.sv * (b + uniform(0, 1)) / nv - self.sv / 2
+            positions.append(self.pos + self.u * x + self.v * y)
+        return positions
+
+    def bounds(self):
+        corners = [self.pos + self.u * (self.su * a) + self.v * (self.sv * b)
+                   for a in (-0.5, 0.5) for b in (-0.5, 0.5)]
+        lo = Vector3D(min(c.x for c in corners), min(c.y for c in corners), min(c.z for c in corners))
+        hi = Vector3D(max(c.x for c in corners), max(c.y for c in corners), max(c.z for c in corners))
+        return lo, hi
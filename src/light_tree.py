@@ -0,0 +1,120 @@
+import random
+
+import numpy as np
+
+from .vector3d import Vector3D
+
+class LightNode:
+    def __init__(self, lo, hi, power, light=None, index=None, left=None, right=None):
+        self.lo = lo
+        self.hi = hi
+        self.power = power
+        self.light = light  # only set on leaves, with the light's index in the scene
+        self.index = index
+        self.left = left
+        self.right = right
+        # the same bounds as arrays, for importance_batch
+        self.center = np.array(((lo + hi) * 0.5).as_list())
+        half = (hi - lo) * 0.5
+        self.radius2 = max(half.dot(half), 1e-6)
+
+    def importance(self, point):
+        # power over squared distance to the node, clamped by the node's own
+        # extent so that points inside (or close to) a cluster don't blow up.
+        # never zero: the ambient term of every light reaches every point
+        center = (self.lo + self.hi) * 0.5
+        d = center - point
+        dist2 = d.dot(d)
+        half = (self.hi - self.lo) * 0.5
+        radius2 = half.dot(half)
+        return self.power / max(dist2, radius2, 1e-6)
+
+    def importance_batch(self, points):
+        # importance for an (N, 3) array of points
+        d = points - self.center
+        return self.power / np.maximum(np.einsum('ij,ij->i', d, d), self.radius2)
+
+class LightTree:
+    """BVH over the scene lights, used to pick lights by estimated contribution."""
+    def __init__(self, lights):
+        self.lights = list(lights)
+        self.root = self._build(list(enumerate(self.lights))) if self.lights else None
+
+    def _build(self, lights):
+        # lights are (index, light) pairs
+        if len(lights) == 1:
+            index, light = lights[0]
+            lo, hi = light.bounds()
+            # lights with zero power would never be picked, so give them a tiny weight
+            return LightNode(lo, hi, max(light.power(), 1e-9), light=light, index=index)
+
+        centers = [(lo + hi) * 0.5 for lo, hi in (light.bounds() for _, light in lights)]
+        c_lo = Vector3D(min(c.x for c in centers), min(c.y for c in centers), min(c.z for c in centers))
+        c_hi = Vector3D(max(c.x for c in centers), max(c.y for c in centers), max(c.z for c in centers))
+        extent = c_hi - c_lo
+        # split along the largest axis of the centroid bounds, at the median
+        if extent.x >= extent.y and extent.x >= extent.z:
+            key = lambda i: centers[i].x
+        elif extent.y >= extent.z:
+            key = lambda i: centers[i].y
+        else:
+            key = lambda i: centers[i].z
+        order = sorted(range(len(lights)), key=key)
+        mid = len(lights) // 2
+        left = self._build([lights[i] for i in order[:mid]])
+        right = self._build([lights[i] for i in order[mid:]])
+
+        lo = Vector3D(min(left.lo.x, right.lo.x), min(left.lo.y, right.lo.y), min(left.lo.z, right.lo.z))
+        hi = Vector3D(max(left.hi.x, right.hi.x), max(left.hi.y, right.hi.y), max(left.hi.z, right.hi.z))
+        return LightNode(lo, hi, left.power + right.power, left=left, right=right)
+
+    def sample(self, point, u=None):
+        # walk down the tree choosing a child proportionally to its importance.
+        # returns the index of the chosen light and the probability of having chosen it
+        if u is None:
+            u = random.random()
+        node = self.root
+        pdf = 1.0
+        while node.light is None:
+            w_left = node.left.importance(point)
+            w_right = node.right.importance(point)
+            p_left = w_left / (w_left + w_right)
+            if u < p_left:
+                # reuse the random number for the next level
+                u = u / p_left
+                pdf *= p_left
+                node = node.left
+            else:
+                u = (u - p_left) / (1 - p_left)
+                pdf *= 1 - p_left
+                node = node.right
+        return node.index, pdf
+
+    def sample_batch(self, points, u):
+        # sample for an (N, 3) array of points and N random numbers, all the
+        # points under a node at once. Returns the (N,) indices of the chosen
+        # lights and the probabilities of having chosen them
+        u = np.array(u, dtype=float)
+        indices = np.zeros(len(points), dtype=int)
+        pdfs = np.ones(len(points))
+        stack = [(self.root, np.arange(len(points)))]
+        while stack:
+            node, rows = stack.pop()
+            if not len(rows):
+                continue
+            if node.light is not None:
+                indices[rows] = node.index
+                continue
+            w_left = node.left.importance_batch(points[rows])
+            w_right = node.right.importance_batch(points[rows])
+            p_left = w_left / (w_left + w_right)
+            left = u[rows] < p_left
+            right = ~left
+            # reuse the random numbers for the next level
+            u[rows[left]] /= p_left[left]
+            u[rows[right]] = (u[rows[right]] - p_left[right]) / (1 - p_left[right])
+            pdfs[rows[left]] *= p_left[left]
+            pdfs[rows[right]] *= 1 - p_left[right]
+            stack.append((node.left, rows[left]))
+            stack.append((node.right, rows[right]))
+        return indices, pdfs
@@ -0,0 +1,48 @@
+import numpy as np
+
+from .base import Color
+
+# Per light buffers: the image split in the colors that do not depend on
+# the lights (background, emission), then for each light the ambient colors
+# it adds and its direct lighting, rendered with every light white at
+# intensity 1 (see Material.shade_parts_batch). Lighting is linear in the
+# colors and intensities of the lights, so the image under any of them is a
+# weighted sum of the buffers: changing a light needs no new render.
+# Materials split their colors with shade_parts_batch: SimpleMaterial and
+# its subclasses give each light its parts (TranslucidMaterial only the
+# direct ones, its ambient does not scale with the lights), the others put
+# everything in the constant part. Exact, seen directly or in reflections,
+# with every light shading every point (light_samples 0).
+
+
+def unit_lights(scene):
+    # turns the lights of a scene (before freeze) white, at intensity 1; their
+    # colors and intensities are kept in scene.light_levels
+    scene.light_levels = [(light.color.as_list(), light.intensity) for light in scene.lights]
+    for light in scene.lights:
+        light.color = Color(1, 1, 1)
+        light.intensity = 1.0
+    return scene.light_levels
+
+
+def channels(scene):
+    # film channels of the buffers of a scene
+    return 3 * (1 + 2 * len(scene.lights))
+
+
+def compose(parts, levels):
+    # image (..., 3) of buffers (..., 3 * (1 + 2L)) under levels, the
+    # (color, intensity) of each light
+    parts = parts.reshape(parts.shape[:-1] + (-1, 3))
+    image = parts[..., 0, :].copy()
+    for l, (color, intensity) in enumerate(levels):
+        image += intensity * (parts[..., 1 + 2 * l, :] + np.asarray(color) * parts[..., 2 + 2 * l, :])
+    return image
+
+
+def save(path, parts, levels):
+    # resolved buffers (H, W, 3 * (1 + 2L)), with the levels they were rendered for
+    parts = parts.reshape(parts.shape[:-1] + (-1, 3)).astype(np.float32)
+    np.savez(path, constant=parts[:, :, 0], ambient=np.moveaxis(parts[:, :, 1::2], 2, 0),
+             direct=np.moveaxis(parts[:, :, 2::2], 2, 0), colors=np.array([c for c, _ in levels]).reshape(-1, 3),
+             intensities=np.array([i for _, i in levels]))
@@ -1,9 +1,25 @@
 import math
+from dataclasses import dataclass
 
-from .base import Color, CastEpsilon, Material
+import numpy as np
+
+from .base import Color, CastEpsilon, Material, HitBatch, normalize_rows
 from .ray import Ray
 from .vector3d import Vector3D
 
+def _read_only(values):
+    array = np.array(values, dtype=float)
+    array.setflags(write=False)
+    return array
+
+@dataclass(frozen=True)
+class FrozenTerms:
+    # what freeze() compiles for a material: the ambient color (3,) and, for
+    # each light of the scene by index, its two compute_light_terms colors
+    # (L, 2, 3). Plain read-only arrays, cheap to send to the workers
+    ambient: np.ndarray
+    lights: np.ndarray
+
 class ColorMaterial(Material):
     def __init__(self,
                 diffuse_color: Color,
@@ -14,6 +30,12 @@ class ColorMaterial(Material):
     def shade(self, hit_record, scene):
         return self.diffuse_color
 
+    def shade_batch(self, batch, scene):
+        return np.tile(self.diffuse_color.as_list(), (len(batch), 1))
+
+    def albedo_batch(self, batch):
+        return np.tile(self.diffuse_color.as_list(), (len(batch), 1))
+
 class SimpleMaterial(Material):
     def __init__(self,
                 ambient_coefficient: float,
@@ -30,30 +52,115 @@ class SimpleMaterial(Material):
         self.specular_coefficient = specular_coefficient
         self.specular_color = specular_color
         self.specular_shininess = specular_shininess
+        self.frozen_terms = None
+
+    def freeze(self, scene):
+        # precompute everything that only depends on the material and the lights
+        self.frozen_terms = self.compute_terms(scene)
+
+    def compute_terms(self, scene):
+        # ambient color and, per light, the colors of compute_light_terms
+        light_terms = [[term.as_list() for term in self.compute_light_terms(light)] for light in scene.lights]
+        return FrozenTerms(_read_only((scene.ambient_light * self.ambient_coefficient).as_list()),
+                           _read_only(light_terms).reshape(-1, 2, 3))
+
+    def compute_light_terms(self, light):
+        # the (diffuse, specular) colors of a light before the geometric factors
+        return ((self.diffuse_color @ light.color) * self.diffuse_coefficient,
+                (self.specular_color @ light.color) * self.specular_coefficient)
+
+    def ambient_term(self, scene):
+        if self.frozen_terms is not None:
+            return Color(*self.frozen_terms.ambient)
+        return scene.ambient_light * self.ambient_coefficient
+
+    def light_terms(self, scene, l, light):
+        # the terms of light l of the scene; before freeze only the lights
+        # that are shaded get their terms computed
+        if self.frozen_terms is not None:
+            first, second = self.frozen_terms.lights[l]
+            return Color(*first), Color(*second)
+        return self.compute_light_terms(light)
+
+    def albedo_batch(self, batch):
+        return np.tile(self.diffuse_color.as_list(), (len(batch), 1))
 
     def shade(self, hit_record, scene):
         shaded_color = Color(0, 0, 0)
         # Ambient component
-        amb_color = scene.ambient_light * self.ambient_coefficient 
-        for light in scene.lights:
+        amb_color = self.ambient_term(scene)
+        view_dir = (scene.camera.eye - hit_record.point).normalize()
+        for l, light, weight in scene.lights_for(hit_record.point):
             light_vector = light.position() - hit_record.point
+            diffuse_term, specular_term = self.light_terms(scene, l, light)
 
             # Diffuse component
             light_dir = light_vector.normalize()
             diff_intensity = max(hit_record.normal.dot(light_dir), 0)
-            diff_color = (self.diffuse_color @ light.color) * (self.diffuse_coefficient * diff_intensity)
+            diff_color = diffuse_term * diff_intensity
 
             # Specular component
-            view_dir = (scene.camera.eye - hit_record.point).normalize()
             reflect_dir = (hit_record.normal * 2 * hit_record.normal.dot(light_dir) - light_dir).normalize()
             spec_intensity = max(view_dir.dot(reflect_dir), 0) ** self.specular_shininess
-            spec_color = (self.specular_color @ light.color) * self.specular_coefficient * spec_intensity
+            spec_color = specular_term * spec_intensity
 
             # Accumulate color contributions
-            shaded_color += (amb_color + diff_color + spec_color) * light.intensity
+            shaded_color += (amb_color + diff_color + spec_color) * (light.intensity * weight)
 
         return shaded_color
 
+    def shade_parts_batch(self, batch, scene):
+        # the light parts come from shade_batch, the rest of its colors are
+        # what does not depend on the lights (see Material.shade_parts_batch)
+        parts = np.zeros((len(batch), 1 + 2 * len(scene.lights), 3))
+        parts[:, 0] = self.shade_batch(batch, scene, parts=parts) - parts[:, 1:].sum(axis=1)
+        return parts
+
+    def shade_batch(self, batch, scene, shadows=False, parts=None):
+        # vectorized shade: loops over the picked lights, every light is
+        # evaluated for all the hits that picked it at once. parts, when
+        # given, gets the ambient and direct colors of each light (see shade_parts_batch)
+        amb_color = self.ambient_term(scene)
+        amb = np.array(amb_color.as_list())
+        view_dirs = normalize_rows(np.array(scene.camera.eye.as_list()) - batch.points)
+        shaded = np.zeros((len(batch), 3))
+        for l, light, rows, w in scene.light_picks(batch.points):
+            w = w * light.intensity
+            if not w.any():
+                continue
+            diffuse_term, specular_term = self.light_terms(scene, l, light)
+            points, normals = batch.points[rows], batch.normals[rows]
+            light_vectors = light.positions(len(rows)) - points
+
+            # Diffuse component
+            light_dirs = normalize_rows(light_vectors)
+            n_dot_l = np.einsum('ij,ij->i', normals, light_dirs)
+            diff_intensity = np.maximum(n_dot_l, 0)
+
+            # Specular component
+            reflect_dirs = normalize_rows(normals * (2 * n_dot_l)[:, None] - light_dirs)
+            spec_intensity = np.maximum(np.einsum('ij,ij->i', view_dirs[rows], reflect_dirs), 0) ** self.specular_shininess
+
+            lit = (np.outer(diff_intensity, diffuse_term.as_list())
+                   + np.outer(spec_intensity, specular_term.as_list()))
+            # ambient is added even in shadow
+            visibility = self.visibility_batch(scene, batch, l, light, rows, light_vectors) if shadows else 1.0
+            ambient, direct = amb * w[:, None], lit * (w * visibility)[:, None]
+            shaded[rows] += ambient + direct
+            if parts is not None:
+                parts[rows, 1 + 2 * l] += ambient
+                parts[rows, 2 + 2 * l] += direct
+        return shaded
+
+    def visibility_batch(self, scene, batch, l, light, rows, light_vectors):
+        # fraction of the light seen by the hits of rows, the ones that picked it
+        if batch.visibility is not None:
+            return batch.visibility[rows, l]
+        shapes = None
+        if batch.records is not None:
+            shapes = [batch.records[k].shape for k in rows]
+        return scene.light_visibility_batch(light, batch.points[rows], batch.normals[rows], light_vectors, shapes)
+
 class SimpleMaterialWithShadows(SimpleMaterial):
     def __init__(self, ambient_coefficient: float, diffuse_coefficient: float, diffuse_color: Color, specular_coefficient: float, specular_color: Color, specular_shininess: float = 32):
         super().__init__(ambient_coefficient, diffuse_coefficient, diffuse_color, specular_coefficient, specular_color, specular_shininess)
@@ -61,75 +168,201 @@ class SimpleMaterialWithShadows(SimpleMaterial):
     def shade(self, hit_record, scene):
         shaded_color = Color(0, 0, 0)
         # Ambient component
-        amb_color = scene.ambient_light * self.ambient_coefficient 
-        for light in scene.lights:
+        amb_color = self.ambient_term(scene)
+        view_dir = (scene.camera.eye - hit_record.point).normalize()
+        for l, light, weight in scene.lights_for(hit_record.point):
             light_vector = light.position() - hit_record.point
 
             # add ambient component once
-            shaded_color += amb_color * light.intensity
+            shaded_color += amb_color * (light.intensity * weight)
 
             # Shadow check
-            shadow_ray = Ray(hit_record.point + hit_record.normal * CastEpsilon, light_vector.normalize())
-            shadow_hit = scene.hit(shadow_ray)
-            if shadow_hit.hit and shadow_hit.t < light_vector.length():
+            visibility = scene.light_visibility(light, hit_record.point, hit_record.normal, light_vector, hit_record.shape)
+            if visibility == 0:
                 continue  # In shadow, skip this light
 
             # Diffuse component
+            diffuse_term, specular_term = self.light_terms(scene, l, light)
             light_dir = light_vector.normalize()
             diff_intensity = max(hit_record.normal.dot(light_dir), 0)
-            diff_color = (self.diffuse_color @ light.color) * (self.diffuse_coefficient * diff_intensity)
+            diff_color = diffuse_term * diff_intensity
 
             # Specular component
-            view_dir = (scene.camera.eye - hit_record.point).normalize()
             reflect_dir = (hit_record.normal * 2 * hit_record.normal.dot(light_dir) - light_dir).normalize()
             spec_intensity = max(view_dir.dot(reflect_dir), 0) ** self.specular_shininess
-            spec_color = (self.specular_color @ light.color) * self.specular_coefficient * spec_intensity
+            spec_color = specular_term * spec_intensity
 
             # Accumulate color contributions
-            shaded_color += (diff_color + spec_color) * light.intensity
+            shaded_color += (diff_color + spec_color) * (light.intensity * weight * visibility)
 
         return shaded_color
 
+    def shade_batch(self, batch, scene, parts=None):
+        return super().shade_batch(batch, scene, shadows=True, parts=parts)
+
+def filtered_square_wave(x, width):
+    # mean over [x - width/2, x + width/2] of the wave that is +1 on even and
+    # -1 on odd unit intervals, from its integral, the triangle wave 1 - |x mod 2 - 1|
+    def integral(x):
+        return 1 - np.abs(np.mod(x, 2) - 1)
+    width = np.maximum(width, 1e-6)
+    return (integral(x + width / 2) - integral(x - width / 2)) / width
+
 class CheckerboardMaterial(SimpleMaterial):
-    def __init__(self, ambient_coefficient: float, diffuse_coefficient: float, square_size: float, white_color: Color = Color(1,1,1), black_color: Color = Color(0,0,0)):
+    def __init__(self, ambient_coefficient: float, diffuse_coefficient: float, square_size: float, white_color: Color = Color(1,1,1), black_color: Color = Color(0,0,0), filtered: bool = False):
         super().__init__(ambient_coefficient, diffuse_coefficient, Color(0, 0, 0), 0, Color(0,0,0), 32)
         self.square_size = square_size
         self.white_color = white_color
         self.black_color = black_color
+        # box filter the pattern over the footprint of each sample (a pixel
+        # over sqrt(spp), see Ray.scale_differentials) instead of point sampling it
+        self.filtered = filtered
+
+    def white_fraction(self, batch):
+        # fraction of white squares seen by each hit. The pattern is the
+        # product of one square wave in u and one in v, so its box filter is
+        # the product of the filtered waves
+        uv = batch.uvs / self.square_size
+        if not self.filtered:
+            squares = np.floor(uv)
+            return ((squares[:, 0] + squares[:, 1]) % 2 == 0).astype(float)
+        widths = batch.uv_widths() / self.square_size
+        waves = filtered_square_wave(uv, widths)
+        return 0.5 * (1 + waves[:, 0] * waves[:, 1])
+
+    def compute_light_terms(self, light):
+        # the diffuse color of the white and of the black squares
+        return ((self.white_color @ light.color) * self.diffuse_coefficient,
+                (self.black_color @ light.color) * self.diffuse_coefficient)
+
+    def albedo_batch(self, batch):
+        black = np.array(self.black_color.as_list())
+        return black + (np.array(self.white_color.as_list()) - black) * self.white_fraction(batch)[:, None]
 
     def shade(self, hit_record, scene):
         shaded_color = Color(0, 0, 0)
         # Ambient component
-        amb_color = scene.ambient_light * self.ambient_coefficient 
-        for light in scene.lights:
+        amb_color = self.ambient_term(scene)
+
+        # checkerboard pattern
+        if self.filtered:
+            white = self.white_fraction(HitBatch.from_records([hit_record]))[0]
+        else:
+            u, v = hit_record.uv.x / self.square_size, hit_record.uv.y / self.square_size
+            white = float((math.floor(u) + math.floor(v)) % 2 == 0)
+
+        for l, light, weight in scene.lights_for(hit_record.point):
             light_vector = light.position() - hit_record.point
 
             # add ambient component once
-            shaded_color += amb_color * light.intensity
+            shaded_color += amb_color * (light.intensity * weight)
 
             # Shadow check
-            shadow_ray = Ray(hit_record.point + hit_record.normal * CastEpsilon, light_vector.normalize())
-            shadow_hit = scene.hit(shadow_ray)
-            if shadow_hit.hit and shadow_hit.t < light_vector.length():
+            visibility = scene.light_visibility(light, hit_record.point, hit_record.normal, light_vector, hit_record.shape)
+            if visibility == 0:
                 continue  # In shadow, skip this light
 
             # Diffuse component from checkerboard pattern
-            u = hit_record.uv.x / self.square_size
-            v = hit_record.uv.y / self.square_size
-
-            diffuse_color = self.black_color  # black
-            if (int(math.floor(u)) + int(math.floor(v))) % 2 == 0:
-                diffuse_color = self.white_color  # white
+            white_term, black_term = self.light_terms(scene, l, light)
+            diffuse_term = black_term + (white_term - black_term) * white
 
             light_dir = light_vector.normalize()
             diff_intensity = max(hit_record.normal.dot(light_dir), 0)
-            diff_color = (diffuse_color @ light.color) * (self.diffuse_coefficient * diff_intensity)
+            diff_color = diffuse_term * diff_intensity
 
             # Accumulate color contributions
-            shaded_color += diff_color * light.intensity
+            shaded_color += diff_color * (light.intensity * weight * visibility)
 
         return shaded_color
 
+    def shade_batch(self, batch, scene, parts=None):
+        amb_color = self.ambient_term(scene)
+        amb = np.array(amb_color.as_list())
+
+        # checkerboard pattern
+        white = self.white_fraction(batch)[:, None]
+
+        shaded = np.zeros((len(batch), 3))
+        for l, light, rows, w in scene.light_picks(batch.points):
+            w = w * light.intensity
+            if not w.any():
+                continue
+            white_term, black_term = self.light_terms(scene, l, light)
+            points, normals = batch.points[rows], batch.normals[rows]
+            light_vectors = light.positions(len(rows)) - points
+            visibility = self.visibility_batch(scene, batch, l, light, rows, light_vectors)
+
+            # Diffuse component from checkerboard pattern
+            black = np.array(black_term.as_list())
+            diffuse_terms = black + (np.array(white_term.as_list()) - black) * white[rows]
+            light_dirs = normalize_rows(light_vectors)
+            diff_intensity = np.maximum(np.einsum('ij,ij->i', normals, light_dirs), 0)
+
+            ambient, direct = amb * w[:, None], diffuse_terms * (diff_intensity * w * visibility)[:, None]
+            shaded[rows] += ambient + direct
+            if parts is not None:
+                parts[rows, 1 + 2 * l] += ambient
+                parts[rows, 2 + 2 * l] += direct
+        return shaded
+
+class TexturedMaterial(SimpleMaterial):
+    def __init__(self, ambient_coefficient: float, diffuse_coefficient: float, texture, uv_scale: float = 1.0, specular_coefficient: float = 0, specular_color: Color = Color(0,0,0), specular_shininess: float = 32, shadows: bool = True):
+        # texture is a MipTexture repeated every uv_scale units of uv
+        super().__init__(ambient_coefficient, diffuse_coefficient, Color(1, 1, 1), specular_coefficient, specular_color, specular_shininess)
+        self.texture = texture
+        self.uv_scale = uv_scale
+        self.shadows = shadows
+
+    def compute_light_terms(self, light):
+        # the (diffuse, specular) colors; the diffuse one is multiplied by the
+        # texture color at the hit
+        return (light.color * self.diffuse_coefficient,
+                (self.specular_color @ light.color) * self.specular_coefficient)
+
+    def texture_colors(self, batch):
+        # footprint of each hit in texture coordinates
+        footprints = batch.uv_widths().max(axis=1) / self.uv_scale
+        s = np.mod(batch.uvs[:, 0] / self.uv_scale, 1.0)
+        t = np.mod(batch.uvs[:, 1] / self.uv_scale, 1.0)
+        return self.texture.sample(s, t, footprints)
+
+    def albedo_batch(self, batch):
+        return self.texture_colors(batch)
+
+    def shade(self, hit_record, scene):
+        return Color(*self.shade_batch(HitBatch.from_records([hit_record]), scene)[0])
+
+    def shade_batch(self, batch, scene, parts=None):
+        amb_color = self.ambient_term(scene)
+        albedo = self.texture_colors(batch)
+        view_dirs = normalize_rows(np.array(scene.camera.eye.as_list()) - batch.points)
+
+        shaded = np.zeros((len(batch), 3))
+        for l, light, rows, w in scene.light_picks(batch.points):
+            w = w * light.intensity
+            if not w.any():
+                continue
+            diffuse_term, specular_term = self.light_terms(scene, l, light)
+            points, normals = batch.points[rows], batch.normals[rows]
+            light_vectors = light.positions(len(rows)) - points
+            visibility = self.visibility_batch(scene, batch, l, light, rows, light_vectors) if self.shadows else 1.0
+
+            light_dirs = normalize_rows(light_vectors)
+            n_dot_l = np.einsum('ij,ij->i', normals, light_dirs)
+            diff_intensity = np.maximum(n_dot_l, 0)
+            reflect_dirs = normalize_rows(normals * (2 * n_dot_l)[:, None] - light_dirs)
+            spec_intensity = np.maximum(np.einsum('ij,ij->i', view_dirs[rows], reflect_dirs), 0) ** self.specular_shininess
+
+            lit = (albedo[rows] * diffuse_term.as_list() * diff_intensity[:, None]
+                   + np.outer(spec_intensity, specular_term.as_list()))
+            # ambient is added even in shadow
+            ambient, direct = albedo[rows] * amb_color.as_list() * w[:, None], lit * (w * visibility)[:, None]
+            shaded[rows] += ambient + direct
+            if parts is not None:
+                parts[rows, 1 + 2 * l] += ambient
+                parts[rows, 2 + 2 * l] += direct
+        return shaded
+
 class ReflectiveMaterial(SimpleMaterialWithShadows):
     def __init__(self, ambient_coefficient: float, diffuse_coefficient: float,
                  diffuse_color: Color, specular_coefficient: float,
@@ -141,29 +374,57 @@ class ReflectiveMaterial(SimpleMaterialWithShadows):
         self.reflection_coefficient = reflection_coefficient
         self.back_ground_color = back_ground_color
 
-    def shade(self, hit_record, scene):
-        local_color = super().shade(hit_record, scene)
-
+    def local(self, hit_record, scene):
+        # everything but the reflected ray: the local shading, weighted by what
+        # the reflection leaves, or the background when seen from behind
         if hit_record.ray.depth < scene.max_depth:
-            d = hit_record.ray.direction
-            n = hit_record.normal
             # if the normal direction is pointing to the same side as no ray direction, return background color
-            if n.dot(d) > 0:
+            if hit_record.normal.dot(hit_record.ray.direction) > 0:
                 if self.back_ground_color:
                     return self.back_ground_color
                 return scene.background
-            reflect_dir = (d - n * 2 * d.dot(n)).normalize()
-            reflect_origin = hit_record.point + n * CastEpsilon
-            reflect_ray = Ray(reflect_origin, reflect_dir, hit_record.ray.depth + 1)
-            reflect_hit = scene.hit(reflect_ray)
-            if reflect_hit.hit:
-                reflected_color = reflect_hit.material.shade(reflect_hit, scene)
-            else:
-                reflected_color = scene.background
-            # Blend local and reflected
-            return local_color * (1 - self.reflection_coefficient) + reflected_color * self.reflection_coefficient
+            return super().shade(hit_record, scene) * (1 - self.reflection_coefficient)
+        return super().shade(hit_record, scene)
 
-        return local_color
+    def scatter(self, hit_record, scene):
+        if hit_record.ray.depth >= scene.max_depth:
+            return []
+        d = hit_record.ray.direction
+        n = hit_record.normal
+        if n.dot(d) > 0:
+            return []
+        reflect_dir = (d - n * 2 * d.dot(n)).normalize()
+        reflect_origin = hit_record.point + n * CastEpsilon
+        # flat mirror: the cone keeps its spread and starts at the footprint width
+        reflect_ray = Ray(reflect_origin, reflect_dir, hit_record.ray.depth + 1,
+                          hit_record.ray.throughput * self.reflection_coefficient,
+                          hit_record.footprint, hit_record.ray.cone_spread)
+        if hit_record.ray.pixel is not None:
+            # off a plane, this is a camera ray of the mirrored camera
+            reflect_ray.pixel = hit_record.ray.pixel
+            reflect_ray.mirrors = hit_record.ray.mirrors + (hit_record.shape,)
+        return [(reflect_ray, self.reflection_coefficient)]
+
+    def shade_batch(self, batch, scene, parts=None):
+        # batched local
+        shaded = super().shade_batch(batch, scene, parts=parts)
+        traced = batch.depths < scene.max_depth
+        shaded[traced] *= 1 - self.reflection_coefficient
+        # seen from behind: background
+        behind = traced & (np.einsum('ij,ij->i', batch.normals, batch.view_dirs) < 0)
+        background = self.back_ground_color if self.back_ground_color else scene.background
+        shaded[behind] = background.as_list()
+        if parts is not None:
+            parts[traced] *= 1 - self.reflection_coefficient
+            parts[behind] = 0
+        return shaded
+
+    def shade(self, hit_record, scene):
+        # Blend local and reflected
+        shaded_color = self.local(hit_record, scene)
+        for ray, weight in scene.surviving(self.scatter(hit_record, scene)):
+            shaded_color += scene.trace(ray) * weight
+        return shaded_color
 
 
 class TranslucidMaterial(SimpleMaterial):
@@ -172,9 +433,7 @@ class TranslucidMaterial(SimpleMaterial):
         self.transmission_coefficient = transmission_coefficient
         self.refraction_index = refraction_index
 
-    def shade(self, hit_record, scene):
-        # Ambient component
-        shaded_color = scene.ambient_light * self.ambient_coefficient 
+    def refraction_frame(self, hit_record):
         origin = hit_record.ray.origin
         view_dir = (origin - hit_record.point).normalize()
 
@@ -193,36 +452,92 @@ class TranslucidMaterial(SimpleMaterial):
             eta = 1.0 / eta
             # we also need to flip c so refraction calculations work correctly
             c = -c
+        # if k < 0 total internal reflection occurs
+        k = 1 - eta**2 * (1 - c**2)
+        return view_dir, n, eta, c, k
+
+    def local(self, hit_record, scene):
+        # everything but the transmitted ray
+        # Ambient component
+        amb_color = self.ambient_term(scene)
+        shaded_color = amb_color
+        view_dir, n, eta, c, k = self.refraction_frame(hit_record)
 
-        for light in scene.lights:
+        for l, light, weight in scene.lights_for(hit_record.point):
             light_vector = light.position() - hit_record.point
+            diffuse_term, specular_term = self.light_terms(scene, l, light)
             # # Diffuse component
             light_dir = light_vector.normalize()
             diff_intensity = max(n.dot(light_dir), 0)
-            shaded_color += (self.diffuse_color @ light.color) * (self.diffuse_coefficient * diff_intensity)*light.intensity
+            shaded_color += diffuse_term * diff_intensity*light.intensity*weight
 
             # # Specular component
             reflect_dir = (n * 2 * n.dot(light_dir) - light_dir).normalize()
             spec_intensity = max(view_dir.dot(reflect_dir), 0) ** self.specular_shininess
-            shaded_color += (self.specular_color @ light.color) * self.specular_coefficient * spec_intensity*light.intensity
+            shaded_color += specular_term * spec_intensity*light.intensity*weight
 
-        transmitted_color = Color(1, 0, 0)
+        # rays that are not transmitted are shown in red (total internal
+        # reflection) or green (maximum depth reached)
         if hit_record.ray.depth < scene.max_depth:
-            # transmission component
-            k = 1 - eta**2 * (1 - c**2)
-            if k >= 0: # if k < 0 total internal reflection occurs
-                refract_dir =  (-view_dir * eta  + n * (eta * c - math.sqrt(k))).normalize()
-                transmission_ray = Ray(hit_record.point, refract_dir, hit_record.ray.depth + 1)
-                transmission_hit = scene.hit(transmission_ray)
-                if transmission_hit.hit:
-                    transmission_material = transmission_hit.material
-                    transmitted_color = transmission_material.shade(transmission_hit, scene) * self.transmission_coefficient
-                else:
-                    transmitted_color = scene.background * self.transmission_coefficient
+            if k < 0:
+                shaded_color += Color(1, 0, 0)
         else:
-            transmitted_color = Color(0, 1, 0)
-            
-            # Accumulate color contributions
-        shaded_color += transmitted_color
+            shaded_color += Color(0, 1, 0)
 
-        return shaded_color
\ No newline at end of file
+        return shaded_color
+
+    def shade_batch(self, batch, scene, parts=None):
+        # batched local; the ambient color does not depend on the lights, so
+        # only the direct colors go to parts
+        amb_color = self.ambient_term(scene)
+        points, view_dirs = batch.points, batch.view_dirs
+
+        # normals facing the viewer, as in refraction_frame
+        c = np.einsum('ij,ij->i', batch.normals, view_dirs)
+        inside = c < 0
+        normals = np.where(inside[:, None], -batch.normals, batch.normals)
+        eta = np.where(inside, self.refraction_index, 1.0 / self.refraction_index)
+        c = np.abs(c)
+        k = 1 - eta**2 * (1 - c**2)
+
+        shaded = np.tile(amb_color.as_list(), (len(batch), 1))
+        for l, light, rows, w in scene.light_picks(points):
+            w = w * light.intensity
+            if not w.any():
+                continue
+            diffuse_term, specular_term = self.light_terms(scene, l, light)
+            light_dirs = normalize_rows(light.positions(len(rows)) - points[rows])
+            n_dot_l = np.einsum('ij,ij->i', normals[rows], light_dirs)
+            diff_intensity = np.maximum(n_dot_l, 0)
+            reflect_dirs = normalize_rows(normals[rows] * (2 * n_dot_l)[:, None] - light_dirs)
+            spec_intensity = np.maximum(np.einsum('ij,ij->i', view_dirs[rows], reflect_dirs), 0) ** self.specular_shininess
+            direct = (np.outer(diff_intensity, diffuse_term.as_list())
+                      + np.outer(spec_intensity, specular_term.as_list())) * w[:, None]
+            shaded[rows] += direct
+            if parts is not None:
+                parts[rows, 2 + 2 * l] += direct
+
+        # red: total internal reflection, green: maximum depth reached
+        traced = batch.depths < scene.max_depth
+        shaded[traced & (k < 0)] += [1, 0, 0]
+        shaded[~traced] += [0, 1, 0]
+        return shaded
+
+    def scatter(self, hit_record, scene):
+        if hit_record.ray.depth >= scene.max_depth:
+            return []
+        view_dir, n, eta, c, k = self.refraction_frame(hit_record)
+        if k < 0:
+            return []
+        # transmission component
+        refract_dir =  (-view_dir * eta  + n * (eta * c - math.sqrt(k))).normalize()
+        transmission_ray = Ray(hit_record.point, refract_dir, hit_record.ray.depth + 1,
+                               hit_record.ray.throughput * self.transmission_coefficient,
+                               hit_record.footprint, hit_record.ray.cone_spread)
+        return [(transmission_ray, self.transmission_coefficient)]
+
+    def shade(self, hit_record, scene):
+        shaded_color = self.local(hit_record, scene)
+        for ray, weight in scene.surviving(self.scatter(hit_record, scene)):
+            shaded_color += scene.trace(ray) * weight
+        return shaded_color
@@ -0,0 +1,71 @@
+import copy
+
+import numpy as np
+
+from .shapes import Plane, PlaneUV
+from .materials import ReflectiveMaterial
+from .rasterizer import rasterize, primary_hit
+
+# Reflections off planar mirrors. A camera ray reflected by a plane is a ray
+# of the camera mirrored by that plane, through the same film position, so
+# the reflected view can be rasterized once from the mirrored camera (keeping
+# only what lies in front of the mirror) and each reflected ray looked up in
+# it like a camera ray (see rasterizer.primary_hit): only pixels where shapes
+# meet, or where the buffer's shape is missed, trace the whole scene.
+# Rays reflected again by another mirror use the camera mirrored twice, and
+# so on up to the number of levels built. Rays keep their film position and
+# the mirrors they bounced off (Ray.pixel, Ray.mirrors).
+
+def _reflect(vector, normal):
+    return vector - normal * (2 * vector.dot(normal))
+
+def mirrored_camera(camera, plane):
+    # the camera seen in the plane: its axes flip handedness, which the
+    # rasterizer does not mind
+    mirrored = copy.copy(camera)
+    mirrored.eye = plane.point + _reflect(camera.eye - plane.point, plane.normal)
+    mirrored.u = _reflect(camera.u, plane.normal)
+    mirrored.v = _reflect(camera.v, plane.normal)
+    mirrored.w = _reflect(camera.w, plane.normal)
+    return mirrored
+
+def planar_mirrors(scene):
+    # planes with a reflective material
+    pairs = {id(shape): (shape, material) for shape, material in scene.camera_visible + scene.reflection_visible}
+    return [shape for shape, material in pairs.values()
+            if isinstance(shape, (Plane, PlaneUV)) and isinstance(material, ReflectiveMaterial)]
+
+class MirrorViews:
+    def __init__(self, scene, camera, levels):
+        # visibility buffers of the mirrored cameras, keyed by the mirrors
+        # the rays bounced off, in order
+        self.views = dict()
+        mirrors = planar_mirrors(scene)
+        level = [((), camera, rasterize(scene, camera))]
+        for _ in range(levels):
+            next_level = []
+            for chain, view_camera, vis in level:
+                seen = {id(vis.pairs[k][0]) for k in np.unique(vis.ids) if k >= 0}
+                for mirror in mirrors:
+                    if id(mirror) not in seen or (chain and chain[-1] is mirror):
+                        continue
+                    # the mirror only reflects on the side its normal points to
+                    if (view_camera.eye - mirror.point).dot(mirror.normal) <= 0:
+                        continue
+                    mirrored = mirrored_camera(view_camera, mirror)
+                    mirror_vis = rasterize(scene, mirrored, scene.reflection_visible, (mirror.point, mirror.normal))
+                    self.views[chain + (mirror,)] = mirror_vis
+                    next_level.append((chain + (mirror,), mirrored, mirror_vis))
+            level = next_level
+
+    def hit(self, scene, ray):
+        vis = self.views.get(ray.mirrors)
+        if vis is None:
+            return scene.hit_candidates(ray, scene.candidates(ray))
+        return primary_hit(scene, vis, ray, *ray.pixel)
+
+    def ambiguous(self):
+        # fraction of the pixels of the views that are traced
+        if not self.views:
+            return 0.0
+        return float(np.mean([vis.ambiguous.mean() for vis in self.views.values()]))
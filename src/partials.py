@@ -0,0 +1,93 @@
+import json
+import random
+import hashlib
+import inspect
+
+import numpy as np
+
+from . import film
+
+# Partial renders: the unresolved film of a run (the weighted sums of the
+# samples and their weights for every pixel, optionally the weighted sums of
+# their squares) with a header saying what was rendered. Runs of the same
+# scene and settings with different seeds draw independent samples, so their
+# partials simply add up: merged sums over merged weights is the image all
+# their samples would have made together, whatever each run's sample count.
+
+FormatVersion = 1
+# settings the samples depend on: runs that differ in any of them cannot be
+# merged. The sample count and the engine may differ, they only change how
+# many samples there are and how they are traced
+HashedSettings = ('filter', 'filter_radius', 'light_samples', 'min_throughput', 'roulette')
+
+def scene_hash(module, width, height, settings):
+    # hash of the scene source and of the settings the image depends on
+    digest = hashlib.sha256()
+    with open(inspect.getsourcefile(module), 'rb') as f:
+        digest.update(f.read())
+    key = dict(width=width, height=height, **{name: settings[name] for name in HashedSettings})
+    digest.update(json.dumps(key, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def seed_tile(seed, tile):
+    # the random streams of a tile only depend on the run seed and the tile,
+    # whichever worker renders it and in which order
+    i0, _, j0, _ = tile
+    np.random.seed([seed, i0, j0])
+    random.seed(f'{seed}/{i0}/{j0}')
+
+def save_partial(path, header, sums, weights, squares=None):
+    arrays = dict(sums=sums.astype(np.float32), weights=weights.astype(np.float32))
+    if squares is not None:
+        arrays['squares'] = squares.astype(np.float32)
+    header = dict(header, version=FormatVersion, squares=squares is not None)
+    with open(path, 'wb') as f:
+        np.savez(f, header=np.array(json.dumps(header)), **arrays)
+
+def load_partial(path):
+    # header, sums, weights and squares (None if the run did not keep them)
+    with np.load(path) as data:
+        header = json.loads(str(data['header']))
+        if header.get('version') != FormatVersion:
+            raise ValueError(f"'{path}' is not a partial render of version {FormatVersion}")
+        squares = data['squares'] if header['squares'] else None
+        return header, data['sums'], data['weights'], squares
+
+def merge_partials(paths):
+    # one partial holding the samples of all of them
+    header, sums, weights, squares = None, None, None, None
+    for path in paths:
+        other, other_sums, other_weights, other_squares = load_partial(path)
+        if header is None:
+            header = dict(other, sources=[])
+            sums, weights = other_sums.astype(np.float64), other_weights.astype(np.float64)
+            squares = None if other_squares is None else other_squares.astype(np.float64)
+        else:
+            if other['scene_hash'] != header['scene_hash']:
+                raise ValueError(f"'{path}' is a render of another scene or with other settings "
+                                 f"({other['scene']}, {other['width']}x{other['height']})")
+            # the same seed means the same samples: counting them twice would
+            # only hide the noise
+            overlap = set(other['seeds']) & set(header['seeds'])
+            if overlap:
+                raise ValueError(f"'{path}' repeats the samples of seeds {sorted(overlap)}, render with another --seed")
+            sums += other_sums
+            weights += other_weights
+            header['seeds'] = header['seeds'] + other['seeds']
+            header['num_samples'] += other['num_samples']
+            # the sums of squares are only kept if every partial has them
+            squares = None if squares is None or other_squares is None else squares + other_squares
+        header['sources'].append(path)
+    if header is None:
+        raise ValueError("No partial renders to merge")
+    header['squares'] = squares is not None
+    return header, sums, weights, squares
+
+def resolve(sums, weights):
+    # weighted mean of the samples of every pixel, black where there are none
+    return film.resolve(sums, weights, np.float32)
+
+def variance(sums, squares, weights):
+    # weighted variance of the samples of every pixel
+    mean = resolve(sums, weights)
+    return np.maximum(resolve(squares, weights) - mean * mean, 0)
@@ -0,0 +1,259 @@
+import math
+
+import numpy as np
+
+from .base import CastEpsilon
+from .shapes import Ball, Cube, Cilinder, Plane, PlaneUV, Translate, ObjectTransform
+
+# Z-buffer rasterizer for primary visibility. The camera visible shapes are
+# tessellated into triangles and rasterized at the pixel centers, giving a
+# visibility buffer with the shape, distance and normal seen through every
+# pixel. Camera rays then only test the shape found there instead of the
+# whole scene (see primary_hit).
+#
+# Curved shapes are tessellated slightly outside their surface, so the mesh
+# contains the shape; implicit surfaces are drawn as their bounding cube.
+# Pixels on the border between two shapes (or the background) are marked
+# ambiguous and traced as usual, as are rays whose shape turns out to be
+# missed. Shapes that cannot be tessellated (paraboloids) are tested by
+# every camera ray. Objects thinner than a pixel that fall between pixel
+# centers can still be missed.
+
+SphereSegments = 48
+CylinderSegments = 48
+# half size of the quad that stands for an infinite plane, relative to the
+# distance from the eye: its far edge lies well within a pixel of the horizon
+PlaneExtent = 1e4
+NearPlane = 1e-4
+
+def _sphere(center, radius):
+    rings, segments = SphereSegments // 2, SphereSegments
+    # circumscribed: vertices pushed out so the flat faces stay outside the sphere
+    radius = radius / (math.cos(math.pi / rings) * math.cos(math.pi / segments))
+    theta = np.linspace(0, math.pi, rings + 1)
+    phi = np.linspace(0, 2 * math.pi, segments, endpoint=False)
+    theta, phi = np.meshgrid(theta, phi, indexing='ij')
+    vertices = np.stack([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)], axis=-1)
+    vertices = vertices.reshape(-1, 3) * radius + np.array(center.as_list())
+    r, s = np.meshgrid(np.arange(rings), np.arange(segments), indexing='ij')
+    a, b = (r * segments + s).ravel(), (r * segments + (s + 1) % segments).ravel()
+    c, d = a + segments, b + segments
+    triangles = np.stack([np.stack([a, c, b], axis=1), np.stack([b, c, d], axis=1)], axis=1)
+    return vertices, triangles.reshape(-1, 3)
+
+def _cube(size):
+    h = size / 2
+    vertices = np.array([(x, y, z) for x in (-h, h) for y in (-h, h) for z in (-h, h)])
+    faces = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+    triangles = [tri for a, b, c, d in faces for tri in ((a, b, c), (a, c, d))]
+    return vertices, np.array(triangles)
+
+def _cylinder(radius, height):
+    n = CylinderSegments
+    radius = radius / math.cos(math.pi / n)
+    phi = np.linspace(0, 2 * math.pi, n, endpoint=False)
+    ring = np.stack([radius * np.cos(phi), radius * np.sin(phi)], axis=-1)
+    bottom = np.hstack([ring, np.full((n, 1), -height / 2)])
+    top = np.hstack([ring, np.full((n, 1), height / 2)])
+    vertices = np.vstack([bottom, top, [(0, 0, -height / 2), (0, 0, height / 2)]])
+    triangles = []
+    for s in range(n):
+        a, b = s, (s + 1) % n
+        triangles += [(a, b, a + n), (b, b + n, a + n), (2 * n, b, a), (2 * n + 1, a + n, b + n)]
+    return vertices, np.array(triangles)
+
+def _plane(point, normal, eye):
+    # a large quad around the point of the plane closest to the eye
+    normal = np.array(normal.as_list())
+    eye = np.array(eye.as_list())
+    distance = np.dot(eye - np.array(point.as_list()), normal)
+    foot = eye - normal * distance
+    extent = PlaneExtent * max(abs(distance), 1.0)
+    helper = np.array([1.0, 0, 0]) if abs(normal[0]) < 0.9 else np.array([0, 1.0, 0])
+    tangent = np.cross(normal, helper)
+    tangent /= np.linalg.norm(tangent)
+    bitangent = np.cross(normal, tangent)
+    corners = [foot + extent * (sx * tangent + sy * bitangent) for sx, sy in ((-1, -1), (1, -1), (1, 1), (-1, 1))]
+    return np.array(corners), np.array([(0, 1, 2), (0, 2, 3)])
+
+def tessellate(shape, camera):
+    # (vertices, triangles) of a shape in world space, or None
+    if isinstance(shape, Ball):
+        return _sphere(shape.center, shape.radius)
+    if isinstance(shape, Cube):
+        return _cube(shape.size)
+    if isinstance(shape, Cilinder):
+        return _cylinder(shape.radius, shape.height)
+    if isinstance(shape, (Plane, PlaneUV)):
+        return _plane(shape.point, shape.normal, camera.eye)
+    if isinstance(shape, Translate):
+        mesh = tessellate(shape.shape, camera)
+        if mesh is None:
+            return None
+        return mesh[0] + np.array(shape.offset.as_list()), mesh[1]
+    if isinstance(shape, ObjectTransform):
+        mesh = tessellate(shape.shape, camera)
+        if mesh is None:
+            return None
+        return mesh[0] @ shape.transform_func.T, mesh[1]
+    if isinstance(getattr(shape, 'bounding_box', None), Cube):
+        # implicit surfaces: their bounding cube contains them
+        return _cube(shape.bounding_box.size)
+    return None
+
+def convex(shape):
+    # whether the mesh of tessellate is the shape's own convex outline
+    if isinstance(shape, (Translate, ObjectTransform)):
+        return convex(shape.shape)
+    return isinstance(shape, (Ball, Cube, Cilinder, Plane, PlaneUV))
+
+class VisBuffer:
+    def __init__(self, width, height):
+        # index in pairs of the shape seen through each pixel center, -1 for none
+        self.ids = np.full((height, width), -1)
+        self.t = np.full((height, width), np.inf)
+        self.normals = np.zeros((height, width, 3))
+        self.ambiguous = np.ones((height, width), dtype=bool)
+        self.pairs = []  # rasterized (shape, material)
+        self.extras = []  # camera visible (shape, material) that were not rasterized
+
+def _clip_near(polygon, w, eye, near):
+    # Sutherland-Hodgman against the plane at distance near in front of the eye
+    depth = lambda p: -np.dot(p - eye, w)
+    clipped = []
+    for k in range(len(polygon)):
+        p, q = polygon[k], polygon[(k + 1) % len(polygon)]
+        dp, dq = depth(p), depth(q)
+        if dp >= near:
+            clipped.append(p)
+        if (dp >= near) != (dq >= near):
+            clipped.append(p + (q - p) * ((near - dp) / (dq - dp)))
+    return clipped
+
+# (triangle, pixel) pairs tested at once by rasterize
+PairsPerBatch = 1 << 20
+
+def _screen_boxes(camera, tris, eye, u, v, w):
+    # inclusive pixel ranges (i0, i1, j0, j1) of the pixel centers each
+    # triangle may cover; triangles crossing the near plane are clipped first
+    boxes = np.zeros((len(tris), 4), dtype=int)
+    boxes[:, [1, 3]] = -1  # empty
+    rel = tris - eye
+    z = -rel @ w
+    front = (z >= NearPlane).all(axis=1)
+    if front.any():
+        boxes[front] = _polygon_boxes(camera, rel[front], u, v, w)
+    for k in np.flatnonzero(~front & (z >= NearPlane).any(axis=1)):
+        polygon = np.array(_clip_near(list(tris[k]), w, eye, NearPlane))
+        boxes[k] = _polygon_boxes(camera, (polygon - eye)[None], u, v, w)[0]
+    return boxes
+
+def _polygon_boxes(camera, rel, u, v, w):
+    # (N, 4) boxes of N polygons given by their vertices relative to the eye, (N, V, 3)
+    width, height = camera.img_width, camera.img_height
+    z = -rel @ w
+    px = ((rel @ u) / z + camera.su / 2) * width / camera.su - 0.5
+    py = ((rel @ v) / z + camera.sv / 2) * height / camera.sv - 0.5
+    return np.stack([np.maximum(np.floor(py.min(axis=1)), 0),
+                     np.minimum(np.ceil(py.max(axis=1)), height - 1),
+                     np.maximum(np.floor(px.min(axis=1)), 0),
+                     np.minimum(np.ceil(px.max(axis=1)), width - 1)], axis=1).astype(int)
+
+def rasterize(scene, camera, pairs=None, clip=None):
+    # pairs are the (shape, material) to draw, by default the camera visible
+    # ones. clip is an optional (point, normal) plane: only surfaces on the
+    # side the normal points to are drawn
+    if getattr(camera, 'radius', 0) > 0:
+        raise ValueError("Primary rasterization needs a pinhole camera (rays from a lens do not start at the eye)")
+    width, height = camera.img_width, camera.img_height
+    vis = VisBuffer(width, height)
+    eye = np.array(camera.eye.as_list())
+    u, v, w = (np.array(axis.as_list()) for axis in (camera.u, camera.v, camera.w))
+    if clip is not None:
+        clip_point, clip_normal = (np.array(a.as_list()) for a in clip)
+
+    # unit directions through the pixel centers, as in Camera.ray
+    xs = camera.su * (np.arange(width) + 0.5) / width - camera.su / 2
+    ys = camera.sv * (np.arange(height) + 0.5) / height - camera.sv / 2
+    directions = ys[:, None, None] * v + xs[None, :, None] * u - w
+    directions /= np.linalg.norm(directions, axis=2, keepdims=True)
+    directions = directions.reshape(-1, 3)
+    depth, ids, normals = vis.t.reshape(-1), vis.ids.reshape(-1), vis.normals.reshape(-1, 3)
+
+    for shape, material in scene.camera_visible if pairs is None else pairs:
+        mesh = tessellate(shape, camera)
+        if mesh is None:
+            vis.extras.append((shape, material))
+            continue
+        shape_id = len(vis.pairs)
+        vis.pairs.append((shape, material))
+        vertices, triangles = mesh
+        tris = vertices[triangles]
+        e1, e2 = tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0]
+        face_normals = np.cross(e1, e2)
+        lengths = np.linalg.norm(face_normals, axis=1)
+        keep = lengths > 0  # drop degenerate triangles (sphere poles)
+        tris, e1, e2 = tris[keep], e1[keep], e2[keep]
+        face_normals = face_normals[keep] / lengths[keep, None]
+
+        boxes = _screen_boxes(camera, tris, eye, u, v, w)
+        rows = np.maximum(boxes[:, 1] - boxes[:, 0] + 1, 0)
+        cols = np.maximum(boxes[:, 3] - boxes[:, 2] + 1, 0)
+        counts = rows * cols
+        order = np.flatnonzero(counts)
+        # every triangle against every pixel center of its box, in batches
+        while len(order):
+            take = max(1, np.searchsorted(np.cumsum(counts[order]), PairsPerBatch))
+            batch, order = order[:take], order[take:]
+            tri = np.repeat(batch, counts[batch])
+            offset = np.arange(len(tri)) - np.repeat(np.cumsum(counts[batch]) - counts[batch], counts[batch])
+            pixel = (boxes[tri, 0] + offset // cols[tri]) * width + boxes[tri, 2] + offset % cols[tri]
+
+            # Moller-Trumbore
+            d = directions[pixel]
+            pvec = np.cross(d, e2[tri])
+            det = np.einsum('ij,ij->i', pvec, e1[tri])
+            valid = np.abs(det) > 1e-12
+            inv = np.where(valid, 1.0 / np.where(valid, det, 1.0), 0)
+            tvec = eye - tris[tri, 0]
+            bu = np.einsum('ij,ij->i', pvec, tvec) * inv
+            qvec = np.cross(tvec, e1[tri])
+            bv = np.einsum('ij,ij->i', d, qvec) * inv
+            t = np.einsum('ij,ij->i', e2[tri], qvec) * inv
+            hit = valid & (bu >= 0) & (bv >= 0) & (bu + bv <= 1) & (t > CastEpsilon)
+            if clip is not None:
+                points = eye + d[hit] * t[hit, None]
+                hit[hit] = (points - clip_point) @ clip_normal > CastEpsilon
+            hit[hit] = t[hit] < depth[pixel[hit]]
+            # farthest first, so the closest write to a pixel is the last one
+            closest = np.flatnonzero(hit)[np.argsort(-t[hit])]
+            depth[pixel[closest]] = t[closest]
+            ids[pixel[closest]] = shape_id
+            normals[pixel[closest]] = face_normals[tri[closest]]
+
+    # a pixel is trusted when it and its 8 neighbours see the same shape,
+    # and that shape's mesh follows its surface: another shape could lie
+    # between a bounding cube and the surface inside
+    padded = np.pad(vis.ids, 1, mode='edge')
+    same = np.ones((height, width), dtype=bool)
+    for di in range(3):
+        for dj in range(3):
+            same &= padded[di:di + height, dj:dj + width] == vis.ids
+    loose = [k for k, (shape, _) in enumerate(vis.pairs) if not convex(shape)]
+    vis.ambiguous = ~same | np.isin(vis.ids, loose)
+    return vis
+
+def primary_hit(scene, vis, ray, x, y):
+    # closest hit of a ray of the rasterized camera through film position (x, y)
+    i = min(int(y), vis.ids.shape[0] - 1)
+    j = min(int(x), vis.ids.shape[1] - 1)
+    if vis.ambiguous[i, j]:
+        return scene.hit_candidates(ray, scene.candidates(ray))
+    if vis.ids[i, j] < 0:
+        # background: only the shapes that were not rasterized can be there
+        return scene.hit_candidates(ray, vis.extras)
+    hit_rec = scene.hit_candidates(ray, [vis.pairs[vis.ids[i, j]]] + vis.extras)
+    if not hit_rec.hit:
+        # the mesh is slightly larger than the shape
+        return scene.hit_candidates(ray, scene.candidates(ray))
+    return hit_rec
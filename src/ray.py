@@ -1,8 +1,28 @@
 class Ray:
-    def __init__(self, origin, direction, depth=0):
+    def __init__(self, origin, direction, depth=0, throughput=1.0, cone_width=0.0, cone_spread=0.0, differentials=None):
         self.origin = origin
         self.direction = direction.normalize()
         self.depth = depth  # for recursion depth if needed
+        self.throughput = throughput  # product of the weights along the path
+        # ray cone: the width of the pixel footprint at the origin and its
+        # growth per unit of distance, used to filter textures
+        self.cone_width = cone_width
+        self.cone_spread = cone_spread
+        # camera rays: changes of the direction for one pixel step in x and
+        # in y (only their part orthogonal to the direction matters)
+        self.differentials = differentials
+        # film position of the camera ray this ray continues, and the planar
+        # mirrors it bounced off since (see mirrors.py)
+        self.pixel = None
+        self.mirrors = ()
+
+    def scale_differentials(self, scale):
+        # footprint of one of several samples per pixel: n jittered samples
+        # each cover about 1/sqrt(n) of the pixel along x and y
+        self.cone_spread *= scale
+        if self.differentials is not None:
+            self.differentials = tuple(d * scale for d in self.differentials)
+        return self
 
     def point_at_parameter(self, t):
         return self.origin + self.direction * t
\ No newline at end of file
@@ -0,0 +1,517 @@
+import math
+import os
+import keyword
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .base import BaseScene, Color
+from .vector3d import Vector3D
+from .camera import Camera
+from .light import AreaLight
+from .shapes import Ball, Cube, PlaneUV, ObjectTransform, Translate, Cilinder
+from .materials import SimpleMaterialWithShadows, CheckerboardMaterial, ReflectiveMaterial
+
+# Scene description edited by app.py, and its export to a scene module that
+# raster.py renders. Kept apart from the GUI so the render daemon can build
+# scenes from specs sent as JSON (see spec_from_dict and build_scene).
+
+
+# -----------------------------
+# Data model
+# -----------------------------
+
+
+def _clamp01(x: float) -> float:
+    return max(0.0, min(1.0, float(x)))
+
+
+@dataclass
+class Vec3:
+    x: float = 0.0
+    y: float = 0.0
+    z: float = 0.0
+
+
+@dataclass
+class Color3:
+    r: float = 1.0
+    g: float = 1.0
+    b: float = 1.0
+
+
+@dataclass
+class Transform:
+    translate: Vec3 = field(default_factory=Vec3)
+    scale: Vec3 = field(default_factory=lambda: Vec3(1.0, 1.0, 1.0))
+    rot_z_deg: float = 0.0
+
+
+@dataclass
+class MaterialSpec:
+    kind: str = "matte"  # matte | checker | mirror
+    params: Dict[str, float] = field(default_factory=dict)
+
+
+@dataclass
+class ObjectSpec:
+    name: str
+    kind: str  # ball | cube | planeuv | cilinder
+    params: Dict[str, float] = field(default_factory=dict)
+    transform: Transform = field(default_factory=Transform)
+    material: MaterialSpec = field(default_factory=MaterialSpec)
+    casts_shadows: bool = True
+    visible_to_camera: bool = True
+    visible_in_reflections: bool = True
+
+
+@dataclass
+class CameraSpec:
+    eye: Vec3 = field(default_factory=lambda: Vec3(12, 12, 4))
+    look_at: Vec3 = field(default_factory=lambda: Vec3(0, 0, 2.5))
+    up: Vec3 = field(default_factory=lambda: Vec3(0, 0, 1))
+    fov: float = 45.0
+    img_width: int = 200
+    img_height: int = 200
+
+
+@dataclass
+class LightSpec:
+    kind: str = "area"  # area only in this app
+    position: Vec3 = field(default_factory=lambda: Vec3(10, 5, 15))
+    look_at: Vec3 = field(default_factory=lambda: Vec3(0, 0, 0))
+    up: Vec3 = field(default_factory=lambda: Vec3(1, 1, 1))
+    width: float = 4.0
+    height: float = 4.0
+    color: Color3 = field(default_factory=lambda: Color3(0.8, 0.6, 0.6))
+    intensity: float = 1.7
+    shadow_samples: int = 1
+
+
+@dataclass
+class SceneSpec:
+    name: str = "Editor Scene"
+    background: Color3 = field(default_factory=lambda: Color3(0.7, 0.8, 0.95))
+    ambient_light: Color3 = field(default_factory=lambda: Color3(0.1, 0.1, 0.1))
+    max_depth: int = 4
+    camera: CameraSpec = field(default_factory=CameraSpec)
+    light: LightSpec = field(default_factory=LightSpec)
+    objects: List[ObjectSpec] = field(default_factory=list)
+
+
+# -----------------------------
+# Camera navigation (viewport mouse)
+# -----------------------------
+
+
+def _sub(a: Vec3, b: Vec3) -> Vec3:
+    return Vec3(a.x - b.x, a.y - b.y, a.z - b.z)
+
+
+def _add(a: Vec3, b: Vec3) -> Vec3:
+    return Vec3(a.x + b.x, a.y + b.y, a.z + b.z)
+
+
+def _mul(a: Vec3, k: float) -> Vec3:
+    return Vec3(a.x * k, a.y * k, a.z * k)
+
+
+def _dot(a: Vec3, b: Vec3) -> float:
+    return a.x * b.x + a.y * b.y + a.z * b.z
+
+
+def _cross(a: Vec3, b: Vec3) -> Vec3:
+    return Vec3(a.y * b.z - a.z * b.y, a.z * b.x - a.x * b.z, a.x * b.y - a.y * b.x)
+
+
+def _unit(a: Vec3) -> Vec3:
+    return _mul(a, 1.0 / max(math.sqrt(_dot(a, a)), 1e-12))
+
+
+def _rotate(v: Vec3, axis: Vec3, angle: float) -> Vec3:
+    # Rodrigues, axis of unit length
+    c, s = math.cos(angle), math.sin(angle)
+    return _add(_add(_mul(v, c), _mul(_cross(axis, v), s)), _mul(axis, _dot(axis, v) * (1 - c)))
+
+
+def orbit_camera(cam: CameraSpec, yaw_deg: float, pitch_deg: float) -> None:
+    # turns the eye around look_at: yaw about the up vector, pitch towards it,
+    # never over the poles
+    up = _unit(cam.up)
+    offset = _rotate(_sub(cam.eye, cam.look_at), up, math.radians(yaw_deg))
+    distance = math.sqrt(_dot(offset, offset))
+    elevation = math.degrees(math.asin(max(-1.0, min(1.0, _dot(offset, up) / max(distance, 1e-12)))))
+    pitch_deg = max(-89.0 - elevation, min(89.0 - elevation, pitch_deg))
+    right = _unit(_cross(offset, up))
+    offset = _rotate(offset, right, math.radians(pitch_deg))
+    cam.eye = _add(cam.look_at, offset)
+
+
+def pan_camera(cam: CameraSpec, dx: float, dy: float) -> None:
+    # moves eye and look_at together; dx, dy in fractions of the image width,
+    # so the point under the mouse follows it at the look_at distance
+    forward = _sub(cam.look_at, cam.eye)
+    distance = math.sqrt(_dot(forward, forward))
+    right = _unit(_cross(forward, cam.up))
+    up = _unit(_cross(right, forward))
+    span = 2 * distance * math.tan(math.radians(cam.fov) / 2)
+    move = _add(_mul(right, -dx * span), _mul(up, dy * span))
+    cam.eye = _add(cam.eye, move)
+    cam.look_at = _add(cam.look_at, move)
+
+
+def zoom_camera(cam: CameraSpec, factor: float) -> None:
+    # scales the eye distance to look_at (dolly), factor < 1 moves closer
+    offset = _sub(cam.eye, cam.look_at)
+    distance = math.sqrt(_dot(offset, offset))
+    factor = max(factor, 1e-3 / max(distance, 1e-12))
+    cam.eye = _add(cam.look_at, _mul(offset, factor))
+
+
+# -----------------------------
+# Exporter (.py scene)
+# -----------------------------
+
+
+def _py_vec3(v: Vec3) -> str:
+    return f"Vector3D({v.x:.6g}, {v.y:.6g}, {v.z:.6g})"
+
+
+def _py_color(c: Color3) -> str:
+    return f"Color({c.r:.6g}, {c.g:.6g}, {c.b:.6g})"
+
+
+def _rot_z_matrix(theta_deg: float) -> List[List[float]]:
+    t = math.radians(theta_deg)
+    c = math.cos(t)
+    s = math.sin(t)
+    return [[c, -s, 0.0], [s, c, 0.0], [0.0, 0.0, 1.0]]
+
+
+def _scale_matrix(s: Vec3) -> List[List[float]]:
+    return [[s.x, 0.0, 0.0], [0.0, s.y, 0.0], [0.0, 0.0, s.z]]
+
+
+def _matmul3(a: List[List[float]], b: List[List[float]]) -> List[List[float]]:
+    out = [[0.0, 0.0, 0.0] for _ in range(3)]
+    for i in range(3):
+        for j in range(3):
+            out[i][j] = sum(a[i][k] * b[k][j] for k in range(3))
+    return out
+
+
+# parameters of each kind and their defaults; unknown kinds are the last one
+_MaterialDefaults = {
+    "matte": dict(ambient=0.12, diffuse=0.9, specular=0.15, shininess=32.0, dr=0.7, dg=0.2, db=0.2),
+    "checker": dict(ambient=1.0, diffuse=0.9, square_size=1.0),
+    "mirror": dict(reflection=1.0),
+}
+_ShapeDefaults = {
+    "ball": dict(radius=1.0),
+    "cube": dict(size=1.0),
+    "cilinder": dict(radius=0.5, height=2.0),
+    "planeuv": dict(px=0.0, py=0.0, pz=0.0, nx=0.0, ny=0.0, nz=1.0, fx=1.0, fy=0.0, fz=0.0),
+}
+
+
+def _values(kind: str, params: Dict[str, float], defaults: Dict[str, Dict[str, float]]) -> Tuple[str, Dict[str, float]]:
+    if kind not in defaults:
+        kind = list(defaults)[-1]
+    return kind, {name: float(params.get(name, value)) for name, value in defaults[kind].items()}
+
+
+def _material_values(mat: MaterialSpec) -> Tuple[str, Dict[str, float]]:
+    return _values(mat.kind, mat.params, _MaterialDefaults)
+
+
+def _shape_values(obj: ObjectSpec) -> Tuple[str, Dict[str, float]]:
+    return _values(obj.kind, obj.params, _ShapeDefaults)
+
+
+def _object_transform(obj: ObjectSpec) -> Optional[Tuple[List[List[float]], Optional[Vec3]]]:
+    # linear matrix and translation (None when zero) of an object;
+    # for PlaneUV, keep as-is (more predictable)
+    if _shape_values(obj)[0] == "planeuv":
+        return None
+    t = obj.transform
+    # build linear matrix = Rz @ S
+    # (consistent with your existing scenes: rot_z(...) @ scale3(...))
+    s = t.scale
+    # avoid singular matrices
+    sx, sy, sz = (float(x) if abs(float(x)) >= 1e-8 else 1e-3 for x in (s.x, s.y, s.z))
+    M = _matmul3(_rot_z_matrix(float(t.rot_z_deg)), _scale_matrix(Vec3(sx, sy, sz)))
+    tr = t.translate
+    if abs(tr.x) > 1e-12 or abs(tr.y) > 1e-12 or abs(tr.z) > 1e-12:
+        return M, tr
+    return M, None
+
+
+def _object_flags(obj: ObjectSpec) -> Dict[str, bool]:
+    return dict(casts_shadows=bool(obj.casts_shadows), visible_to_camera=bool(obj.visible_to_camera),
+                visible_in_reflections=bool(obj.visible_in_reflections))
+
+
+def _check_name(name: str) -> None:
+    # object names become variable names of the exported module
+    if not isinstance(name, str) or not name.isidentifier() or keyword.iskeyword(name):
+        raise ValueError(f"Object name {name!r} is not a valid Python identifier")
+
+
+def scene_source(scene: SceneSpec, module_name: str) -> str:
+    lines: List[str] = []
+    lines.append(
+        "\n".join(
+            [
+                '"""Auto-generated by app.py scene editor.',
+                "",
+                "Do not edit by hand unless you know what you're doing.",
+                f"Module name: {module_name}",
+                '"""',
+            ]
+        )
+    )
+    lines.append("import math")
+    lines.append("import numpy as np")
+    lines.append("from src.base import BaseScene, Color")
+    lines.append("from src.vector3d import Vector3D")
+    lines.append("from src.camera import Camera")
+    lines.append("from src.light import AreaLight")
+    lines.append(
+        "from src.shapes import Ball, Cube, PlaneUV, ObjectTransform, Translate, Cilinder"
+    )
+    lines.append(
+        "from src.materials import SimpleMaterialWithShadows, CheckerboardMaterial, ReflectiveMaterial"
+    )
+    lines.append("")
+
+    lines.append("def _m(m):")
+    lines.append("    return np.array(m, dtype=float)")
+    lines.append("")
+
+    lines.append("class Scene(BaseScene):")
+    lines.append("    def __init__(self):")
+    lines.append(f"        super().__init__({scene.name!r})")
+    lines.append(f"        self.background = {_py_color(scene.background)}")
+    lines.append(f"        self.ambient_light = {_py_color(scene.ambient_light)}")
+    lines.append(f"        self.max_depth = {int(scene.max_depth)}")
+
+    cam = scene.camera
+    lines.append(
+        "        self.camera = Camera(\n"
+        f"            eye={_py_vec3(cam.eye)},\n"
+        f"            look_at={_py_vec3(cam.look_at)},\n"
+        f"            up={_py_vec3(cam.up)},\n"
+        f"            fov={float(cam.fov):.6g},\n"
+        f"            img_width={int(cam.img_width)},\n"
+        f"            img_height={int(cam.img_height)},\n"
+        "        )"
+    )
+
+    li = scene.light
+    lines.append("        self.lights = [AreaLight(")
+    lines.append(f"            position={_py_vec3(li.position)},")
+    lines.append(f"            look_at={_py_vec3(li.look_at)},")
+    lines.append(f"            up={_py_vec3(li.up)},")
+    lines.append(f"            width={float(li.width):.6g},")
+    lines.append(f"            height={float(li.height):.6g},")
+    lines.append(f"            color={_py_color(li.color)},")
+    lines.append(f"            intensity={float(li.intensity):.6g},")
+    lines.append(f"            shadow_samples={int(li.shadow_samples)})]")
+    lines.append("")
+
+    for obj in scene.objects:
+        _check_name(obj.name)
+        # materials (per-object, simple + deterministic)
+        kind, v = _material_values(obj.material)
+        if kind == "matte":
+            lines.append(
+                f"        _mat_{obj.name} = SimpleMaterialWithShadows({v['ambient']:.6g}, {v['diffuse']:.6g}, Color({v['dr']:.6g}, {v['dg']:.6g}, {v['db']:.6g}), {v['specular']:.6g}, Color(1,1,1), {v['shininess']:.6g})"
+            )
+        elif kind == "checker":
+            lines.append(
+                f"        _mat_{obj.name} = CheckerboardMaterial({v['ambient']:.6g}, {v['diffuse']:.6g}, {v['square_size']:.6g})"
+            )
+        else:  # mirror
+            lines.append(
+                f"        _mat_{obj.name} = ReflectiveMaterial(0.0, 0.0, Color(0,0,0), 0.0, Color(0,0,0), reflection_coefficient={v['reflection']:.6g})"
+            )
+
+        # shapes
+        kind, v = _shape_values(obj)
+        if kind == "ball":
+            lines.append(f"        _shape_{obj.name} = Ball(center=Vector3D(0,0,0), radius={v['radius']:.6g})")
+        elif kind == "cube":
+            lines.append(f"        _shape_{obj.name} = Cube(size={v['size']:.6g})")
+        elif kind == "cilinder":
+            lines.append(f"        _shape_{obj.name} = Cilinder(radius={v['radius']:.6g}, height={v['height']:.6g})")
+        else:  # planeuv
+            lines.append(
+                "        _shape_%s = PlaneUV(point=Vector3D(%.6g, %.6g, %.6g), normal=Vector3D(%.6g, %.6g, %.6g), forward_direction=Vector3D(%.6g, %.6g, %.6g))"
+                % ((obj.name,) + tuple(v[k] for k in ("px", "py", "pz", "nx", "ny", "nz", "fx", "fy", "fz")))
+            )
+
+        transform = _object_transform(obj)
+        if transform is not None:
+            M, tr = transform
+            lines.append(f"        _shape_{obj.name} = ObjectTransform(_shape_{obj.name}, _m({M}))")
+            if tr is not None:
+                lines.append(
+                    f"        _shape_{obj.name} = Translate(_shape_{obj.name}, Vector3D({tr.x:.6g}, {tr.y:.6g}, {tr.z:.6g}))"
+                )
+
+        # visibility flags are only written when they differ from the defaults
+        flags = "".join(f", {name}=False" for name, value in _object_flags(obj).items() if not value)
+        lines.append(f"        self.add(_shape_{obj.name}, _mat_{obj.name}{flags})")
+        lines.append("")
+
+    return "\n".join(lines) + "\n"
+
+
+def export_scene_py(scene: SceneSpec, out_path: str) -> None:
+    module_name = os.path.splitext(os.path.basename(out_path))[0]
+    with open(out_path, "w", encoding="utf-8") as f:
+        f.write(scene_source(scene, module_name))
+
+
+# -----------------------------
+# Specs without a module
+# -----------------------------
+
+
+def spec_from_dict(data: Dict) -> SceneSpec:
+    # inverse of dataclasses.asdict, for specs sent as JSON
+    def vec3(d: Dict) -> Vec3:
+        return Vec3(**d)
+
+    def color(d: Dict) -> Color3:
+        return Color3(**d)
+
+    cam = dict(data.get("camera", {}))
+    for key in ("eye", "look_at", "up"):
+        if key in cam:
+            cam[key] = vec3(cam[key])
+    li = dict(data.get("light", {}))
+    for key in ("position", "look_at", "up"):
+        if key in li:
+            li[key] = vec3(li[key])
+    if "color" in li:
+        li["color"] = color(li["color"])
+
+    objects = []
+    for o in data.get("objects", []):
+        o = dict(o)
+        t = dict(o.get("transform", {}))
+        for key in ("translate", "scale"):
+            if key in t:
+                t[key] = vec3(t[key])
+        o["transform"] = Transform(**t)
+        o["material"] = MaterialSpec(**o.get("material", {}))
+        objects.append(ObjectSpec(**o))
+
+    scene = SceneSpec(camera=CameraSpec(**cam), light=LightSpec(**li), objects=objects)
+    for key in ("name", "max_depth"):
+        if key in data:
+            setattr(scene, key, data[key])
+    for key in ("background", "ambient_light"):
+        if key in data:
+            setattr(scene, key, color(data[key]))
+    return scene
+
+
+def build_scene(scene: SceneSpec):
+    # the Scene of the module export_scene_py would write, built directly:
+    # specs come from clients of the render daemon, nothing of them is run
+    def vec3(v: Vec3):
+        return Vector3D(float(v.x), float(v.y), float(v.z))
+
+    def color(c: Color3):
+        return Color(float(c.r), float(c.g), float(c.b))
+
+    built = BaseScene(str(scene.name))
+    built.background = color(scene.background)
+    built.ambient_light = color(scene.ambient_light)
+    built.max_depth = int(scene.max_depth)
+    cam = scene.camera
+    built.camera = Camera(eye=vec3(cam.eye), look_at=vec3(cam.look_at), up=vec3(cam.up), fov=float(cam.fov),
+                          img_width=int(cam.img_width), img_height=int(cam.img_height))
+    li = scene.light
+    built.lights = [AreaLight(position=vec3(li.position), look_at=vec3(li.look_at), up=vec3(li.up),
+                              width=float(li.width), height=float(li.height), color=color(li.color),
+                              intensity=float(li.intensity), shadow_samples=int(li.shadow_samples))]
+
+    for obj in scene.objects:
+        kind, v = _material_values(obj.material)
+        if kind == "matte":
+            material = SimpleMaterialWithShadows(v["ambient"], v["diffuse"], Color(v["dr"], v["dg"], v["db"]),
+                                                 v["specular"], Color(1, 1, 1), v["shininess"])
+        elif kind == "checker":
+            material = CheckerboardMaterial(v["ambient"], v["diffuse"], v["square_size"])
+        else:  # mirror
+            material = ReflectiveMaterial(0.0, 0.0, Color(0, 0, 0), 0.0, Color(0, 0, 0),
+                                          reflection_coefficient=v["reflection"])
+
+        kind, v = _shape_values(obj)
+        if kind == "ball":
+            shape = Ball(center=Vector3D(0, 0, 0), radius=v["radius"])
+        elif kind == "cube":
+            shape = Cube(size=v["size"])
+        elif kind == "cilinder":
+            shape = Cilinder(radius=v["radius"], height=v["height"])
+        else:  # planeuv
+            shape = PlaneUV(point=Vector3D(v["px"], v["py"], v["pz"]), normal=Vector3D(v["nx"], v["ny"], v["nz"]),
+                            forward_direction=Vector3D(v["fx"], v["fy"], v["fz"]))
+
+        transform = _object_transform(obj)
+        if transform is not None:
+            M, tr = transform
+            shape = ObjectTransform(shape, np.array(M, dtype=float))
+            if tr is not None:
+                shape = Translate(shape, vec3(tr))
+        built.add(shape, material, **_object_flags(obj))
+    return built
+
+
+def object_edit(old: SceneSpec, new: SceneSpec) -> Optional[Tuple[int, bool]]:
+    # (index, geometry) when new is old with one object edited, added at the
+    # end or removed from the end; geometry is False for material-only edits.
+    # None for any other difference (camera, light, settings, several objects)
+    if replace(old, name="", objects=[]) != replace(new, name="", objects=[]):
+        return None
+    if len(new.objects) == len(old.objects) + 1 and new.objects[:-1] == old.objects:
+        return len(old.objects), True
+    if len(new.objects) == len(old.objects) - 1 and old.objects[:-1] == new.objects:
+        return len(new.objects), True
+    if len(new.objects) != len(old.objects):
+        return None
+    changed = [k for k, (a, b) in enumerate(zip(old.objects, new.objects)) if a != b]
+    if len(changed) != 1:
+        return None
+    k = changed[0]
+    a, b = old.objects[k], new.objects[k]
+    return k, replace(a, name="", material=b.material) != replace(b, name="")
+
+
+def shading_edit(old: SceneSpec, new: SceneSpec) -> bool:
+    # whether new is old with only what deferred shading redoes edited:
+    # materials, the light, the background and the ambient light
+    def geometry(spec):
+        objects = [replace(o, name="", material=MaterialSpec()) for o in spec.objects]
+        return replace(spec, name="", background=Color3(), ambient_light=Color3(), light=LightSpec(), objects=objects)
+
+    return geometry(old) == geometry(new)
+
+
+def light_edit(old: SceneSpec, new: SceneSpec) -> bool:
+    # whether new is old with at most the color and intensity of the light
+    # edited, what light buffers (see lightbuffers.py) redo without rendering
+    def unlit(spec):
+        return replace(spec, name="", light=replace(spec.light, color=Color3(), intensity=1.0))
+
+    return unlit(old) == unlit(new)
+
+
+def light_levels(spec: SceneSpec) -> list:
+    # (color, intensity) of each light, as lightbuffers.compose takes them
+    li = spec.light
+    return [((li.color.r, li.color.g, li.color.b), li.intensity)]
@@ -0,0 +1,81 @@
+import json
+import base64
+import socket
+
+import numpy as np
+
+# Protocol of the render daemon (daemon.py): one JSON object per line, both
+# ways, over a local TCP socket. Requests:
+#
+#   {"type": "render", "id": ..., "scene": module | "spec": SceneSpec as a dict,
+#    "width": ..., "height": ..., "num_samples": ..., "priority": "preview" | "final" | int,
+#    "stream": bool, "output": path, and any raster.py option by its long name}
+#   {"type": "cancel", "id": ...}
+#
+# Events of a job, tagged with its id:
+#
+#   {"event": "started", "width": ..., "height": ..., "tiles": ...}
+#   {"event": "progress", "tile": [i0, i1, j0, j1], "done": ..., "total": ..., "data": ...}
+#   {"event": "done", "seconds": ..., "output": ...} | "cancelled" | "error" (with "message")
+#
+# "data" (with "stream") holds the tile's pixels resolved so far, float32
+# rows from i0 up, base64 encoded: see tile_pixels.
+
+DefaultAddress = 'localhost:7878'
+# lower runs first
+Priorities = {'preview': 0, 'final': 1}
+FinalEvents = ('done', 'cancelled', 'error')
+
+def encode(message):
+    return (json.dumps(message) + '\n').encode()
+
+def encode_pixels(pixels):
+    return base64.b64encode(np.ascontiguousarray(pixels, dtype='<f4').tobytes()).decode('ascii')
+
+def tile_pixels(event):
+    # pixels of a progress event, shape (i1 - i0, j1 - j0, 3)
+    i0, i1, j0, j1 = event['tile']
+    return np.frombuffer(base64.b64decode(event['data']), dtype='<f4').reshape(i1 - i0, j1 - j0, 3)
+
+class RenderClient:
+    # blocking client, for scripts and app.py
+    def __init__(self, address=DefaultAddress, timeout=None):
+        host, _, port = address.rpartition(':')
+        self.sock = socket.create_connection((host or 'localhost', int(port)), timeout=timeout)
+        self.sock.settimeout(None)
+        self.lines = self.sock.makefile('rb')
+        self.next_id = 0
+
+    def submit(self, request):
+        # sends a render request, returns its id
+        request = dict(request, type='render')
+        if 'id' not in request:
+            self.next_id += 1
+            request['id'] = self.next_id
+        self.sock.sendall(encode(request))
+        return request['id']
+
+    def cancel(self, job):
+        self.sock.sendall(encode(dict(type='cancel', id=job)))
+
+    def events(self):
+        # events of all the jobs of this client, as they come
+        for line in self.lines:
+            yield json.loads(line)
+
+    def render(self, request, callback=None):
+        # submits a job and waits for its last event, which is returned;
+        # callback receives the other events
+        job = self.submit(request)
+        for event in self.events():
+            if event.get('id') != job:
+                continue
+            if event['event'] in FinalEvents:
+                return event
+            if callback is not None:
+                callback(event)
+        raise ConnectionError("The render daemon closed the connection")
+
+    def close(self):
+        self.lines.close()
+        self.sock.close()
@@ -0,0 +1,53 @@
+class ShadowCache:
+    """Recent occluders of each light, tested first by the next shadow rays towards that light."""
+    # occluders remembered per light in the current tile
+    TileCandidates = 4
+
+    def __init__(self):
+        self.tile = None
+        # per light: the occluders of the current tile, most recent first, and
+        # how many rays each blocked; the worker-wide entry is the occluder
+        # that blocked the most rays in the last tile that had one
+        self.tile_occluders = dict()
+        self.tile_blocks = dict()
+        self.last_occluders = dict()
+        # counters: shadow rays that went through the cache and how many
+        # of them were blocked by a cached shape
+        self.lookups = 0
+        self.hits = 0
+
+    def begin_tile(self, tile):
+        self.end_tile()
+        self.tile = tile
+
+    def end_tile(self):
+        # the main occluder of each light of the tile becomes the worker-wide entry
+        for key, blocks in self.tile_blocks.items():
+            self.last_occluders[key] = max(blocks.values(), key=lambda entry: entry[0])[1]
+        self.tile_occluders = dict()
+        self.tile_blocks = dict()
+
+    def lookup(self, light):
+        # shapes to test first, in order
+        key = id(light)
+        shapes = list(self.tile_occluders.get(key, ()))
+        last = self.last_occluders.get(key)
+        if last is not None and all(shape is not last for shape in shapes):
+            shapes.append(last)
+        return shapes
+
+    def store(self, light, shape, blocked=1):
+        # shape just blocked blocked rays towards light
+        key = id(light)
+        shapes = [shape] + [other for other in self.tile_occluders.get(key, ()) if other is not shape]
+        self.tile_occluders[key] = shapes[:self.TileCandidates]
+        blocks = self.tile_blocks.setdefault(key, dict())
+        count, _ = blocks.get(id(shape), (0, shape))
+        blocks[id(shape)] = (count + blocked, shape)
+
+    def counters(self):
+        return self.lookups, self.hits
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups else 0.0
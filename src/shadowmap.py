@@ -0,0 +1,132 @@
+import numpy as np
+
+from .ray import Ray
+from .camera import Camera
+from .light import PointLight
+from .vector3d import Vector3D
+from .base import CastEpsilon
+from .rasterizer import rasterize, convex
+
+# Cube shadow maps for point lights. The shadow casters are rasterized from
+# the light into the six faces of a cube, keeping the distance to the
+# closest caster and which caster it is for every texel. A shading point
+# compares its distance with the 3x3 texels around its direction from the
+# light (percentage-closer filtering), with a depth bias that grows with the
+# slope of the surface seen from the light: its visibility is the fraction
+# of the texels that leave it lit, so shadow edges are smoothed over a
+# texel instead of following the texel grid.
+#
+# The meshes contain their shapes, so texels with nothing in front of the
+# point can be trusted; a fully shadowed point is confirmed with one exact
+# hit against the caster its texels report, and traced when that fails.
+# Casters that cannot be tessellated are tested exactly by every point that
+# is not fully shadowed, and casters thinner than a texel can slip between
+# texel centers, as for the primary rasterizer.
+
+# depth bias, relative to the distance to the light: a constant part, and a
+# part per texel of depth change across the texel (the tangent of the angle
+# between the normal and the light), capped for grazing angles
+ShadowMapTolerance = 0.01
+SlopeBias = 1.0
+MaxSlope = 10.0
+# (looking direction, up) of the faces, in the order +x, -x, +y, -y, +z, -z
+CubeFaces = [
+    ((1, 0, 0), (0, 0, 1)), ((-1, 0, 0), (0, 0, 1)),
+    ((0, 1, 0), (0, 0, 1)), ((0, -1, 0), (0, 0, 1)),
+    ((0, 0, 1), (0, 1, 0)), ((0, 0, -1), (0, 1, 0)),
+]
+
+def _blocks(shape, origin, target):
+    to_target = target - origin
+    shadow_hit = shape.hit(Ray(origin, to_target))
+    return shadow_hit.hit and CastEpsilon < shadow_hit.t < to_target.length()
+
+class CubeShadowMap:
+    def __init__(self, scene, light, resolution):
+        self.resolution = resolution
+        # distance to the closest caster and its index in shapes (-1 for none)
+        self.t = np.empty((6, resolution, resolution), dtype=np.float32)
+        self.ids = np.empty((6, resolution, resolution), dtype=np.int32)
+        self.axes = np.empty((6, 3, 3))  # u, v and w of every face
+        pairs = [(shape, None) for shape in scene.shadow_casters]
+        for f, (look, up) in enumerate(CubeFaces):
+            face = Camera(light.pos, light.pos + Vector3D(*look), Vector3D(*up), 90, resolution, resolution)
+            vis = rasterize(scene, face, pairs)
+            self.t[f] = vis.t
+            self.ids[f] = vis.ids
+            self.axes[f] = [axis.as_list() for axis in (face.u, face.v, face.w)]
+        self.shapes = [shape for shape, _ in vis.pairs]
+        self.extras = [shape for shape, _ in vis.extras]
+        self.index = {id(shape): k for k, shape in enumerate(self.shapes)}
+        # index of the convex ones (see visibility), -2 for the others
+        self.convex = np.array([k if convex(shape) else -2 for k, shape in enumerate(self.shapes)] + [-2])
+
+    def __setstate__(self, state):
+        # object ids change when the map is sent to a worker
+        self.__dict__.update(state)
+        self.index = {id(shape): k for k, shape in enumerate(self.shapes)}
+
+    def visibility(self, points, normals, light_vectors, receivers=None):
+        # fraction of the light seen from every point, nan where the exact
+        # shadow ray is needed. receivers are the shapes the points lie on, if known
+        n, res = len(points), self.resolution
+        visibility = np.full(n, np.nan)
+        rel = -light_vectors  # from the light to the points
+        dist = np.linalg.norm(rel, axis=1)
+
+        # the dominant axis of the direction picks the face
+        axis = np.argmax(np.abs(rel), axis=1)
+        face = 2 * axis + (rel[np.arange(n), axis] < 0)
+        u, v, w = self.axes[face, 0], self.axes[face, 1], self.axes[face, 2]
+        z = -np.einsum('ij,ij->i', rel, w)
+        j = np.rint((np.einsum('ij,ij->i', rel, u) / z + 1) * res / 2 - 0.5).astype(int)
+        i = np.rint((np.einsum('ij,ij->i', rel, v) / z + 1) * res / 2 - 0.5).astype(int)
+        # the kernel of texels on a face border would cross to another face
+        inside = (i > 0) & (i < res - 1) & (j > 0) & (j < res - 1)
+        if not inside.any():
+            return visibility
+        k = np.flatnonzero(inside)
+        rows = i[k, None] + np.repeat([-1, 0, 1], 3)
+        cols = j[k, None] + np.tile([-1, 0, 1], 3)
+        t = self.t[face[k, None], rows, cols]
+        ids = self.ids[face[k, None], rows, cols]
+        d = dist[k, None]
+        # slope scaled bias: the depth covered by one texel grows with tan(angle)
+        cos = np.abs(np.einsum('ij,ij->i', normals[k], light_vectors[k])) / np.maximum(dist[k], 1e-12)
+        slope = np.minimum(np.sqrt(np.maximum(1 - cos * cos, 0)) / np.maximum(cos, 1e-6), MaxSlope)
+        bias = d * (ShadowMapTolerance + SlopeBias * (2 / res) * slope[:, None])
+
+        # a convex receiver cannot shadow itself where it faces the light
+        receiver = np.full(len(k), -2)
+        if receivers is not None:
+            receiver = self.convex[[self.index.get(id(receivers[m]), -1) for m in k]]
+        facing = np.einsum('ij,ij->i', normals[k], light_vectors[k]) > 0
+        own = (ids == receiver[:, None]) & facing[:, None]
+        clear = (ids < 0) | own | (t > d - bias)
+        fraction = clear.mean(axis=1)
+        shadowed = (fraction == 0) & (ids == ids[:, :1]).all(axis=1)
+
+        for m in range(len(k)):
+            p = k[m]
+            if fraction[m] == 0 and not shadowed[m]:
+                # covered by several casters: left to the exact ray
+                continue
+            origin = Vector3D(*points[p]) + Vector3D(*normals[p]) * CastEpsilon
+            target = Vector3D(*(points[p] + light_vectors[p]))
+            if shadowed[m]:
+                if _blocks(self.shapes[ids[m, 0]], origin, target):
+                    visibility[p] = 0.0
+            elif self.extras and any(_blocks(shape, origin, target) for shape in self.extras):
+                visibility[p] = 0.0
+            else:
+                visibility[p] = fraction[m]
+        return visibility
+
+def build_shadow_maps(scene, resolution):
+    # attaches a shadow map to every point light of the scene, returns how many
+    count = 0
+    for light in scene.lights:
+        if isinstance(light, PointLight):
+            light.shadow_map = CubeShadowMap(scene, light, resolution)
+            count += 1
+    return count
@@ -1,3 +1,5 @@
+from functools import partial
+
 from src.vector3d import Vector3D
 from .base import Shape, HitRecord, CastEpsilon
 import numpy as np
@@ -32,7 +34,14 @@ class Ball(Shape):
                     point = ray.point_at_parameter(t)
                     normal = (point - self.center).normalize()
 
-            return HitRecord(hit, t, point, normal)
+            return HitRecord(hit, t, point, normal, uv=partial(self.uv, normal) if hit else None)
+
+    def uv(self, normal):
+        # arc lengths along the equator and from the south pole, so textures
+        # keep the same scale as on planes
+        phi = np.arctan2(normal.y, normal.x) + np.pi
+        theta = np.arccos(max(min(normal.z, 1.0), -1.0))
+        return Vector3D(self.radius * phi, self.radius * (np.pi - theta), 0)
 
 class Plane(Shape):
     def __init__(self, point, normal):
@@ -69,9 +78,21 @@ class PlaneUV(Shape):
                 u = vec.dot(self.right_direction)
                 v = vec.dot(self.forward_direction)
                 uv = Vector3D(u, v, 0)
-                return HitRecord(True, t, point, self.normal, uv=uv)
+                hit_rec = HitRecord(True, t, point, self.normal, uv=uv)
+                if ray.differentials is not None:
+                    hit_rec.uv_derivatives = self.uv_derivatives(ray, t, denom)
+                return hit_rec
         return HitRecord(False, float('inf'), None, None)
 
+    def uv_derivatives(self, ray, t, denom):
+        # (du/dx, dv/dx, du/dy, dv/dy) per pixel: each direction differential
+        # moves the hit along the plane by t * (dd - d * (dd.n) / (d.n))
+        derivatives = []
+        for dd in ray.differentials:
+            dp = (dd - ray.direction * (dd.dot(self.normal) / denom)) * t
+            derivatives += [dp.dot(self.right_direction), dp.dot(self.forward_direction)]
+        return tuple(derivatives)
+
 class ImplicitFunction(Shape):
     def __init__(self, function):
         super().__init__("implicit_function")
@@ -157,10 +178,19 @@ class Cube(Shape):
                     normal = Vector3D(0, 0, -1)
                 else:
                     normal = Vector3D(0, 0, 1)
-                return HitRecord(hit=True, t=t, point=point, normal=normal)
+                return HitRecord(hit=True, t=t, point=point, normal=normal, uv=partial(self.uv, point, normal))
 
         return HitRecord(hit=False, t=float('inf'), point=None, normal=None)
 
+    def uv(self, point, normal):
+        # coordinates inside the face, from its corner
+        half = self.size / 2
+        if normal.x != 0:
+            return Vector3D(point.y + half, point.z + half, 0)
+        if normal.y != 0:
+            return Vector3D(point.x + half, point.z + half, 0)
+        return Vector3D(point.x + half, point.y + half, 0)
+
 class Cilinder(Shape):
     def __init__(self, radius, height):
         super().__init__("cilinder")
@@ -189,7 +219,9 @@ class Cilinder(Shape):
             point = ray.point_at_parameter(__t)
             if -self.height/2 <= point.z <= self.height/2:
                 normal = Vector3D(point.x, point.y, 0).normalize()
-                return HitRecord(True, __t, point, normal)
+                # arc length around the axis and height from the bottom
+                uv = Vector3D(self.radius * (np.arctan2(point.y, point.x) + np.pi), point.z + self.height/2, 0)
+                return HitRecord(True, __t, point, normal, uv=uv)
         
         # verify if the ray hits the caps of the cylinder
         if discriminant >= 0:
@@ -218,7 +250,9 @@ class Cilinder(Shape):
                     point = ray.point_at_parameter(t)
             
             if t < float('inf'):
-                return HitRecord(True, t, point, normal)
+                # caps use their x, y coordinates
+                uv = Vector3D(point.x + self.radius, point.y + self.radius, 0)
+                return HitRecord(True, t, point, normal, uv=uv)
         return HitRecord(False, float('inf'), None, None)
 
 
@@ -230,12 +264,14 @@ class Translate(Shape):
 
     def hit(self, ray):
         moved_origin = ray.origin - self.offset
-        moved_ray = Ray(moved_origin, ray.direction)
+        moved_ray = Ray(moved_origin, ray.direction, differentials=ray.differentials)
         hit_rec = self.shape.hit(moved_ray)
         if hit_rec.hit:
             point = hit_rec.point + self.offset
             normal = hit_rec.normal
-            return HitRecord(True, hit_rec.t, point, normal, uv=getattr(hit_rec, 'uv', None))
+            moved_hit = HitRecord(True, hit_rec.t, point, normal, uv=hit_rec.lazy_uv)
+            moved_hit.uv_derivatives = hit_rec.uv_derivatives
+            return moved_hit
         return HitRecord(False, float('inf'), None, None)
 
 
@@ -253,7 +289,13 @@ class ObjectTransform(Shape):
         origin_inv = self.inverse_transform_func @ origin
         norm_dir_inv = np.linalg.norm(direction_inv)
         direction_inv = direction_inv / norm_dir_inv
-        ray_in_obj_space = Ray(Vector3D(*origin_inv), Vector3D(*direction_inv))
+        differentials = None
+        if ray.differentials is not None:
+            # linear in the direction, with the same rescaling
+            differentials = tuple(
+                Vector3D(*(self.inverse_transform_func @ np.array(dd.as_list()) / norm_dir_inv))
+                for dd in ray.differentials)
+        ray_in_obj_space = Ray(Vector3D(*origin_inv), Vector3D(*direction_inv), differentials=differentials)
         hit_rec = self.shape.hit(ray_in_obj_space)
         
         if hit_rec.hit:
@@ -268,7 +310,9 @@ class ObjectTransform(Shape):
             if normal.dot(ray.direction) > 0:
                 normal = -normal
 
-            return HitRecord(True, hit_rec.t / norm_dir_inv, point, normal, uv=hit_rec.uv)
+            world_hit = HitRecord(True, hit_rec.t / norm_dir_inv, point, normal, uv=hit_rec.lazy_uv)
+            world_hit.uv_derivatives = hit_rec.uv_derivatives
+            return world_hit
         
         return HitRecord(False, float('inf'), None, None)
 
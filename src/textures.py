@@ -0,0 +1,158 @@
+import os
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+from .imageio import read_image
+
+# Image textures are stored as mip pyramids in a tiled file next to the image
+# (<image>.mip, float16, plus a <image>.mip.json index). The file is memory
+# mapped and read one tile at a time through a bounded LRU cache, so the
+# memory used by a worker does not grow with the number or size of textures.
+
+TileTexels = 32
+
+class TileCache:
+    """LRU cache of texture tiles with a budget in bytes, shared by all textures of a process."""
+    def __init__(self, budget):
+        self.budget = budget
+        self.tiles = OrderedDict()
+        self.size = 0
+        self.lookups = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        self.lookups += 1
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            return tile
+        self.misses += 1
+        tile = load()
+        self.tiles[key] = tile
+        self.size += tile.nbytes
+        # always keep the tile just loaded, even if it alone exceeds the budget
+        while self.size > self.budget and len(self.tiles) > 1:
+            _, old = self.tiles.popitem(last=False)
+            self.size -= old.nbytes
+        return tile
+
+    def resize(self, budget):
+        self.budget = budget
+        while self.size > self.budget and self.tiles:
+            _, old = self.tiles.popitem(last=False)
+            self.size -= old.nbytes
+
+# one cache per process (each worker gets its own when the pool starts)
+tile_cache = TileCache(64 << 20)
+
+def _downsample(level):
+    # 2x2 box filter; odd sizes repeat their last row/column
+    h, w, _ = level.shape
+    if h % 2:
+        level = np.concatenate([level, level[-1:]], axis=0)
+    if w % 2:
+        level = np.concatenate([level, level[:, -1:]], axis=1)
+    return 0.25 * (level[0::2, 0::2] + level[1::2, 0::2] + level[0::2, 1::2] + level[1::2, 1::2])
+
+def build_mip_file(image, path):
+    # writes the pyramid of image (H, W, 3) as tiles, returns the level table
+    levels = [image]
+    while levels[-1].shape[0] > 1 or levels[-1].shape[1] > 1:
+        levels.append(_downsample(levels[-1]))
+
+    table = []
+    offset = 0
+    for level in levels:
+        h, w, _ = level.shape
+        tiles_x, tiles_y = -(-w // TileTexels), -(-h // TileTexels)
+        table.append([w, h, tiles_x, tiles_y, offset])
+        offset += tiles_x * tiles_y
+
+    tiles = np.memmap(path, dtype=np.float16, mode='w+', shape=(offset, TileTexels, TileTexels, 3))
+    for level, (w, h, tiles_x, tiles_y, first) in zip(levels, table):
+        # pad to whole tiles by repeating the border
+        padded = np.pad(level, ((0, tiles_y * TileTexels - h), (0, tiles_x * TileTexels - w), (0, 0)), mode='edge')
+        blocks = padded.reshape(tiles_y, TileTexels, tiles_x, TileTexels, 3).swapaxes(1, 2)
+        tiles[first:first + tiles_x * tiles_y] = blocks.reshape(-1, TileTexels, TileTexels, 3)
+    tiles.flush()
+    del tiles
+    return table
+
+class MipTexture:
+    def __init__(self, path, width=None, height=None, channels=3, dtype=np.uint8):
+        # width/height/channels/dtype are only needed for raw images
+        self.path = path
+        self.mip_path = path + '.mip'
+        index_path = self.mip_path + '.json'
+        mtime = os.path.getmtime(path)
+
+        index = None
+        if os.path.exists(index_path) and os.path.exists(self.mip_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            if index.get('mtime') != mtime or index.get('tile') != TileTexels:
+                index = None
+        if index is None:
+            image = read_image(path, width, height, channels, dtype)
+            index = {'mtime': mtime, 'tile': TileTexels, 'levels': build_mip_file(image, self.mip_path)}
+            with open(index_path, 'w') as f:
+                json.dump(index, f)
+
+        self.levels = index['levels']
+        self.width, self.height = self.levels[0][0], self.levels[0][1]
+        self._tiles = None
+
+    def __getstate__(self):
+        # the memory map is reopened by each worker
+        state = self.__dict__.copy()
+        state['_tiles'] = None
+        return state
+
+    def tile(self, index):
+        if self._tiles is None:
+            self._tiles = np.memmap(self.mip_path, dtype=np.float16, mode='r')
+            self._tiles = self._tiles.reshape(-1, TileTexels, TileTexels, 3)
+        return tile_cache.get((self.mip_path, index),
+                              lambda: np.asarray(self._tiles[index], dtype=np.float32))
+
+    def texels(self, level, x, y):
+        # (N, 3) colors of the integer texel coordinates x, y (wrapped) of a level
+        w, h, tiles_x, _, first = self.levels[level]
+        x, y = x % w, y % h
+        ids = first + (y // TileTexels) * tiles_x + x // TileTexels
+        colors = np.empty((len(x), 3), dtype=np.float32)
+        for index in np.unique(ids):
+            sel = ids == index
+            colors[sel] = self.tile(int(index))[y[sel] % TileTexels, x[sel] % TileTexels]
+        return colors
+
+    def bilinear(self, level, s, t):
+        # s, t in [0, 1) texture coordinates, t = 0 at the bottom of the image
+        w, h = self.levels[level][0], self.levels[level][1]
+        x = s * w - 0.5
+        y = (1 - t) * h - 0.5
+        x0, y0 = np.floor(x), np.floor(y)
+        fx, fy = (x - x0)[:, None], (y - y0)[:, None]
+        x0, y0 = x0.astype(np.int64), y0.astype(np.int64)
+        top = self.texels(level, x0, y0) * (1 - fx) + self.texels(level, x0 + 1, y0) * fx
+        bottom = self.texels(level, x0, y0 + 1) * (1 - fx) + self.texels(level, x0 + 1, y0 + 1) * fx
+        return top * (1 - fy) + bottom * fy
+
+    def sample(self, s, t, footprint):
+        # trilinear lookup: footprint is the width of the filter in texture
+        # coordinates, it picks the two mip levels to blend
+        texels = np.maximum(footprint * max(self.width, self.height), 1.0)
+        lod = np.clip(np.log2(texels), 0, len(self.levels) - 1)
+        lower = np.floor(lod).astype(np.int64)
+        frac = (lod - lower)[:, None]
+        colors = np.zeros((len(s), 3), dtype=np.float32)
+        for level in np.unique(lower):
+            sel = lower == level
+            colors[sel] = self.bilinear(int(level), s[sel], t[sel])
+            upper = min(int(level) + 1, len(self.levels) - 1)
+            blend = sel & (frac[:, 0] > 0)
+            if upper != level and blend.any():
+                colors[blend] += (self.bilinear(upper, s[blend], t[blend]) - colors[blend]) * frac[blend]
+        return colors
@@ -0,0 +1,107 @@
+import math
+
+import numpy as np
+
+from .base import HitBatch
+from . import denoise, rasterizer
+
+# Wavefront path engine: instead of each material tracing its secondary rays
+# recursively, the rays of a tile advance one bounce at a time. Every bounce
+# intersects its whole queue in one batch, shades the hits grouped by
+# material (Material.shade_batch) and pushes the spawned rays, with their
+# accumulated weights, to the queue of the next bounce. Paths whose throughput gets too low are
+# terminated there (see BaseScene.surviving).
+
+class PathState:
+    def __init__(self, sample, ray, weight):
+        self.sample = sample  # index of the camera sample inside the tile
+        self.ray = ray
+        self.weight = weight  # product of the weights along the path
+
+def primary_queue(camera, tile, num_samples, mask=None):
+    # one path per camera sample, and the (x, y) film position of each sample;
+    # with a mask (of the tile's pixels) only the pixels set in it
+    i0, i1, j0, j1 = tile
+    queue = []
+    positions = []
+    scale = 1 / math.sqrt(num_samples)
+    for i in range(i0, i1):
+        for j in range(j0, j1):
+            if mask is not None and not mask[i - i0, j - j0]:
+                continue
+            for _ in range(num_samples):
+                # random offset for anti-aliasing, around the middle of the pixel
+                dx = np.random.uniform(-0.5, 0.5)
+                dy = np.random.uniform(-0.5, 0.5)
+                x, y = j + 0.5 + dx, i + 0.5 + dy
+                queue.append(PathState(len(queue), camera.ray(x, y).scale_differentials(scale), 1.0))
+                positions.append((x, y))
+    return queue, np.array(positions).reshape(-1, 2)
+
+def trace_bounce(scene, queue, samples, hits=None, record=None, visibility=None):
+    # advances the queue by one bounce, returns the queue of the next one.
+    # record (a dependencies.SampleRecord) gets the shapes the bounce depends on,
+    # visibility is the (S, L) light visibility of the hits when already known.
+    # samples (S, 3) get the colors, or (S, 1 + 2L, 3) their light parts
+    # (see Material.shade_parts_batch)
+    if hits is None:
+        hits = scene.hit_batch([path.ray for path in queue])
+    if record is not None and queue:
+        record.record([path.sample for path in queue], hits, queue[0].ray.depth)
+
+    # sort hits by material so each material shades its hits together
+    groups = dict()
+    missed = []
+    for k, (path, hit_rec) in enumerate(zip(queue, hits)):
+        if hit_rec.hit:
+            groups.setdefault(id(hit_rec.material), []).append((k, path, hit_rec))
+        else:
+            missed.append(path)
+    if missed:
+        np.add.at(samples if samples.ndim == 2 else samples[:, 0], [path.sample for path in missed],
+                  np.outer([path.weight for path in missed], scene.background.as_list()))
+
+    next_queue = []
+    for group in groups.values():
+        material = group[0][2].material
+        paths = [path for _, path, _ in group]
+        batch = HitBatch.from_records([hit_rec for _, _, hit_rec in group])
+        if visibility is not None:
+            batch.visibility = visibility[[k for k, _, _ in group]]
+        if samples.ndim == 2:
+            colors = material.shade_batch(batch, scene)
+        else:
+            colors = material.shade_parts_batch(batch, scene)
+        weights = np.array([path.weight for path in paths]).reshape((-1,) + (1,) * (colors.ndim - 1))
+        np.add.at(samples, [path.sample for path in paths], colors * weights)
+        for _, path, hit_rec in group:
+            for ray, weight in scene.surviving(material.scatter(hit_rec, scene)):
+                next_queue.append(PathState(path.sample, ray, path.weight * weight))
+    return next_queue
+
+def render_tile(scene, camera, tile, num_samples, aux=False, vis=None, mask=None, record=None, gbuffer=None,
+                light_parts=False):
+    # film positions (S, 2) and colors (S, 3) of the camera samples of a
+    # tile. With aux, also the first hit buffers and object ids (see denoise).
+    # With a visibility buffer the camera rays use rasterizer.primary_hit.
+    # mask and record as in primary_queue and trace_bounce; gbuffer (see
+    # gbuffer.py) keeps the first hits and their light visibility. With
+    # light_parts the colors are (S, 1 + 2L, 3) light parts, see trace_bounce
+    queue, positions = primary_queue(camera, tile, num_samples, mask)
+    samples = np.zeros((len(queue), 1 + 2 * len(scene.lights), 3) if light_parts else (len(queue), 3))
+    first_hits = None
+    if aux or vis is not None or gbuffer is not None:
+        if vis is not None:
+            hits = [rasterizer.primary_hit(scene, vis, path.ray, x, y)
+                    for path, (x, y) in zip(queue, positions.tolist())]
+        else:
+            hits = scene.hit_batch([path.ray for path in queue])
+        if aux:
+            first_hits = denoise.first_hit_aux(scene, hits)
+        visibility = gbuffer.capture(scene, tile, positions, hits) if gbuffer is not None else None
+        queue = trace_bounce(scene, queue, samples, hits, record, visibility)
+    while queue:
+        queue = trace_bounce(scene, queue, samples, record=record)
+    if aux:
+        return positions, samples, first_hits
+    return positions, samples